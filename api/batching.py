@@ -0,0 +1,122 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class InferenceBatcher:
+    """
+    Collects concurrent prediction requests into batches and runs the model off the event loop.
+
+    Args:
+    - predict_fn: callable, takes a np.array batch (N, H, W, C) and returns N predictions
+    - max_batch_size: int, maximum number of images sent to the model at once
+    - max_wait_ms: float, how long the first request of a batch waits for others to join it
+    - on_batch: callable on_batch(size, seconds), called after each model call, or None
+    """
+
+    def __init__(self, predict_fn, max_batch_size=32, max_wait_ms=5.0, on_batch=None):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.on_batch = on_batch
+        self._queue = None
+        self._task = None
+        self._executor = None
+
+    async def start(self):
+        # A single thread: the model processes one batch at a time
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        # Fail the requests still waiting in the queue
+        while self._queue is not None and not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Inference batcher stopped."))
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def queue_size(self):
+        """
+        Number of requests waiting for the next batch.
+        """
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _timed_predict(self, images):
+        start = time.perf_counter()
+        try:
+            return self.predict_fn(images)
+        finally:
+            if self.on_batch is not None:
+                self.on_batch(len(images), time.perf_counter() - start)
+
+    async def predict(self, image):
+        """
+        Queue a single preprocessed image and wait for its prediction.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image, future))
+        return await future
+
+    async def run_batch(self, images):
+        """
+        Run an already formed batch on the inference thread, next to the queued requests.
+        """
+        loop = asyncio.get_running_loop()
+        predictions = await loop.run_in_executor(self._executor, self._timed_predict, images)
+        return np.asarray(predictions)
+
+    async def _collect_batch(self):
+        loop = asyncio.get_running_loop()
+
+        # Wait for the first request, then give the others max_wait to join
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Skip requests whose caller has gone away
+        return [(image, future) for image, future in batch if not future.done()]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            if not batch:
+                continue
+
+            images = np.stack([image for image, _ in batch])
+            try:
+                predictions = await loop.run_in_executor(
+                    self._executor, self._timed_predict, images
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            # Send each result back to its caller
+            for (_, future), prediction in zip(batch, np.asarray(predictions)):
+                if not future.done():
+                    future.set_result(prediction)
@@ -1,144 +1,777 @@
-from fastapi import FastAPI, HTTPException
-from pymongo import MongoClient
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import JSONResponse, Response
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
 from bson import ObjectId
+from bson.errors import InvalidId
 import numpy as np
 import mlflow
 import cv2
-import base64
 from bson import ObjectId
 from datetime import datetime
 from pydantic import BaseModel
-from typing import Optional
-import requests
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import asyncio
+import contextvars
+import hashlib
+import time
+import traceback
 
 import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from hidden import MONGO_URI, MLFLOW_RUN, MLFLOW_URI
+from batching import InferenceBatcher
+from model_backends import BACKENDS, load_model, model_version, prepare_model
+from model_registry import (
+    ModelRegistry,
+    ServedModel,
+    get_deployment,
+    get_deployment_sync,
+    set_deployment,
+)
+from prediction_cache import PredictionCache
+from preprocessing import (
+    PREPROCESSING_PARAMS,
+    PREPROCESSING_VERSION,
+    decode_and_normalize,
+)
+from common.scan_store import (
+    get_roi_async,
+    get_thumbnail_async,
+    has_scan,
+    make_thumbnail,
+    put_roi_async,
+    put_thumbnail_async,
+    read_scan_buffer_async,
+)
+from common.feedback_store import (
+    FEEDBACK_COLLECTION,
+    FeedbackBuffer,
+    ensure_feedback_indexes,
+    feedback_document,
+)
+from common.metrics import CONTENT_TYPE, MetricsMiddleware, MetricsRegistry, stage
+from common.scan_similarity import (
+    PerceptualHashIndex,
+    ensure_phash_indexes,
+    find_exact_async,
+    find_same_roi_async,
+    phash_document,
+    put_phash_async,
+)
 
 # Retrieve MLFLOW_RUN and MONGO_URI from the docker environment
 # MLFLOW_RUN = os.environ.get("MLFLOW_RUN")
 # MONGO_URI = os.environ.get("MONGO_URI")
 # MLFLOW_URI = os.environ.get("MLFLOW_URI")
 
-app = FastAPI()
-
-# Load the ML model
+# Load the ML model, with the inference backend selected by MODEL_BACKEND.
+# A model deployed with POST /admin/model takes precedence over MLFLOW_RUN.
+MODEL_BACKEND = os.environ.get("MODEL_BACKEND", "mlflow")
 mlflow.set_tracking_uri(MLFLOW_URI)
-model = mlflow.pyfunc.load_model(MLFLOW_RUN)
-
-# Load model save like a keras 
-
-# from keras import load_model
-# model=load_model("tumor_detection_model/brain_tumor_detector")
 
+# Size of the blank batch run through the model before /ready passes (0 to skip)
+WARMUP_BATCH_SIZE = int(os.environ.get("WARMUP_BATCH_SIZE", 8))
+# Delay before loading the model again after a failure
+MODEL_LOAD_RETRY_SECONDS = float(os.environ.get("MODEL_LOAD_RETRY_SECONDS", 30))
+# How often each process checks for a model deployed through another process
+MODEL_POLL_SECONDS = float(os.environ.get("MODEL_POLL_SECONDS", 10))
+# How long the requests started on a replaced model have to finish
+MODEL_DRAIN_TIMEOUT = float(os.environ.get("MODEL_DRAIN_TIMEOUT", 300))
+# When set, the admin endpoints require this value in the X-Admin-Token header
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+# Group concurrent /predict/ calls into batches for the model
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 32))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", 5))
+
+# Metrics exposed on GET /metrics. With several processes (serve.py), each one writes its
+# values to METRICS_DIR every METRICS_SNAPSHOT_SECONDS and /metrics adds them up.
+METRICS_DIR = os.environ.get("METRICS_DIR")
+METRICS_SNAPSHOT_SECONDS = float(os.environ.get("METRICS_SNAPSHOT_SECONDS", 5))
+# Requests slower than this are logged with the time spent in each stage
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 1000))
+metrics = MetricsRegistry("model_api", METRICS_DIR)
+batch_size_histogram = metrics.histogram(
+    "batch_size", "Images per model call.", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)
+)
+batch_seconds_histogram = metrics.histogram("batch_seconds", "Duration of the model calls.")
+
+
+def record_batch(size, seconds):
+    # Called by the batchers, on the inference thread
+    batch_size_histogram.observe(size)
+    batch_seconds_histogram.observe(seconds)
+
+
+# The model is loaded in the background at startup, by each process
+registry = ModelRegistry(MODEL_DRAIN_TIMEOUT)
+model_state = {"status": "loading", "error": None, "load_seconds": None, "warmup_seconds": None}
+
+
+def deployed_model(deployment):
+    if deployment is None:
+        return MLFLOW_RUN, MODEL_BACKEND
+    return deployment["model_uri"], deployment["backend"]
+
+
+def prepare_deployed_model():
+    """
+    Downloads and converts the deployed model into the local cache, without loading it.
+    Run by serve.py in a short-lived process before the workers start, so that they
+    only read it from disk instead of each downloading or converting it.
+    """
+    try:
+        deployment = get_deployment_sync(MONGO_URI)
+    except PyMongoError:
+        deployment = None
+    model_uri, backend = deployed_model(deployment)
+    start = time.perf_counter()
+    prepare_model(model_uri, backend)
+    seconds = time.perf_counter() - start
+    print(f"Model {model_uri} ({backend}) ready in the cache in {seconds:.1f} s")
+
+
+async def build_served_model(model_uri, backend):
+    """
+    Loads a model next to the one being served, with its own batcher, and warms it up.
+    """
+    start = time.perf_counter()
+    model = await asyncio.to_thread(load_model, model_uri, backend)
+    model_state["load_seconds"] = time.perf_counter() - start
+
+    batcher = InferenceBatcher(model.predict, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, record_batch)
+    await batcher.start()
+    served = ServedModel(
+        model, model_version(model, model_uri, backend), model_uri, backend, batcher
+    )
+    if WARMUP_BATCH_SIZE:
+        # The first predictions build the graph and allocate the buffers: pay it before serving
+        if registry.current is None:
+            model_state["status"] = "warming_up"
+        start = time.perf_counter()
+        try:
+            for size in sorted({1, WARMUP_BATCH_SIZE}):
+                await batcher.run_batch(np.zeros((size, 224, 224, 3), dtype=np.uint8))
+        except Exception:
+            await batcher.stop()
+            raise
+        model_state["warmup_seconds"] = time.perf_counter() - start
+    return served
+
+
+async def deploy(model_uri, backend):
+    """
+    Swaps in a new model. Must be called with registry.swap_lock held.
+
+    Returns:
+    - tuple, (new ServedModel, replaced ServedModel or None)
+    """
+    served = await build_served_model(model_uri, backend)
+    previous = await registry.swap(served)
+    prediction_cache.set_model_version(served.version)
+    await prediction_cache.setup()
+    print(f"Model {served.version} serving ({model_uri}, {backend})")
+    return served, previous
+
+
+async def start_model():
+    while True:
+        try:
+            async with registry.swap_lock:
+                await deploy(*deployed_model(await get_deployment(db)))
+            model_state.update(status="ready", error=None)
+            break
+        except Exception as e:
+            # e.g. tracking server unreachable and model not cached yet
+            traceback.print_exc()
+            model_state.update(status="failed", error=repr(e))
+            await asyncio.sleep(MODEL_LOAD_RETRY_SECONDS)
+
+    # Follow the deployments made through the other processes (pre-fork workers, replicas)
+    failed_deployment = None
+    while True:
+        await asyncio.sleep(MODEL_POLL_SECONDS)
+        deployment = None
+        try:
+            deployment = await get_deployment(db)
+            wanted = deployed_model(deployment)
+            current = (registry.current.model_uri, registry.current.backend)
+            if wanted == current or registry.swap_lock.locked() or deployment == failed_deployment:
+                continue
+            async with registry.swap_lock:
+                await deploy(*wanted)
+        except Exception:
+            traceback.print_exc()
+            failed_deployment = deployment
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # The API answers (and /ready fails) while the model is loaded in the background
+    loading = asyncio.create_task(start_model())
+    try:
+        await ensure_feedback_indexes(db)
+    except PyMongoError as e:
+        print(f"Could not create the feedback indexes: {e}")
+    await feedback_buffer.start()
+    indexing = asyncio.create_task(refresh_scan_index())
+    snapshots = None
+    if METRICS_DIR:
+        snapshots = asyncio.create_task(metrics.write_snapshots(METRICS_SNAPSHOT_SECONDS))
+    yield
+    loading.cancel()
+    indexing.cancel()
+    if snapshots is not None:
+        snapshots.cancel()
+    await feedback_buffer.stop()
+    await registry.close()
+    preprocess_pool.shutdown(wait=False)
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(
+    MetricsMiddleware, registry=metrics, slow_request_seconds=SLOW_REQUEST_MS / 1000
+)
+
+
+def check_model_ready():
+    if registry.current is None:
+        raise HTTPException(
+            status_code=503, detail=f"Model not ready ({model_state['status']})."
+        )
 
-# Define function normalize :
-def normalize_image(img, target_size):
-    # Convertir en niveaux de gris si ce n'est pas déjà le cas
-    if len(img.shape) == 3:
-        gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
-        # Appliquer un filtre pour supprimer le bruit (par exemple, un filtre gaussien)
-        denoised_img = cv2.GaussianBlur(gray_img, (5, 5), 0)
-    else:
-        # Appliquer un filtre pour supprimer le bruit (par exemple, un filtre gaussien)
-        denoised_img = cv2.GaussianBlur(img, (5, 5), 0)
+# Settings for /predict/batch
+if "OPENCV_THREADS" in os.environ:
+    cv2.setNumThreads(int(os.environ["OPENCV_THREADS"]))
+PREDICT_CHUNK_SIZE = int(os.environ.get("PREDICT_CHUNK_SIZE", 64))
+PREPROCESS_THREADS = int(os.environ.get("PREPROCESS_THREADS", os.cpu_count() or 4))
+preprocess_pool = ThreadPoolExecutor(PREPROCESS_THREADS, thread_name_prefix="preprocess")
 
-    # Détecter les contours pour trouver le crop optimal
-    _, thresh = cv2.threshold(denoised_img, 30, 255, cv2.THRESH_BINARY)
-    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+# Load model save like a keras 
 
-    if contours:
-        # Trouver le contour avec la plus grande aire
-        max_contour = max(contours, key=cv2.contourArea)
+# from keras import load_model
+# model=load_model("tumor_detection_model/brain_tumor_detector")
 
-        # Obtenir les coordonnées du rectangle englobant
-        x, y, w, h = cv2.boundingRect(max_contour)
 
-        # Cropper l'image pour obtenir la région d'intérêt
-        cropped_img = img[y : y + h, x : x + w]
+def format_prediction(prediction, current_date, version):
+    # prediction is the model output for one image
+    return {
+        "AI_predict": "yes" if prediction[0] > 0.5 else "no",
+        "confidence": float(prediction[0]),
+        "prediction_date": current_date,
+        "model_version": version,
+    }
 
-        # Redimensionner à target_size (pour s'assurer que toutes les images ont la même taille)
-        normalized_image = cv2.resize(
-            cropped_img, target_size, interpolation=cv2.INTER_AREA
-        )
-    else:
-        # Redimensionner à target_size si aucun contour n'est détecté
-        normalized_image = cv2.resize(img, target_size, interpolation=cv2.INTER_AREA)
 
-    return normalized_image
+def prediction_fields(result):
+    # Fields stored in scanner.prediction, in the format displayed by the UI
+    is_tumor = result["AI_predict"] == "yes"
+    return {
+        "AI_predict": "Tumor" if is_tumor else "No tumor",
+        "confidence": (result["confidence"] if is_tumor else 1 - result["confidence"]) * 100,
+        "raw_confidence": result["confidence"],
+        "prediction_date": result["prediction_date"],
+        "model_version": result["model_version"],
+    }
 
 
-# Connect to MongoDB
-client = MongoClient(MONGO_URI)
+async def prepare_scan(scanner, version):
+    """
+    Returns (scan hash, cached prediction, model input).
+
+    The cache is checked first, then the ROI stored at ingest. The scan itself is only
+    read and preprocessed when neither is available.
+    """
+    scan_hash = scanner.get("scan_id")
+    if scan_hash:
+        with stage("cache_lookup"):
+            prediction = await prediction_cache.get(scan_hash, version)
+        if prediction is not None:
+            return scan_hash, prediction, None
+        with stage("read_roi"):
+            roi = await get_roi_async(db, scan_hash, PREPROCESSING_VERSION)
+        if roi is not None:
+            if REUSE_DUPLICATE_PREDICTIONS:
+                prediction = await duplicate_prediction(scan_hash, roi, version)
+                if prediction is not None:
+                    return scan_hash, prediction, None
+            return scan_hash, None, roi
+
+    # Stream the scan from the scan store into a buffer
+    with stage("read_scan"):
+        image_data = await read_scan_buffer_async(db, scanner)
+    if image_data is None:
+        return scan_hash, None, None
+
+    if not scan_hash:
+        # Scan not migrated to the scan store yet: hash its content
+        scan_hash = hashlib.sha256(image_data).hexdigest()
+        with stage("cache_lookup"):
+            prediction = await prediction_cache.get(scan_hash, version)
+        if prediction is not None:
+            return scan_hash, prediction, None
+
+    image_ready, _ = await normalize_async(image_data)
+    return scan_hash, None, image_ready
+
+
+async def duplicate_prediction(scan_hash, roi, version):
+    # Output computed for another scan file with exactly the same ROI, so the same model
+    # input (e.g. the same image saved again with other metadata). An equal perceptual
+    # hash is not enough: different images often share one.
+    with stage("duplicate_lookup"):
+        duplicates = set(await find_same_roi_async(db, PREPROCESSING_VERSION, roi))
+        duplicates.discard(scan_hash)
+        if not duplicates:
+            return None
+        prediction = await prediction_cache.get_duplicate(sorted(duplicates), version)
+    if prediction is not None:
+        await prediction_cache.put(scan_hash, prediction, version)
+    return prediction
+
+
+async def normalize_async(image_data):
+    # Decode and normalize off the event loop. The thread runs in a copy of the context,
+    # so the decode and normalize stages are timed for the current request.
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        preprocess_pool, context.run, decode_and_normalize, image_data
+    )
+
+
+# Connect to MongoDB with the async driver
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+client = AsyncIOMotorClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE)
 db = client["braintumor"]
 
+# Cache of the model outputs by (scan hash, model version)
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", 10000))
+PREDICTION_CACHE_PERSISTENT = os.environ.get("PREDICTION_CACHE_PERSISTENT", "0") == "1"
+prediction_cache = PredictionCache(
+    None,
+    PREDICTION_CACHE_SIZE,
+    db.prediction_cache if PREDICTION_CACHE_PERSISTENT else None,
+)
+
+# Perceptual hashes of the ingested scans, to flag duplicates and near-duplicates.
+# Each process keeps its own index, loaded from MongoDB at startup and refreshed with the
+# hashes written by the other processes every SCAN_INDEX_REFRESH_SECONDS.
+# Distance 0 by default: on the benchmark scans, 2 bits already flag 3.6 other scans per
+# scan on average (see `python -m common.scan_similarity --calibrate` and the README).
+NEAR_DUPLICATE_DISTANCE = int(os.environ.get("NEAR_DUPLICATE_DISTANCE", 0))
+MAX_DUPLICATES = int(os.environ.get("MAX_DUPLICATES", 20))
+SCAN_INDEX_REFRESH_SECONDS = float(os.environ.get("SCAN_INDEX_REFRESH_SECONDS", 30))
+# Reuse the prediction of a scan with a byte-identical ROI instead of running the model
+REUSE_DUPLICATE_PREDICTIONS = os.environ.get("REUSE_DUPLICATE_PREDICTIONS", "1") == "1"
+scan_index = PerceptualHashIndex()
+
+
+async def refresh_scan_index():
+    try:
+        await ensure_phash_indexes(db)
+    except PyMongoError as e:
+        print(f"Could not create the perceptual hash indexes: {e}")
+    while True:
+        try:
+            start = time.perf_counter()
+            first_load = not scan_index.ready
+            count = await scan_index.load_async(db, PREPROCESSING_VERSION)
+            if first_load:
+                print(
+                    f"Perceptual hash index: {count} scans loaded "
+                    f"in {time.perf_counter() - start:.1f} s"
+                )
+        except PyMongoError as e:
+            print(f"Could not load the perceptual hashes: {e}")
+        await asyncio.sleep(SCAN_INDEX_REFRESH_SECONDS)
+
+
+# Expert feedback, written in bulk every FEEDBACK_BATCH_SIZE documents or FEEDBACK_FLUSH_SECONDS
+FEEDBACK_BATCH_SIZE = int(os.environ.get("FEEDBACK_BATCH_SIZE", 100))
+FEEDBACK_FLUSH_SECONDS = float(os.environ.get("FEEDBACK_FLUSH_SECONDS", 2.0))
+feedback_buffer = FeedbackBuffer(
+    db[FEEDBACK_COLLECTION], FEEDBACK_BATCH_SIZE, FEEDBACK_FLUSH_SECONDS
+)
+
 
 @app.post("/predict/")
 async def predict(patient_id: str):
+    check_model_ready()
 
     # Retrieve patient data from MongoDB
-    patient_data = db.patients.find_one({"_id": ObjectId(patient_id)})
+    with stage("find_patient"):
+        patient_data = await db.patients.find_one({"_id": ObjectId(patient_id)})
     if patient_data is None:
         raise HTTPException(status_code=404, detail="Patient not found.")
-    scanner = patient_data.get("scanner")
+    scanner = patient_data.get("scanner") or {}
 
-    # Retrieve scanner_img from patient data
-    scanner_img = scanner.get("scanner_img")
-    if scanner_img is None:
+    # Check that the patient has a scan
+    if not has_scan(scanner):
         raise HTTPException(
             status_code=400, detail="No scanner image found for the patient."
         )
 
-    # Decode the base64 encoded image data
-    image_data = base64.b64decode(scanner_img)
+    # The request runs on the model current at its start, even if it is swapped meanwhile
+    async with registry.acquire() as served:
+        # Answer from the cache when this scan was already predicted by this model,
+        # otherwise get the normalized image (precomputed at ingest when available)
+        scan_hash, prediction, image_ready = await prepare_scan(scanner, served.version)
+        if prediction is None:
+            if image_ready is None:
+                raise HTTPException(
+                    status_code=400, detail="Scanner image could not be read or decoded."
+                )
+
+            # Make a prediction, batched with the other requests in flight
+            with stage("inference"):
+                prediction = await served.batcher.predict(
+                    np.asarray(image_ready).reshape(224, 224, 3)
+                )
+            await prediction_cache.put(scan_hash, prediction, served.version)
+
+    # Get the current date and time
+    current_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    # Return the prediction result
+    return format_prediction(prediction, current_date, served.version)
+
+
+class BatchPredictRequest(BaseModel):
+    patient_ids: List[str]
+
+
+@app.post("/predict/batch")
+async def predict_batch(request: BatchPredictRequest):
+    check_model_ready()
+    try:
+        ids = [ObjectId(patient_id) for patient_id in request.patient_ids]
+    except (InvalidId, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid patient ID format.")
+
+    # Retrieve all the scans with a single query
+    with stage("find_patients"):
+        patients = await db.patients.find(
+            {"_id": {"$in": ids}},
+            {"scanner.scan_id": 1, "scanner.scanner_img": 1, "scanner.prediction": 1},
+        ).to_list(None)
+    found = {patient["_id"] for patient in patients}
+    not_found = [str(patient_id) for patient_id in ids if patient_id not in found]
+
+    no_image = []
+    to_process = []
+    for patient in patients:
+        scanner = patient.get("scanner") or {}
+        if not has_scan(scanner):
+            no_image.append(str(patient["_id"]))
+        else:
+            to_process.append(patient)
+
+    async with registry.acquire() as served:
+        # Look up the cache and the stored ROIs, then load and normalize the other scans in parallel
+        prepared = await asyncio.gather(
+            *[prepare_scan(patient["scanner"], served.version) for patient in to_process]
+        )
+        current_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        results = []
+        ready = []
+        failed = []
+        for patient, (scan_hash, prediction, image_ready) in zip(to_process, prepared):
+            if prediction is not None:
+                results.append(
+                    (patient, format_prediction(prediction, current_date, served.version))
+                )
+            elif image_ready is not None:
+                ready.append((patient, scan_hash, image_ready))
+            else:
+                failed.append(str(patient["_id"]))
+
+        # Run the model on vectorized chunks
+        for start in range(0, len(ready), PREDICT_CHUNK_SIZE):
+            chunk = ready[start : start + PREDICT_CHUNK_SIZE]
+            with stage("inference"):
+                predictions = await served.batcher.run_batch(
+                    np.stack([image for _, _, image in chunk])
+                )
+            for (patient, scan_hash, _), prediction in zip(chunk, predictions):
+                await prediction_cache.put(scan_hash, prediction, served.version)
+                results.append(
+                    (patient, format_prediction(prediction, current_date, served.version))
+                )
+
+    # Write all the predictions back in one round trip
+    operations = []
+    for patient, result in results:
+        fields = prediction_fields(result)
+        previous = patient["scanner"].get("prediction")
+        if isinstance(previous, dict):
+            update = {f"scanner.prediction.{key}": value for key, value in fields.items()}
+        else:
+            update = {"scanner.prediction": fields}
+        operations.append(UpdateOne({"_id": patient["_id"]}, {"$set": update}))
+    if operations:
+        with stage("write_predictions"):
+            await db.patients.bulk_write(operations, ordered=False)
+
+    return {
+        "predictions": [
+            {"patient_id": str(patient["_id"]), **result} for patient, result in results
+        ],
+        "not_found": not_found,
+        "no_image": no_image,
+        "failed": failed,
+    }
+
+@app.post("/ingest/")
+async def ingest(patient_id: str):
+    """
+    Precompute and store the normalized ROI and the thumbnail of the patient's scan,
+    so that /predict/ does not have to decode and preprocess it, and the pages do not
+    have to load the full image. Then flag the other patients with the same scan, or a
+    near-duplicate one.
+    """
+    patient_data = await db.patients.find_one(
+        {"_id": ObjectId(patient_id)}, {"scanner.scan_id": 1, "scanner.scanner_img": 1}
+    )
+    if patient_data is None:
+        raise HTTPException(status_code=404, detail="Patient not found.")
+    scanner = patient_data.get("scanner") or {}
+    if not scanner.get("scan_id"):
+        raise HTTPException(
+            status_code=400, detail="No scanner image in the scan store for the patient."
+        )
 
-    # Convert the bytes to an image
-    image_data = np.frombuffer(image_data, np.uint8)
-    decoded_image = cv2.imdecode(image_data, cv2.IMREAD_COLOR)
+    scan_id = scanner["scan_id"]
+    roi = await get_roi_async(db, scan_id, PREPROCESSING_VERSION)
+    roi_missing = roi is None
+    thumbnail_missing = await get_thumbnail_async(db, scan_id) is None
+    result = {
+        "scan_id": scan_id,
+        "preprocessing_version": PREPROCESSING_VERSION,
+        "created": roi_missing,
+        "thumbnail_created": thumbnail_missing,
+    }
 
-    # Normalize the image
-    image_ready = normalize_image(decoded_image, (224, 224))
+    if roi_missing or thumbnail_missing:
+        image_data = await read_scan_buffer_async(db, scanner)
+        if image_data is None:
+            raise HTTPException(status_code=400, detail="Scanner image could not be read.")
+
+        if roi_missing:
+            roi, box = await normalize_async(image_data)
+            if roi is None:
+                raise HTTPException(
+                    status_code=400, detail="Scanner image could not be decoded."
+                )
+            await put_roi_async(db, scan_id, PREPROCESSING_VERSION, roi, box, PREPROCESSING_PARAMS)
+
+        if thumbnail_missing:
+            loop = asyncio.get_running_loop()
+            thumbnail = await loop.run_in_executor(preprocess_pool, make_thumbnail, image_data)
+            if thumbnail is None:
+                raise HTTPException(
+                    status_code=400, detail="Scanner image could not be decoded."
+                )
+            await put_thumbnail_async(db, scan_id, thumbnail)
+
+    result["duplicates"] = await flag_duplicates(patient_data["_id"], scan_id, roi)
+    return result
+
+
+async def flag_duplicates(patient_id, scan_id, roi):
+    """
+    Stores in scanner.duplicates the other patients whose scan is the same or has a
+    perceptual hash within NEAR_DUPLICATE_DISTANCE bits, closest first.
+    """
+    phash = scan_index.hash_of(scan_id)
+    if phash is None:
+        loop = asyncio.get_running_loop()
+        document = await loop.run_in_executor(
+            preprocess_pool, phash_document, scan_id, PREPROCESSING_VERSION, roi
+        )
+        await put_phash_async(db, document)
+        phash = int(document["phash"], 16)
+        scan_index.add(scan_id, phash)
+        # Exact duplicates ingested by another process since its last index refresh
+        for other in await find_exact_async(db, PREPROCESSING_VERSION, phash):
+            scan_index.add(other, phash)
+
+    with stage("duplicate_search"):
+        distances = dict(scan_index.search(phash, NEAR_DUPLICATE_DISTANCE, MAX_DUPLICATES))
+    distances[scan_id] = 0
+    patients = await db.patients.find(
+        {"scanner.scan_id": {"$in": list(distances)}, "_id": {"$ne": patient_id}},
+        {"scanner.scan_id": 1},
+    ).limit(MAX_DUPLICATES).to_list(None)
+    duplicates = sorted(
+        (
+            {
+                "patient_id": str(patient["_id"]),
+                "scan_id": patient["scanner"]["scan_id"],
+                "distance": distances[patient["scanner"]["scan_id"]],
+            }
+            for patient in patients
+        ),
+        key=lambda duplicate: (duplicate["distance"], duplicate["patient_id"]),
+    )
+
+    # Only if the scan was not replaced in the meantime
+    await db.patients.update_one(
+        {"_id": patient_id, "scanner.scan_id": scan_id},
+        {"$set": {"scanner.duplicates": duplicates}},
+    )
+    return duplicates
+
+
+@app.get("/ready")
+async def ready():
+    # Readiness probe: passes once the model is loaded and warmed up
+    current = registry.current
+    content = {
+        "model_version": current.version if current else None,
+        "backend": current.backend if current else MODEL_BACKEND,
+        **model_state,
+    }
+    if model_state["status"] != "ready":
+        return JSONResponse(status_code=503, content=content)
+    return content
 
-    # Convert the image to a list of images (batch of 1)
-    image_ready = np.array(image_ready).reshape(1, 224, 224, 3)
 
-    # Make a prediction
-    prediction = model.predict(image_ready)
+@app.get("/model/info")
+async def model_info():
+    check_model_ready()
+    current = registry.current
+    # Parity of an optimized backend with the original model, when it was checked
+    parity_report = getattr(current.model, "parity_report", None)
+    return {
+        **current.info(),
+        "parity": parity_report() if parity_report else None,
+        "draining": [served.info() for served in registry.draining],
+    }
 
-    # Format the prediction
-    pred_label = "yes" if prediction[0][0] > 0.5 else "no"
-    confidence = float(prediction[0][0])
 
-    # Get the current date and time
-    current_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+class DeployRequest(BaseModel):
+    model_uri: str
+    backend: Optional[str] = None
+
+
+@app.post("/admin/model")
+async def deploy_model(request: DeployRequest, x_admin_token: Optional[str] = Header(None)):
+    """
+    Loads and warms up a new model next to the current one, then swaps it in. The requests
+    in flight finish on the previous model, which is released once they are done. The
+    other API processes pick up the deployment within MODEL_POLL_SECONDS.
+    """
+    if ADMIN_TOKEN and x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid admin token.")
+    backend = request.backend or MODEL_BACKEND
+    if backend not in BACKENDS:
+        raise HTTPException(status_code=400, detail=f"Unknown backend, expected one of {BACKENDS}.")
+    if registry.swap_lock.locked():
+        raise HTTPException(status_code=409, detail="A model is already being loaded.")
+
+    async with registry.swap_lock:
+        start = time.perf_counter()
+        try:
+            served, previous = await deploy(request.model_uri, backend)
+        except Exception as e:
+            raise HTTPException(
+                status_code=400, detail=f"Model could not be loaded: {e!r}"
+            )
+        await set_deployment(db, served)
 
-    # Return the prediction result
     return {
-        "AI_predict": pred_label,
-        "confidence": confidence,
-        "prediction_date": current_date,
+        "model_version": served.version,
+        "previous_version": previous.version if previous else None,
+        "load_seconds": time.perf_counter() - start,
     }
 
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return prediction_cache.stats()
+
+
+# Values read from the serving state when /metrics is scraped
+metrics.gauge(
+    "batch_queue_depth", "Requests waiting for the next model batch.",
+    function=lambda: registry.current.batcher.queue_size() if registry.current else 0,
+)
+metrics.counter(
+    "prediction_cache_lookups_total", "Prediction cache lookups by result.", ("result",),
+    function=lambda: {
+        ("hit",): prediction_cache.hits,
+        ("persistent_hit",): prediction_cache.persistent_hits,
+        ("miss",): prediction_cache.misses,
+        ("duplicate_hit",): prediction_cache.duplicate_hits,
+    },
+)
+# Each worker holds the whole index: report the largest one, not the sum over the workers
+metrics.gauge(
+    "scan_index_size", "Scans in the perceptual hash index.",
+    function=lambda: len(scan_index), merge="max",
+)
+metrics.gauge(
+    "feedback_pending", "Feedback waiting to be written to MongoDB.",
+    function=lambda: feedback_buffer.stats()["pending"],
+)
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    # Prometheus text format, summed over the processes sharing METRICS_DIR
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+
 class Feedback(BaseModel):
     patient_id: Optional[str] = None
     # scanner: Optional[str] = None
     prediction: Optional[str] = None
     expert_opinion: Optional[str] = None
+    comment: Optional[str] = None
 
-@app.post("/feedback/")
-def feedback(feedback_data: Feedback):
-    print('\n')
-    for key, value in feedback_data.dict().items():
-        if value is None:
+@app.post("/feedback/", status_code=202)
+async def feedback(feedback_data: Feedback):
+    for key in ("patient_id", "prediction", "expert_opinion"):
+        if getattr(feedback_data, key) is None:
             raise HTTPException(
                 status_code=400, detail=f"Missing value for {key}."
             )
-        else :
-            print(f"{key} : {value}")
-    print('\n')
 
+    # Attach the scan and the model version the expert reviewed
+    try:
+        patient = await db.patients.find_one(
+            {"_id": ObjectId(feedback_data.patient_id)},
+            {"scanner.scan_id": 1, "scanner.prediction": 1},
+        )
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid patient_id.")
+    if patient is None:
+        raise HTTPException(status_code=404, detail="Patient not found.")
+
+    # Buffered: written to MongoDB with the next batch
+    feedback_buffer.add(
+        feedback_document(
+            feedback_data.patient_id,
+            patient.get("scanner") or {},
+            feedback_data.prediction,
+            feedback_data.expert_opinion,
+            feedback_data.comment,
+        )
+    )
+    return {"status": "accepted"}
+
+
+@app.get("/feedback/stats")
+async def feedback_stats():
+    return feedback_buffer.stats()
 
 
 # Run the API with uvicorn
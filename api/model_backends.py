@@ -0,0 +1,560 @@
+"""
+Inference backends for the model API, selected with the MODEL_BACKEND environment variable:
+
+- "mlflow" (default): the model as logged in MLflow (mlflow.pyfunc)
+- "onnx": the model converted to ONNX and run with ONNX Runtime
+- "onnx-int8": ONNX with int8 dynamic quantization of the weights
+- "onnx-int8-static": ONNX with int8 static quantization (weights and activations),
+  calibrated on stored scans. It must be built beforehand with this script.
+- "stub": a deterministic stand-in that needs neither MLflow nor the weights, for the
+  benchmarks (benchmarks/load_test.py)
+
+The MLflow artifacts and the converted models are cached on local disk (MODEL_CACHE_DIR),
+one directory per run, so a restart does not download the model again and does not need
+the tracking server.
+
+With ONNX_SHARED_WEIGHTS=1 (set by serve.py when it runs several workers), the ONNX
+backends load a copy of the model whose weights are in a separate file (ONNX external
+data). ONNX Runtime maps that file into memory instead of copying it, so all the
+processes that load the model share the same pages.
+
+Usage (from the api directory), to build a backend and check its accuracy parity
+against the original model on stored scans:
+    python model_backends.py --backend onnx-int8-static --calibration 200 --samples 500
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BACKENDS = ("mlflow", "onnx", "onnx-int8", "onnx-int8-static", "stub")
+MODEL_CACHE_DIR = os.environ.get(
+    "MODEL_CACHE_DIR", os.path.expanduser("~/.cache/braintumor/models")
+)
+# "sha256": check the hash of every cached file at load, "size": only check the sizes
+MODEL_CACHE_VERIFY = os.environ.get("MODEL_CACHE_VERIFY", "sha256")
+# Share the weights of the ONNX backends between processes (see shared_weights_path)
+ONNX_SHARED_WEIGHTS = os.environ.get("ONNX_SHARED_WEIGHTS", "0") == "1"
+INPUT_SHAPE = (224, 224, 3)
+ONNX_OPSET = 13
+
+
+def model_run_id(model_uri):
+    # The run ID identifies the weights, whatever URI is used to load them
+    match = re.match(r"runs:/([^/]+)/", model_uri)
+    if match:
+        return match.group(1)
+    try:
+        import mlflow
+
+        return mlflow.models.get_model_info(model_uri).run_id or None
+    except Exception:
+        return None
+
+
+def _write_json(path, data):
+    # Write then rename, so that a partial file is never read
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def model_cache_dir(model_uri):
+    """
+    Cache directory of a model URI, named after its run ID.
+
+    URIs that need the tracking server to be resolved (models:/name/stage) are recorded
+    in an index, so that the last resolved run is used when the server is unreachable.
+    """
+    index_path = os.path.join(MODEL_CACHE_DIR, "uris.json")
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        index = {}
+
+    key = model_run_id(model_uri)
+    if key is None:
+        key = index.get(model_uri) or hashlib.sha1(model_uri.encode()).hexdigest()
+    elif index.get(model_uri) != key:
+        os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+        _write_json(index_path, dict(index, **{model_uri: key}))
+    return os.path.join(MODEL_CACHE_DIR, key)
+
+
+def _sha256_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _list_files(root):
+    files = {}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            relative = os.path.relpath(path, root)
+            if relative != "manifest.json":
+                files[relative] = {"size": os.path.getsize(path), "sha256": _sha256_file(path)}
+    return files
+
+
+def verify_artifacts(directory, manifest, full=True):
+    """
+    Returns True if the cached files match the manifest written when they were downloaded.
+    """
+    for relative, expected in manifest["files"].items():
+        path = os.path.join(directory, relative)
+        if not os.path.isfile(path) or os.path.getsize(path) != expected["size"]:
+            return False
+        if full and _sha256_file(path) != expected["sha256"]:
+            return False
+    return True
+
+
+def _cached_model_path(directory):
+    try:
+        with open(os.path.join(directory, "manifest.json")) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if not verify_artifacts(directory, manifest, full=MODEL_CACHE_VERIFY == "sha256"):
+        return None
+    return os.path.join(directory, manifest["model_path"])
+
+
+def fetch_model(model_uri):
+    """
+    Returns the local path of the MLflow model, downloading it into the cache if it is
+    missing or does not match its manifest.
+    """
+    cache_dir = model_cache_dir(model_uri)
+    directory = os.path.join(cache_dir, "mlflow")
+    if os.path.isdir(directory):
+        path = _cached_model_path(directory)
+        if path is not None:
+            return path
+        print(f"Cached model in {directory} is incomplete or corrupted, downloading it again")
+        shutil.rmtree(directory, ignore_errors=True)
+
+    import mlflow
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".download-", dir=cache_dir)
+    try:
+        path = mlflow.artifacts.download_artifacts(artifact_uri=model_uri, dst_path=tmp_dir)
+        manifest = {
+            "model_uri": model_uri,
+            "model_path": os.path.relpath(path, tmp_dir),
+            "files": _list_files(tmp_dir),
+            "downloaded_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        _write_json(os.path.join(tmp_dir, "manifest.json"), manifest)
+        # The rename publishes the complete directory at once
+        os.rename(tmp_dir, directory)
+    except OSError:
+        # Another process has published the same model in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        path = _cached_model_path(directory)
+        if path is None:
+            raise
+        return path
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return os.path.join(directory, manifest["model_path"])
+
+
+def artifact_path(model_uri, backend):
+    names = {
+        "onnx": "model.onnx",
+        "onnx-int8": "model.int8-dynamic.onnx",
+        "onnx-int8-static": "model.int8-static.onnx",
+    }
+    return os.path.join(model_cache_dir(model_uri), names[backend])
+
+
+def parity_report_path(path):
+    return path + ".parity.json"
+
+
+def export_onnx(model_uri, path):
+    """
+    Converts the Keras model logged in MLflow to ONNX.
+    """
+    import mlflow
+    import tensorflow as tf
+    import tf2onnx
+
+    keras_model = mlflow.tensorflow.load_model(fetch_model(model_uri))
+    signature = (tf.TensorSpec((None,) + INPUT_SHAPE, tf.float32, name="input"),)
+    tmp_path = path + ".tmp"
+    tf2onnx.convert.from_keras(
+        keras_model, input_signature=signature, opset=ONNX_OPSET, output_path=tmp_path
+    )
+    # Write then rename, so that a partial file is never used
+    os.replace(tmp_path, path)
+
+
+class CalibrationReader:
+    """
+    Feeds calibration images to onnxruntime.quantization.quantize_static.
+    """
+
+    def __init__(self, images, input_name, batch_size=16):
+        self.batches = iter(
+            [
+                {input_name: np.asarray(images[i : i + batch_size], dtype=np.float32)}
+                for i in range(0, len(images), batch_size)
+            ]
+        )
+
+    def get_next(self):
+        return next(self.batches, None)
+
+
+def quantize(onnx_path, path, calibration_images=None):
+    """
+    int8 quantization: dynamic (weights only) when no calibration images are given,
+    static (weights and activations) otherwise.
+    """
+    from onnxruntime.quantization import (
+        CalibrationMethod,
+        QuantFormat,
+        QuantType,
+        quantize_dynamic,
+        quantize_static,
+    )
+
+    tmp_path = path + ".tmp"
+    if calibration_images is None:
+        quantize_dynamic(onnx_path, tmp_path, weight_type=QuantType.QInt8)
+    else:
+        import onnxruntime as ort
+
+        input_name = ort.InferenceSession(
+            onnx_path, providers=["CPUExecutionProvider"]
+        ).get_inputs()[0].name
+        quantize_static(
+            onnx_path,
+            tmp_path,
+            CalibrationReader(calibration_images, input_name),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QInt8,
+            weight_type=QuantType.QInt8,
+            calibrate_method=CalibrationMethod.MinMax,
+        )
+    os.replace(tmp_path, path)
+
+
+def shared_weights_path(path):
+    """
+    Returns the path of a copy of the ONNX model with its weights in a separate file
+    (external data), writing it if it is not cached yet.
+
+    ONNX Runtime maps external data into memory instead of reading it, so the weights
+    are pages of the page cache, shared by every process that loads the model.
+    """
+    shared_path = path[: -len(".onnx")] + ".shared.onnx"
+    if os.path.exists(shared_path):
+        return shared_path
+
+    import onnx
+
+    directory = os.path.dirname(path)
+    data_name = os.path.basename(shared_path) + ".data"
+    tmp_dir = tempfile.mkdtemp(prefix=".shared-", dir=directory)
+    try:
+        onnx.save_model(
+            onnx.load(path),
+            os.path.join(tmp_dir, os.path.basename(shared_path)),
+            save_as_external_data=True,
+            location=data_name,
+        )
+        # The weights are published first: the model file is only there once they are
+        os.replace(os.path.join(tmp_dir, data_name), os.path.join(directory, data_name))
+        os.replace(os.path.join(tmp_dir, os.path.basename(shared_path)), shared_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return shared_path
+
+
+def build_artifact(model_uri, backend, calibration_images=None):
+    """
+    Returns the path of the converted model, converting it if it is not cached yet.
+    """
+    path = artifact_path(model_uri, backend)
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    onnx_path = artifact_path(model_uri, "onnx")
+    if not os.path.exists(onnx_path):
+        export_onnx(model_uri, onnx_path)
+    if backend == "onnx-int8":
+        quantize(onnx_path, path)
+    elif backend == "onnx-int8-static":
+        if calibration_images is None:
+            raise RuntimeError(
+                "The onnx-int8-static model needs calibration scans: build it first with "
+                "`python model_backends.py --backend onnx-int8-static`"
+            )
+        quantize(onnx_path, path, calibration_images)
+    return path
+
+
+class OnnxModel:
+    """
+    ONNX Runtime model with the predict interface of the MLflow pyfunc model.
+
+    The session is created in the process that runs the first prediction. A session
+    is not fork-safe (its thread pool does not survive a fork), so a process that was
+    forked after it was created builds its own.
+
+    With shared_path (see shared_weights_path), the session is loaded from the copy
+    whose weights are mapped from disk, and the weights are not prepacked: prepacking
+    makes a private, reordered copy of them in each process.
+    """
+
+    def __init__(self, path, run_id=None, backend="onnx", shared_path=None):
+        self.path = path
+        self.shared_path = shared_path
+        self.run_id = run_id
+        self.backend = backend
+        self.intra_op_threads = int(os.environ.get("INTRA_OP_THREADS", 0))
+        self._session = None
+        self._pid = None
+
+    def _get_session(self):
+        if self._session is None or self._pid != os.getpid():
+            import onnxruntime as ort
+
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if self.intra_op_threads:
+                options.intra_op_num_threads = self.intra_op_threads
+            options.inter_op_num_threads = 1
+            if self.shared_path:
+                options.add_session_config_entry("session.disable_prepacking", "1")
+            self._session = ort.InferenceSession(
+                self.shared_path or self.path, options, providers=["CPUExecutionProvider"]
+            )
+            self._input_name = self._session.get_inputs()[0].name
+            self._pid = os.getpid()
+        return self._session
+
+    def predict(self, images):
+        session = self._get_session()
+        batch = np.asarray(images, dtype=np.float32)
+        return session.run(None, {self._input_name: batch})[0]
+
+    def parity_report(self):
+        try:
+            with open(parity_report_path(self.path)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+
+class StubModel:
+    """
+    Deterministic stand-in for the model: the output of an image only depends on its
+    mean intensity. The compute time of a real model is simulated with a fixed delay
+    per batch (STUB_BATCH_MS) plus a delay per image (STUB_IMAGE_MS).
+    """
+
+    run_id = None
+    backend = "stub"
+
+    def __init__(self, batch_ms=None, image_ms=None):
+        self.batch_ms = float(os.environ.get("STUB_BATCH_MS", 0) if batch_ms is None else batch_ms)
+        self.image_ms = float(os.environ.get("STUB_IMAGE_MS", 0) if image_ms is None else image_ms)
+
+    def predict(self, images):
+        batch = np.asarray(images, dtype=np.float32)
+        delay_ms = self.batch_ms + self.image_ms * len(batch)
+        if delay_ms:
+            time.sleep(delay_ms / 1000)
+        mean = batch.reshape(len(batch), -1).mean(axis=1) / 255
+        return (1 / (1 + np.exp(-12 * (mean - 0.25)))).reshape(-1, 1)
+
+    def parity_report(self):
+        return None
+
+
+def prepare_model(model_uri, backend="mlflow"):
+    """
+    Downloads (and converts) the model into the local cache, without loading it.
+
+    Returns:
+    - str, local path of the model, or None for the stub backend
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown MODEL_BACKEND {backend!r}, expected one of {BACKENDS}")
+    if backend == "stub":
+        return None
+    if backend == "mlflow":
+        return fetch_model(model_uri)
+    path = build_artifact(model_uri, backend)
+    if ONNX_SHARED_WEIGHTS:
+        shared_weights_path(path)
+    return path
+
+
+def load_model(model_uri, backend="mlflow"):
+    """
+    Returns a model with a predict(images) method, for the requested backend.
+    """
+    path = prepare_model(model_uri, backend)
+    if backend == "stub":
+        return StubModel()
+    if backend == "mlflow":
+        import mlflow
+
+        return mlflow.pyfunc.load_model(path)
+    shared_path = shared_weights_path(path) if ONNX_SHARED_WEIGHTS else None
+    return OnnxModel(path, model_run_id(model_uri), backend, shared_path)
+
+
+def model_version(model, model_uri, backend="mlflow"):
+    # Outputs differ between backends, so each backend has its own version
+    run_id = getattr(model, "run_id", None) or getattr(
+        getattr(model, "metadata", None), "run_id", None
+    )
+    version = run_id or model_uri
+    return version if backend == "mlflow" else f"{version}+{backend}"
+
+
+def predict_in_batches(model, images, batch_size=32):
+    outputs = []
+    timings = []
+    for i in range(0, len(images), batch_size):
+        batch = np.asarray(images[i : i + batch_size])
+        start = time.perf_counter()
+        outputs.append(np.asarray(model.predict(batch)).reshape(len(batch), -1))
+        timings.append((time.perf_counter() - start) / len(batch))
+    return np.concatenate(outputs), timings
+
+
+def parity_report(reference, candidate, images, labels, batch_size=32):
+    """
+    Compares the candidate backend with the original model on the same images.
+
+    Args:
+    - images: list of normalized scans (224, 224, 3)
+    - labels: list of expert labels (1 = tumor, 0 = no tumor, None = not validated)
+    """
+    reference_outputs, reference_timings = predict_in_batches(reference, images, batch_size)
+    candidate_outputs, candidate_timings = predict_in_batches(candidate, images, batch_size)
+    reference_scores = reference_outputs[:, 0]
+    candidate_scores = candidate_outputs[:, 0]
+    difference = np.abs(reference_scores - candidate_scores)
+
+    report = {
+        "samples": len(images),
+        "class_agreement": float(np.mean((reference_scores > 0.5) == (candidate_scores > 0.5))),
+        "max_abs_diff": float(difference.max()),
+        "mean_abs_diff": float(difference.mean()),
+        "reference_ms_per_image": 1000 * float(np.median(reference_timings)),
+        "candidate_ms_per_image": 1000 * float(np.median(candidate_timings)),
+    }
+    report["speedup"] = report["reference_ms_per_image"] / report["candidate_ms_per_image"]
+
+    labelled = [i for i, label in enumerate(labels) if label is not None]
+    if labelled:
+        truth = np.array([labels[i] for i in labelled])
+        report["labelled_samples"] = len(labelled)
+        report["reference_accuracy"] = float(np.mean((reference_scores[labelled] > 0.5) == truth))
+        report["candidate_accuracy"] = float(np.mean((candidate_scores[labelled] > 0.5) == truth))
+    return report
+
+
+def sample_scans(db, limit, skip=0):
+    """
+    Normalized scans stored at ingest, with the expert label when the prediction was validated.
+
+    Returns:
+    - tuple, (list of np.array, list of labels)
+    """
+    from common.scan_store import ROI_COLLECTION
+    from preprocessing import PREPROCESSING_VERSION
+
+    entries = list(
+        db[ROI_COLLECTION]
+        .find({"preprocessing_version": PREPROCESSING_VERSION}, {"scan_id": 1, "roi": 1, "shape": 1})
+        .sort("_id", 1)
+        .skip(skip)
+        .limit(limit)
+    )
+    # Expert label: the AI prediction when the expert agreed, the opposite otherwise
+    labels = {}
+    for patient in db.patients.find(
+        {
+            "scanner.scan_id": {"$in": [entry["scan_id"] for entry in entries]},
+            "scanner.prediction.predict_check": {"$in": ["Yes", "No"]},
+        },
+        {"scanner.scan_id": 1, "scanner.prediction": 1},
+    ):
+        prediction = patient["scanner"]["prediction"]
+        is_tumor = prediction["AI_predict"] == "Tumor"
+        labels[patient["scanner"]["scan_id"]] = int(is_tumor == (prediction["predict_check"] == "Yes"))
+
+    images = [
+        np.frombuffer(entry["roi"], dtype=np.uint8).reshape(entry["shape"]) for entry in entries
+    ]
+    return images, [labels.get(entry["scan_id"]) for entry in entries]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build an optimized backend and check its parity")
+    built_backends = [backend for backend in BACKENDS if backend not in ("mlflow", "stub")]
+    parser.add_argument("--backend", choices=built_backends, default="onnx-int8")
+    parser.add_argument("--calibration", type=int, default=200, help="scans used to calibrate static int8")
+    parser.add_argument("--samples", type=int, default=500, help="scans used for the parity check")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--rebuild", action="store_true", help="convert again even if cached")
+    args = parser.parse_args()
+
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+    import mlflow
+    from hidden import MLFLOW_RUN, MLFLOW_URI, MONGO_URI
+    from pymongo import MongoClient
+
+    mlflow.set_tracking_uri(MLFLOW_URI)
+    db = MongoClient(MONGO_URI)["braintumor"]
+
+    path = artifact_path(MLFLOW_RUN, args.backend)
+    if args.rebuild and os.path.exists(path):
+        os.remove(path)
+
+    calibration_images = None
+    if args.backend == "onnx-int8-static":
+        calibration_images, _ = sample_scans(db, args.calibration)
+        print(f"Calibration on {len(calibration_images)} scan(s)")
+    # The parity check uses other scans than the calibration
+    skip = len(calibration_images or [])
+    path = build_artifact(MLFLOW_RUN, args.backend, calibration_images)
+    print(f"Model: {path} ({os.path.getsize(path) / 1e6:.1f} MB)")
+
+    images, labels = sample_scans(db, args.samples, skip=skip)
+    if not images:
+        sys.exit("No normalized scan stored for the parity check (see POST /ingest/)")
+    reference = load_model(MLFLOW_RUN, "mlflow")
+    candidate = OnnxModel(path, model_run_id(MLFLOW_RUN), args.backend)
+    report = parity_report(reference, candidate, images, labels, args.batch_size)
+    report.update({"backend": args.backend, "model_uri": MLFLOW_RUN})
+
+    with open(parity_report_path(path), "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,116 @@
+import asyncio
+import gc
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from pymongo import MongoClient
+
+# Model deployed on every API process, changed by POST /admin/model
+DEPLOYMENTS_COLLECTION = "model_deployments"
+DEPLOYMENT_ID = "current"
+
+
+class ServedModel:
+    """
+    A loaded model with its own micro-batcher, and the number of requests using it.
+    """
+
+    def __init__(self, model, version, model_uri, backend, batcher):
+        self.model = model
+        self.version = version
+        self.model_uri = model_uri
+        self.backend = backend
+        self.batcher = batcher
+        self.in_flight = 0
+        self.loaded_at = datetime.now()
+
+    def info(self):
+        return {
+            "model_uri": self.model_uri,
+            "model_version": self.version,
+            "backend": self.backend,
+            "in_flight": self.in_flight,
+            "loaded_at": self.loaded_at.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+
+class ModelRegistry:
+    """
+    Holds the model serving new requests. A swap replaces it at once: the requests that
+    started on the previous model finish on it, then the previous model is released.
+
+    Args:
+    - drain_timeout: float, seconds to wait for the requests of a replaced model
+    """
+
+    def __init__(self, drain_timeout=300.0):
+        self.drain_timeout = drain_timeout
+        self.current = None
+        self.draining = []
+        self.swap_lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def acquire(self):
+        """
+        Pins the current model for the duration of a request.
+        """
+        served = self.current
+        served.in_flight += 1
+        try:
+            yield served
+        finally:
+            served.in_flight -= 1
+
+    async def swap(self, served):
+        # No await between the read and the write: the swap is atomic for the event loop
+        previous, self.current = self.current, served
+        if previous is not None:
+            self.draining.append(previous)
+            asyncio.create_task(self._retire(previous))
+        return previous
+
+    async def _retire(self, served):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.drain_timeout
+        while served.in_flight > 0 and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        await served.batcher.stop()
+        self.draining.remove(served)
+        served.model = None
+        gc.collect()
+        print(f"Model {served.version} released")
+
+    async def close(self):
+        for served in [self.current] + self.draining:
+            if served is not None:
+                await served.batcher.stop()
+
+
+async def get_deployment(db):
+    """
+    Returns:
+    - dict with model_uri and backend of the deployed model, or None if none was deployed
+    """
+    return await db[DEPLOYMENTS_COLLECTION].find_one({"_id": DEPLOYMENT_ID})
+
+
+def get_deployment_sync(mongo_uri):
+    # Used before the fork by serve.py, where the async client can't be used yet
+    client = MongoClient(mongo_uri, serverSelectionTimeoutMS=3000)
+    try:
+        return client["braintumor"][DEPLOYMENTS_COLLECTION].find_one({"_id": DEPLOYMENT_ID})
+    finally:
+        client.close()
+
+
+async def set_deployment(db, served):
+    await db[DEPLOYMENTS_COLLECTION].replace_one(
+        {"_id": DEPLOYMENT_ID},
+        {
+            "model_uri": served.model_uri,
+            "backend": served.backend,
+            "model_version": served.version,
+            "deployed_at": datetime.now(),
+        },
+        upsert=True,
+    )
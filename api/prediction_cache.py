@@ -0,0 +1,125 @@
+from collections import OrderedDict
+
+from pymongo import ASCENDING
+
+
+class PredictionCache:
+    """
+    Caches raw model outputs by (scan content hash, model version).
+
+    Two tiers: an in-process LRU, and an optional MongoDB collection shared by every
+    process of the API. Entries written by another model version are never returned,
+    and are removed from the collection when the API starts with a new version.
+
+    Args:
+    - model_version: str, identifier of the loaded model
+    - max_size: int, number of entries kept in the in-process LRU
+    - collection: motor collection for the persistent tier, or None
+    """
+
+    def __init__(self, model_version, max_size=10000, collection=None):
+        self.model_version = model_version
+        self.max_size = max_size
+        self.collection = collection
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.duplicate_hits = 0
+
+    def set_model_version(self, model_version):
+        # The in-process entries belong to the previous model
+        if model_version != self.model_version:
+            self.model_version = model_version
+            self._entries.clear()
+
+    async def setup(self):
+        if self.collection is None:
+            return
+        await self.collection.create_index([("model_version", ASCENDING)])
+        # Drop the entries computed by any other model version
+        await self.collection.delete_many({"model_version": {"$ne": self.model_version}})
+
+    def _key(self, scan_hash, model_version):
+        return f"{model_version}:{scan_hash}"
+
+    def _remember(self, key, prediction):
+        self._entries[key] = prediction
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get(self, scan_hash, model_version=None):
+        """
+        Args:
+        - model_version: str, version of the model serving the request (default: current)
+
+        Returns:
+        - list of floats, model output for the scan, or None on a miss
+        """
+        key = self._key(scan_hash, model_version or self.model_version)
+        prediction = self._entries.get(key)
+        if prediction is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return prediction
+
+        if self.collection is not None:
+            entry = await self.collection.find_one({"_id": key})
+            if entry is not None:
+                self._remember(key, entry["prediction"])
+                self.persistent_hits += 1
+                return entry["prediction"]
+
+        self.misses += 1
+        return None
+
+    async def get_duplicate(self, scan_hashes, model_version=None):
+        """
+        Looks up the output computed for any of scan_hashes, other scans with the same
+        normalized ROI (see common/scan_similarity.py). Not counted as a lookup: the scan's own
+        lookup already counted as a miss.
+
+        Returns:
+        - list of floats, model output of one of the scans, or None
+        """
+        model_version = model_version or self.model_version
+        keys = [self._key(scan_hash, model_version) for scan_hash in scan_hashes]
+        for key in keys:
+            prediction = self._entries.get(key)
+            if prediction is not None:
+                self.duplicate_hits += 1
+                return prediction
+
+        if self.collection is not None and keys:
+            entry = await self.collection.find_one({"_id": {"$in": keys}})
+            if entry is not None:
+                self.duplicate_hits += 1
+                return entry["prediction"]
+        return None
+
+    async def put(self, scan_hash, prediction, model_version=None):
+        model_version = model_version or self.model_version
+        key = self._key(scan_hash, model_version)
+        prediction = [float(value) for value in prediction]
+        self._remember(key, prediction)
+        if self.collection is not None:
+            await self.collection.replace_one(
+                {"_id": key},
+                {"model_version": model_version, "prediction": prediction},
+                upsert=True,
+            )
+
+    def stats(self):
+        lookups = self.hits + self.persistent_hits + self.misses
+        return {
+            "model_version": self.model_version,
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "persistent": self.collection is not None,
+            "hits": self.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "duplicate_hits": self.duplicate_hits,
+            "hit_rate": (self.hits + self.persistent_hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import cv2
+
+# The normalization is shared with the training code (tumor_detection_model/functions)
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from common.metrics import stage  # noqa: E402
+from tumor_detection_model.functions.normalize_images import (  # noqa: E402
+    normalize_image_with_box,
+    preprocessing_params,
+    preprocessing_version,
+)
+
+
+# Preprocessing parameters. The version identifies the stored ROIs computed with them.
+TARGET_SIZE = (224, 224)
+PREPROCESSING_PARAMS = preprocessing_params(TARGET_SIZE)
+PREPROCESSING_VERSION = preprocessing_version(TARGET_SIZE)
+
+
+def decode_and_normalize(image_data):
+    """
+    Returns (normalized image, crop box), or (None, None) if the image can't be decoded.
+    """
+    # Convert the bytes to an image
+    with stage("decode"):
+        decoded_image = cv2.imdecode(image_data, cv2.IMREAD_COLOR)
+    if decoded_image is None:
+        return None, None
+
+    # Normalize the image
+    with stage("normalize"):
+        return normalize_image_with_box(decoded_image, TARGET_SIZE)
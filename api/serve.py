@@ -0,0 +1,183 @@
+"""
+Pre-fork server for the model API.
+
+The master process stays light: it never imports TensorFlow, ONNX Runtime or the
+MongoDB client, which are not fork-safe. Before forking, it downloads and converts the
+deployed model into the local cache in a short-lived process, so the workers only read
+it from disk. Each worker then creates its own model session, MongoDB client, event loop,
+micro-batcher and preprocessing thread pool, on a shared listening socket.
+
+With an ONNX backend, the weights are not copied into each worker: the workers map the
+same weights file of the cache into memory (ONNX_SHARED_WEIGHTS, on by default with
+more than one worker), so memory does not grow with the weights for every worker. The
+TensorFlow model of the mlflow backend cannot be shared: each worker loads a copy.
+
+The workers write their metrics to METRICS_DIR (a temporary directory unless set), so
+that GET /metrics on any worker returns the totals of all of them.
+
+Usage (from the api directory):
+    python serve.py --workers 4 --intra-op-threads 4 --port 8000
+
+See "Multi-process serving" in the README to size --workers and --intra-op-threads.
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+import traceback
+
+
+def configure_threads(intra_op_threads, preprocess_threads):
+    # Must be set before TensorFlow / OpenCV are imported by model_api
+    os.environ["INTRA_OP_THREADS"] = str(intra_op_threads)
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(intra_op_threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    os.environ["OMP_NUM_THREADS"] = str(intra_op_threads)
+    os.environ["PREPROCESS_THREADS"] = str(preprocess_threads)
+    # Parallelism comes from the preprocessing pool, not from inside each OpenCV call
+    os.environ.setdefault("OPENCV_THREADS", "1")
+
+
+def bind_socket(host, port, backlog=2048):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock):
+    import uvicorn
+
+    # model_api is imported here, after the fork: each worker loads its own model
+    # and creates its own MongoDB client
+    config = uvicorn.Config("model_api:app", log_level="info", timeout_keep_alive=30)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def spawn_worker(sock):
+    pid = os.fork()
+    if pid == 0:
+        # Child: restore the default handlers, uvicorn installs its own
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        code = 0
+        try:
+            run_worker(sock)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def remove_metrics_snapshot(pid):
+    try:
+        os.remove(os.path.join(os.environ["METRICS_DIR"], f"model_api_{pid}.json"))
+    except (KeyError, OSError):
+        pass
+
+
+def prepare_model():
+    import model_api
+
+    model_api.prepare_deployed_model()
+
+
+def serve(host, port, workers, prepare):
+    if prepare:
+        # In a separate process, so that nothing of the model is loaded in the master
+        process = multiprocessing.get_context("spawn").Process(target=prepare_model)
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            # The workers retry the download themselves, and report it on /ready
+            print(f"Could not prepare the model (exit code {process.exitcode})")
+
+    sock = bind_socket(host, port)
+    print(f"Master {os.getpid()}: {workers} worker(s) on http://{host}:{port}")
+    if workers > 1 and os.environ.get("MODEL_BACKEND", "mlflow") == "mlflow":
+        print("MODEL_BACKEND=mlflow: each worker loads its own copy of the weights")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    children = {spawn_worker(sock) for _ in range(workers)}
+    while children and not stopping:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(0.5)
+            continue
+        children.discard(pid)
+        # The gauges of a dead worker would stay in the totals: drop its metrics
+        remove_metrics_snapshot(pid)
+        # Replace a worker that died: it loads the model from the local cache
+        print(f"Worker {pid} exited with status {status}, restarting it")
+        time.sleep(1)
+        children.add(spawn_worker(sock))
+
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in children:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+
+
+if __name__ == "__main__":
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Pre-fork server for the model API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--intra-op-threads", type=int, default=int(os.environ.get("INTRA_OP_THREADS", 1)),
+        help="threads used by the model inside one prediction, per worker",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=int(os.environ.get("API_WORKERS", 0)),
+        help="number of worker processes (default: CPUs / intra-op threads)",
+    )
+    parser.add_argument(
+        "--preprocess-threads", type=int, default=int(os.environ.get("PREPROCESS_THREADS", 0)),
+        help="image decoding / normalization threads per worker (default: CPUs / workers)",
+    )
+    parser.add_argument(
+        "--no-prepare", action="store_true",
+        help="let each worker download the model instead of preparing the cache first",
+    )
+    args = parser.parse_args()
+
+    workers = args.workers or max(1, cpus // args.intra_op_threads)
+    preprocess_threads = args.preprocess_threads or max(1, cpus // workers)
+    configure_threads(args.intra_op_threads, preprocess_threads)
+    os.environ.setdefault("ONNX_SHARED_WEIGHTS", "1" if workers > 1 else "0")
+    metrics_dir = None
+    if not os.environ.get("METRICS_DIR"):
+        metrics_dir = os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="model_api_metrics_")
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    try:
+        serve(args.host, args.port, workers, not args.no_prepare)
+    finally:
+        if metrics_dir is not None:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
@@ -1,43 +1,41 @@
-import requests
-import cv2
+import sys
 import os
-import numpy as np
-
-url = "http://127.0.0.1:8000/predict/"
-yes_path = "/home/kevin/simplon/briefs/b14_neuroguard_app/repo/data/raw/yes"
-no_path = "/home/kevin/simplon/briefs/b14_neuroguard_app/repo/data/raw/no"
 
-# List of images to test
-yes_images = [f"{yes_path}/{i}" for i in os.listdir(yes_path)]
-no_images = [f"{no_path}/{i}" for i in os.listdir(no_path)]
-
-# Join the lists
-all_images = yes_images + no_images
+import requests
+from pymongo import MongoClient
 
-# Choose a random image
-filename = np.random.choice(all_images)
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+from hidden import MONGO_URI
 
-# load image using openCV
-image = cv2.imread(filename)
+# Manual check of a running model API: python test_api.py [patient_id] [api_url]
+# For load and latency measures, see benchmarks/load_test.py
+url = sys.argv[2] if len(sys.argv) > 2 else "http://127.0.0.1:8000"
 
-# Convert the image to bytes
-_, image_encoded = cv2.imencode(".jpg", image)
-image_bytes = image_encoded.tobytes()
+if len(sys.argv) > 1:
+    patient_id = sys.argv[1]
+else:
+    # Choose a random patient with a scan
+    db = MongoClient(MONGO_URI)["braintumor"]
+    patients = list(
+        db.patients.aggregate(
+            [{"$match": {"scanner.scan_id": {"$type": "string"}}}, {"$sample": {"size": 1}}]
+        )
+    )
+    if not patients:
+        sys.exit("No patient with a scan in the database")
+    patient_id = str(patients[0]["_id"])
 
-# Send the image to the API
-response = requests.post(url, files={"file": ("image.jpg", image_bytes)})
+# Ask the API for a prediction on the patient's scan
+response = requests.post(f"{url}/predict/", params={"patient_id": patient_id})
 
 # Print response managing errors
 if response.status_code == 200:
-    if response.json().get("label") == "yes":
-        print(
-            f'Présence de tumeur ? {response.json().get("label")} (Confidence : {response.json().get("confidence"):.2%})',
-            f'\nFichier envoyé: {filename.split("/")[-1]}',
-        )
-    else:
-        print(
-            f'Présence de tumeur ? {response.json().get("label")} (Confidence : {1/1-response.json().get("confidence"):.2%})',
-            f'\nFichier envoyé: {filename.split("/")[-1]}',
-        )
+    result = response.json()
+    # confidence is the probability of a tumor
+    confidence = result["confidence"] if result["AI_predict"] == "yes" else 1 - result["confidence"]
+    print(
+        f'Présence de tumeur ? {result["AI_predict"]} (Confidence : {confidence:.2%})',
+        f'\nPatient: {patient_id}, modèle: {result.get("model_version")}',
+    )
 else:
     print("Error:", response.status_code, response.text)
@@ -0,0 +1,135 @@
+"""
+Helpers shared by the benchmarks: closed-loop load generation, latency summaries,
+synthetic scans and machine-readable results.
+"""
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+# hidden.py (MONGO_URI) is next to the repository
+sys.path.append(os.path.abspath(os.path.join(ROOT, "..")))
+
+
+def percentiles_ms(seconds):
+    """
+    Returns the p50, p95 and p99 of a list of durations in seconds, in milliseconds.
+    """
+    if not len(seconds):
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "mean_ms": None}
+    values = np.asarray(seconds, dtype=np.float64) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "mean_ms": float(values.mean()),
+    }
+
+
+def latency_summary(latencies, errors, duration):
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": len(latencies) / duration,
+        **percentiles_ms(latencies),
+    }
+
+
+async def run_load(send, concurrency, duration):
+    """
+    Runs concurrency clients in a closed loop for duration seconds: each client sends a
+    request as soon as its previous one is answered.
+
+    Args:
+    - send: coroutine function send(i) -> bool, sends the i-th request and tells whether
+      it succeeded. Exceptions count as errors.
+
+    Returns:
+    - (latencies of the successful requests in seconds, number of errors)
+    """
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def client_loop(offset):
+        nonlocal errors
+        i = offset
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                ok = await send(i)
+            except Exception:
+                ok = False
+            i += concurrency
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    await asyncio.gather(*[client_loop(i) for i in range(concurrency)])
+    return latencies, errors
+
+
+def synthetic_scan(rng, size=256, tumor=None):
+    """
+    A grayscale brain-like image (a bright ellipse on a dark background, with noise),
+    with a brighter blob when tumor is true. Every call gives different bytes.
+
+    Returns:
+    - (np.array uint8 BGR image, bool tumor)
+    """
+    if tumor is None:
+        tumor = bool(rng.random() < 0.5)
+    image = rng.normal(12, 4, (size, size)).clip(0, 255).astype(np.uint8)
+    center = (size // 2 + int(rng.integers(-size // 16, size // 16 + 1)), size // 2)
+    axes = (int(size * rng.uniform(0.3, 0.4)), int(size * rng.uniform(0.35, 0.45)))
+    cv2.ellipse(image, center, axes, 0, 0, 360, int(rng.integers(90, 140)), -1)
+    if tumor:
+        spot = (
+            center[0] + int(rng.integers(-axes[0] // 2, axes[0] // 2 + 1)),
+            center[1] + int(rng.integers(-axes[1] // 2, axes[1] // 2 + 1)),
+        )
+        cv2.circle(image, spot, int(size * rng.uniform(0.05, 0.12)), 230, -1)
+    image = cv2.GaussianBlur(image, (5, 5), 0)
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR), tumor
+
+
+def environment():
+    # Enough context to compare two result files
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+    }
+
+
+def write_results(path, benchmark, config, results):
+    report = {
+        "benchmark": benchmark,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": environment(),
+        "config": config,
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {path}")
+    return report
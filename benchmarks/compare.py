@@ -0,0 +1,79 @@
+"""
+Compares two result files of the same benchmark (load_test.py or microbench.py), for
+example the last release and the candidate, and exits with status 1 on a regression.
+
+A measure regresses when its p95 latency grows, or its throughput drops, by more than
+--threshold (a fraction, 0.15 = 15%). Measures are matched on their parameters
+(scenario and concurrency, or function and workers).
+
+Usage:
+    python benchmarks/compare.py baseline.json candidate.json --threshold 0.15
+"""
+import argparse
+import json
+import sys
+
+# Measured values, everything else identifies the measure
+METRICS = {
+    "requests", "errors", "throughput_rps", "images_per_s",
+    "p50_ms", "p95_ms", "p99_ms", "mean_ms", "median_ms",
+}
+THROUGHPUT = ("throughput_rps", "images_per_s")
+
+
+def measure_key(result):
+    return json.dumps({k: v for k, v in result.items() if k not in METRICS}, sort_keys=True)
+
+
+def compare(baseline, candidate, threshold):
+    """
+    Returns:
+    - list of dict, one per measure present in both reports, with the relative changes
+      and whether the measure regressed
+    """
+    baseline_results = {measure_key(result): result for result in baseline["results"]}
+    rows = []
+    for result in candidate["results"]:
+        reference = baseline_results.get(measure_key(result))
+        if reference is None:
+            continue
+        row = {"measure": measure_key(result), "regression": False}
+        if reference.get("p95_ms") and result.get("p95_ms") is not None:
+            row["p95_change"] = result["p95_ms"] / reference["p95_ms"] - 1
+            row["regression"] |= row["p95_change"] > threshold
+        for name in THROUGHPUT:
+            if reference.get(name) and result.get(name) is not None:
+                row["throughput_change"] = result[name] / reference[name] - 1
+                row["regression"] |= row["throughput_change"] < -threshold
+        if result.get("errors", 0) > reference.get("errors", 0):
+            row["regression"] = True
+        rows.append(row)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=0.15)
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline["benchmark"] != candidate["benchmark"]:
+        sys.exit(f"Different benchmarks: {baseline['benchmark']} and {candidate['benchmark']}")
+
+    rows = compare(baseline, candidate, args.threshold)
+    for row in rows:
+        changes = "  ".join(
+            f"{name} {row[name]:+.1%}" for name in ("p95_change", "throughput_change") if name in row
+        )
+        print(f"{'REGRESSION' if row['regression'] else 'ok':>10}  {row['measure']}  {changes}")
+    print(
+        f"\n{len(rows)} measure(s) compared "
+        f"({baseline['environment']['commit']} -> {candidate['environment']['commit']})"
+    )
+    if any(row["regression"] for row in rows):
+        sys.exit(1)
@@ -0,0 +1,224 @@
+"""
+Load test of the model API and the backend, against a seeded benchmark database.
+
+Both applications run in this process. Requests go through httpx.ASGITransport, and
+the backend calls the model API the same way. The real MLflow model is replaced by
+the deterministic "stub" backend of api/model_backends.py. Its compute time can be
+set with --stub-batch-ms and --stub-image-ms. Each run:
+
+1. drops and seeds the benchmark database (see benchmarks/seed.py);
+2. starts both applications and waits for the model;
+3. for each scenario and each concurrency, warms up, then sends requests from
+   closed-loop clients for --duration seconds.
+
+Scenarios:
+- predict: POST /predict/?patient_id=... on the model API
+- predict_patient: GET /predict_patient/{id} on the backend (model API call, then
+  writes to MongoDB)
+- list_views: the backend patient lists (/view_patients, /tumor, /no_tumor,
+  /view_validates_patients, /view_waiting_patients)
+
+The throughput and the p50/p95/p99 latencies are printed and written as JSON
+(--output). Compare two result files with benchmarks/compare.py.
+
+The numbers include the client, which shares the event loop with the applications:
+compare runs made on the same machine with the same options.
+
+Usage (from the repository root):
+    python benchmarks/load_test.py --patients 500 --concurrency 1,8,32 --duration 20
+    python benchmarks/load_test.py --in-memory  # throwaway mongod, needs pymongo_inmemory
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+import httpx
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from bench_utils import ROOT, latency_summary, run_load, write_results
+from seed import DEFAULT_DATABASE, reset_database, seed_patients
+
+SCENARIOS = ("predict", "predict_patient", "list_views")
+LIST_VIEWS = (
+    "/view_patients",
+    "/tumor",
+    "/no_tumor",
+    "/view_validates_patients",
+    "/view_waiting_patients",
+)
+
+
+def configure_services(args):
+    # Read by the applications at import time
+    os.environ["MODEL_BACKEND"] = args.backend
+    os.environ["STUB_BATCH_MS"] = str(args.stub_batch_ms)
+    os.environ["STUB_IMAGE_MS"] = str(args.stub_image_ms)
+    os.environ["PREDICTION_CACHE_PERSISTENT"] = "0"
+    if not args.prediction_cache:
+        os.environ["PREDICTION_CACHE_SIZE"] = "0"
+    # Only the initial statistics recount, not one in the middle of a measure
+    os.environ.setdefault("STATS_REFRESH_SECONDS", "86400")
+
+
+def load_services(db):
+    """
+    Imports both applications and points them to the benchmark database.
+
+    The backend resolves its templates and static files from its own directory, so the
+    working directory is changed to braintumor-ui.
+    """
+    sys.path.append(os.path.join(ROOT, "api"))
+    sys.path.append(os.path.join(ROOT, "braintumor-ui"))
+    import model_api
+
+    os.chdir(os.path.join(ROOT, "braintumor-ui"))
+    import app as ui
+
+    model_api.db = db
+    model_api.feedback_buffer.collection = db[model_api.FEEDBACK_COLLECTION]
+    ui.db = db
+    return model_api, ui
+
+
+async def wait_ready(client, timeout):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while asyncio.get_running_loop().time() < deadline:
+        if (await client.get("/ready")).status_code == 200:
+            return
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"The model was not ready within {timeout}s")
+
+
+def scenario_sender(scenario, api_client, ui_client, patient_ids):
+    if scenario == "predict":
+
+        async def send(i):
+            patient_id = patient_ids[i % len(patient_ids)]
+            response = await api_client.post("/predict/", params={"patient_id": patient_id})
+            return response.status_code == 200
+
+    elif scenario == "predict_patient":
+
+        async def send(i):
+            response = await ui_client.get(f"/predict_patient/{patient_ids[i % len(patient_ids)]}")
+            return response.status_code == 200
+
+    else:
+
+        async def send(i):
+            response = await ui_client.get(LIST_VIEWS[i % len(LIST_VIEWS)])
+            return response.status_code == 200
+
+    return send
+
+
+async def run(args, mongo_uri):
+    client = AsyncIOMotorClient(mongo_uri, maxPoolSize=max(args.concurrency) * 2 + 10)
+    db = await reset_database(client, args.database)
+    print(f"Seeding {args.patients} patient(s)...")
+    patient_ids = await seed_patients(
+        db, args.patients, args.seed, args.image_size, args.predicted_fraction, not args.no_ingest
+    )
+
+    model_api, ui = load_services(db)
+    api_transport = httpx.ASGITransport(app=model_api.app)
+    results = []
+    async with model_api.app.router.lifespan_context(model_api.app):
+        async with ui.app.router.lifespan_context(ui.app):
+            # The backend reaches the model API in this process
+            await ui.model_api.aclose()
+            ui.model_api = ui.ModelApiClient(
+                "http://model-api", ui.MODEL_API_TIMEOUT, 0, max(args.concurrency),
+                transport=api_transport,
+            )
+            async with httpx.AsyncClient(
+                transport=api_transport, base_url="http://model-api", timeout=120
+            ) as api_client, httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=ui.app), base_url="http://backend", timeout=120
+            ) as ui_client:
+                await wait_ready(api_client, args.startup_timeout)
+                for scenario in args.scenarios:
+                    send = scenario_sender(scenario, api_client, ui_client, patient_ids)
+                    for concurrency in args.concurrency:
+                        await run_load(send, concurrency, args.warmup)
+                        latencies, errors = await run_load(send, concurrency, args.duration)
+                        result = {
+                            "scenario": scenario,
+                            "concurrency": concurrency,
+                            **latency_summary(latencies, errors, args.duration),
+                        }
+                        results.append(result)
+                        print(
+                            f"{scenario:>16} c={concurrency:<4} "
+                            f"{result['throughput_rps']:>8.1f} req/s  "
+                            f"p50 {result['p50_ms'] or 0:>7.1f} ms  "
+                            f"p95 {result['p95_ms'] or 0:>7.1f} ms  "
+                            f"p99 {result['p99_ms'] or 0:>7.1f} ms  "
+                            f"errors {errors}"
+                        )
+            await ui.model_api.aclose()
+    client.close()
+    return results
+
+
+def start_in_memory_mongod():
+    try:
+        from pymongo_inmemory import Mongod
+        from pymongo_inmemory.context import Context
+    except ImportError:
+        sys.exit("--in-memory needs pymongo_inmemory: pip install pymongo_inmemory")
+    # Downloads a mongod binary on the first use, then runs it on a temporary data folder
+    mongod = Mongod(Context())
+    mongod.start()
+    return mongod
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the model API and the backend")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated list")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma separated list")
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--patients", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--image-size", type=int, default=256)
+    parser.add_argument("--predicted-fraction", type=float, default=0.3)
+    parser.add_argument("--no-ingest", action="store_true",
+                        help="do not precompute the ROIs, so that /predict/ preprocesses the scans")
+    parser.add_argument("--backend", default="stub", help="MODEL_BACKEND of the model API")
+    parser.add_argument("--stub-batch-ms", type=float, default=5.0)
+    parser.add_argument("--stub-image-ms", type=float, default=1.0)
+    parser.add_argument("--prediction-cache", action="store_true",
+                        help="keep the prediction cache (disabled by default)")
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument("--in-memory", action="store_true", help="run a throwaway mongod")
+    parser.add_argument("--mongo-uri", default=None)
+    parser.add_argument("--database", default=DEFAULT_DATABASE)
+    parser.add_argument("--output", default="load_test.json")
+    args = parser.parse_args()
+    args.scenarios = args.scenarios.split(",")
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s) {sorted(unknown)}, expected {SCENARIOS}")
+    args.concurrency = [int(c) for c in args.concurrency.split(",")]
+    args.output = os.path.abspath(args.output)
+
+    mongod = None
+    if args.in_memory:
+        mongod = start_in_memory_mongod()
+        args.mongo_uri = mongod.connection_string
+    elif args.mongo_uri is None:
+        from hidden import MONGO_URI
+
+        args.mongo_uri = MONGO_URI
+
+    configure_services(args)
+    try:
+        results = asyncio.run(run(args, args.mongo_uri))
+    finally:
+        if mongod is not None:
+            mongod.stop()
+
+    config = {key: value for key, value in vars(args).items() if key not in ("mongo_uri", "output")}
+    write_results(args.output, "load_test", config, results)
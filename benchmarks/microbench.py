@@ -0,0 +1,138 @@
+"""
+Microbenchmarks of the image pipeline (tumor_detection_model/functions):
+
+- normalize_image: one image at a time, latency per image
+- normalize_images: a batch, for each number of threads
+- load_images: a class folder of PNG files written for the run, for each number of
+  threads, with and without target_size
+
+Each measure is repeated --repeat times. The median and p95 durations and the images
+per second of the median run are printed and written as JSON (--output). Compare two
+result files with benchmarks/compare.py.
+
+Usage (from the repository root):
+    python benchmarks/microbench.py --images 256 --workers 1,4 --repeat 5
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from bench_utils import ROOT, percentiles_ms, synthetic_scan, write_results
+
+sys.path.append(ROOT)
+from tumor_detection_model.functions.load_images import load_images  # noqa: E402
+from tumor_detection_model.functions.normalize_images import (  # noqa: E402
+    normalize_image,
+    normalize_images,
+)
+
+TARGET_SIZE = (224, 224)
+
+
+def measure(name, fn, repeat, images, **params):
+    fn()  # Warm-up: imports, allocations, OpenCV thread pool
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    stats = percentiles_ms(durations)
+    result = {
+        "name": name,
+        **params,
+        "images": images,
+        "repeat": repeat,
+        "median_ms": stats["p50_ms"],
+        "p95_ms": stats["p95_ms"],
+        "images_per_s": images / (stats["p50_ms"] / 1000),
+    }
+    details = " ".join(f"{key}={value}" for key, value in params.items())
+    print(
+        f"{name:>18} {details:<28} median {result['median_ms']:>9.2f} ms  "
+        f"p95 {result['p95_ms']:>9.2f} ms  {result['images_per_s']:>9.1f} img/s"
+    )
+    return result
+
+
+def bench_normalize_image(images, repeat):
+    # Latency of a single image, as in the model API
+    durations = []
+    for _ in range(repeat):
+        for image in images:
+            start = time.perf_counter()
+            normalize_image(image, TARGET_SIZE)
+            durations.append(time.perf_counter() - start)
+    stats = percentiles_ms(durations)
+    result = {
+        "name": "normalize_image",
+        "images": len(images),
+        "repeat": repeat,
+        "median_ms": stats["p50_ms"],
+        "p95_ms": stats["p95_ms"],
+        "p99_ms": stats["p99_ms"],
+        "images_per_s": 1000 / stats["p50_ms"],
+    }
+    print(
+        f"{'normalize_image':>18} {'per image':<28} median {result['median_ms']:>9.2f} ms  "
+        f"p95 {result['p95_ms']:>9.2f} ms  {result['images_per_s']:>9.1f} img/s"
+    )
+    return result
+
+
+def write_class_folders(directory, images, labels):
+    for i, (image, tumor) in enumerate(zip(images, labels)):
+        folder = os.path.join(directory, "yes" if tumor else "no")
+        os.makedirs(folder, exist_ok=True)
+        cv2.imwrite(os.path.join(folder, f"{i:06d}.png"), image)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the image pipeline")
+    parser.add_argument("--images", type=int, default=256)
+    parser.add_argument("--image-size", type=int, default=512)
+    parser.add_argument("--workers", default=f"1,{os.cpu_count() or 1}", help="comma separated list")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="microbench.json")
+    args = parser.parse_args()
+    workers_list = sorted({int(w) for w in args.workers.split(",")})
+
+    rng = np.random.default_rng(args.seed)
+    scans = [synthetic_scan(rng, args.image_size) for _ in range(args.images)]
+    images = [image for image, _ in scans]
+    labels = [tumor for _, tumor in scans]
+
+    results = [bench_normalize_image(images, args.repeat)]
+    for workers in workers_list:
+        results.append(
+            measure(
+                "normalize_images",
+                lambda: normalize_images(images, TARGET_SIZE, workers=workers),
+                args.repeat, len(images), workers=workers,
+            )
+        )
+
+    directory = tempfile.mkdtemp(prefix="braintumor_bench_")
+    try:
+        write_class_folders(directory, images, labels)
+        for workers in workers_list:
+            for target_size in (None, TARGET_SIZE):
+                results.append(
+                    measure(
+                        "load_images",
+                        lambda: load_images(directory, target_size=target_size, workers=workers),
+                        args.repeat, len(images),
+                        workers=workers,
+                        target_size=list(target_size) if target_size else None,
+                    )
+                )
+    finally:
+        shutil.rmtree(directory)
+
+    write_results(args.output, "microbench", vars(args), results)
@@ -0,0 +1,139 @@
+"""
+Seeds a benchmark database with synthetic patients and scans.
+
+Each patient gets a unique synthetic scan stored in GridFS, like an upload from the UI.
+Unless --no-ingest is given, the normalized ROIs are stored as well, as the model API
+does at ingest. A fraction of the patients already have a prediction, some of them
+checked by an expert, so that every patient list has content.
+
+The database is dropped first: it must be dedicated to the benchmarks.
+
+Usage (from the repository root):
+    python benchmarks/seed.py --patients 1000 --database braintumor_benchmark
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from bench_utils import ROOT, synthetic_scan
+
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "api"))
+sys.path.append(os.path.join(ROOT, "braintumor-ui"))
+from common.scan_store import put_roi_async, put_scan_async  # noqa: E402
+from patient_queries import name_search_fields  # noqa: E402
+from preprocessing import (  # noqa: E402
+    PREPROCESSING_PARAMS,
+    PREPROCESSING_VERSION,
+    decode_and_normalize,
+)
+
+DEFAULT_DATABASE = "braintumor_benchmark"
+# Never drop the application database
+PROTECTED_DATABASES = {"braintumor", "admin", "config", "local"}
+
+FIRST_NAMES = ["Alice", "Bruno", "Chloé", "David", "Élodie", "Farid", "Gaëlle", "Hugo"]
+LAST_NAMES = ["Martin", "Bernard", "Dubois", "Durand", "Lefèvre", "Moreau", "Girard"]
+
+
+def seed_prediction(rng, tumor):
+    # Prediction as stored by the UI, right for 90% of the scans
+    ai_tumor = tumor if rng.random() < 0.9 else not tumor
+    confidence = float(rng.uniform(0.55, 0.99))
+    prediction = {
+        "AI_predict": "Tumor" if ai_tumor else "No tumor",
+        "confidence": confidence * 100,
+        "raw_confidence": confidence if ai_tumor else 1 - confidence,
+        "prediction_date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "model_version": "seed",
+    }
+    if rng.random() < 0.5:
+        prediction["predict_check"] = "Yes" if ai_tumor == tumor else "No"
+        prediction["predict_check_date"] = prediction["prediction_date"]
+    return prediction
+
+
+async def seed_patients(
+    db, n, seed=0, image_size=256, predicted_fraction=0.3, ingest=True, batch_size=100
+):
+    """
+    Inserts n synthetic patients with their scans.
+
+    Returns:
+    - list of the patient ids (str), in insertion order
+    """
+    rng = np.random.default_rng(seed)
+    patient_ids = []
+    for start in range(0, n, batch_size):
+        documents = []
+        for i in range(start, min(start + batch_size, n)):
+            image, tumor = synthetic_scan(rng, image_size)
+            data = cv2.imencode(".png", image)[1].tobytes()
+            scanner = await put_scan_async(db, data, f"scan_{i:06d}.png")
+            scanner["scanner_name"] = f"scan_{i:06d}.png"
+            scanner["prediction"] = (
+                seed_prediction(rng, tumor) if rng.random() < predicted_fraction else None
+            )
+            if ingest:
+                roi, box = decode_and_normalize(np.frombuffer(data, np.uint8))
+                await put_roi_async(
+                    db, scanner["scan_id"], PREPROCESSING_VERSION, roi, box, PREPROCESSING_PARAMS
+                )
+            name = f"{FIRST_NAMES[i % len(FIRST_NAMES)]} {LAST_NAMES[i % len(LAST_NAMES)]} {i}"
+            documents.append(
+                {
+                    "name": name,
+                    "age": int(rng.integers(18, 90)),
+                    "gender": "female" if i % 2 else "male",
+                    "scanner": scanner,
+                    **name_search_fields(name),
+                }
+            )
+        result = await db.patients.insert_many(documents)
+        patient_ids.extend(str(inserted_id) for inserted_id in result.inserted_ids)
+    return patient_ids
+
+
+async def reset_database(client, database):
+    if database in PROTECTED_DATABASES:
+        raise ValueError(f"Refusing to drop the {database!r} database, use a dedicated one")
+    await client.drop_database(database)
+    return client[database]
+
+
+async def main(args):
+    client = AsyncIOMotorClient(args.mongo_uri)
+    db = await reset_database(client, args.database)
+    start = time.perf_counter()
+    patient_ids = await seed_patients(
+        db, args.patients, args.seed, args.image_size, args.predicted_fraction, not args.no_ingest
+    )
+    print(
+        f"{len(patient_ids)} patient(s) seeded in {args.database} "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seed a benchmark database")
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--image-size", type=int, default=256)
+    parser.add_argument("--predicted-fraction", type=float, default=0.3)
+    parser.add_argument("--no-ingest", action="store_true", help="do not precompute the ROIs")
+    parser.add_argument("--mongo-uri", default=None)
+    parser.add_argument("--database", default=DEFAULT_DATABASE)
+    args = parser.parse_args()
+
+    if args.mongo_uri is None:
+        from hidden import MONGO_URI
+
+        args.mongo_uri = MONGO_URI
+
+    asyncio.run(main(args))
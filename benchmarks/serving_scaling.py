@@ -0,0 +1,158 @@
+"""
+Scaling curve of the pre-fork model API (api/serve.py).
+
+For each number of workers, starts the server, sends /predict/ requests for patients
+that have a scan during --duration seconds, then records the throughput, the latency
+percentiles and the memory of the whole process tree (PSS, which counts the pages
+shared copy-on-write between the workers only once).
+
+Usage (from the repository root, MongoDB must contain patients with a scan):
+    python benchmarks/serving_scaling.py --workers 1,2,4,8,16 --intra-op-threads 1
+
+The prediction cache is disabled in the benchmarked servers, so every request runs
+the model. Drop the scan_rois collection to include the image preprocessing as well.
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import httpx
+from pymongo import MongoClient
+
+from bench_utils import ROOT, latency_summary, run_load
+
+
+def process_tree(pid):
+    children = []
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except FileNotFoundError:
+        pass
+    return [pid] + [p for child in children for p in process_tree(child)]
+
+
+def memory_mb(pid, field):
+    # Pss: proportional set size, shared pages are split between the processes using them
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        pass
+    return 0.0
+
+
+def wait_ready(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}/ready", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"The model API was not ready within {timeout}s")
+
+
+async def load(url, patient_ids, concurrency, duration):
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=120, limits=limits) as client:
+
+        async def send(i):
+            patient_id = patient_ids[i % len(patient_ids)]
+            response = await client.post("/predict/", params={"patient_id": patient_id})
+            return response.status_code == 200
+
+        return await run_load(send, concurrency, duration)
+
+
+def run_point(args, workers, patient_ids):
+    url = f"http://127.0.0.1:{args.port}"
+    env = dict(os.environ, PREDICTION_CACHE_SIZE="0", PREDICTION_CACHE_PERSISTENT="0")
+    command = [
+        sys.executable, "serve.py",
+        "--port", str(args.port),
+        "--workers", str(workers),
+        "--intra-op-threads", str(args.intra_op_threads),
+    ]
+    if args.no_prepare:
+        command.append("--no-prepare")
+    server = subprocess.Popen(command, cwd=os.path.join(ROOT, "api"), env=env)
+    try:
+        wait_ready(url, args.startup_timeout)
+        asyncio.run(load(url, patient_ids, args.concurrency, args.warmup))
+        latencies, errors = asyncio.run(
+            load(url, patient_ids, args.concurrency, args.duration)
+        )
+        pids = process_tree(server.pid)
+        pss = sum(memory_mb(pid, "Pss") for pid in pids)
+        rss = sum(memory_mb(pid, "Rss") for pid in pids)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=60)
+
+    return {
+        "workers": workers,
+        "intra_op_threads": args.intra_op_threads,
+        "concurrency": args.concurrency,
+        **latency_summary(latencies, errors, args.duration),
+        "pss_mb": pss,
+        "rss_mb": rss,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scaling curve of the pre-fork model API")
+    parser.add_argument("--workers", default="1,2,4,8,16", help="comma separated list")
+    parser.add_argument("--intra-op-threads", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--warmup", type=float, default=5.0)
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    parser.add_argument("--no-prepare", action="store_true")
+    parser.add_argument("--mongo-uri", default=None)
+    parser.add_argument("--output", default="serving_scaling.json")
+    args = parser.parse_args()
+
+    if args.mongo_uri is None:
+        from hidden import MONGO_URI
+
+        args.mongo_uri = MONGO_URI
+
+    db = MongoClient(args.mongo_uri)["braintumor"]
+    patient_ids = [
+        str(patient["_id"])
+        for patient in db.patients.find(
+            {"scanner.scan_id": {"$type": "string"}}, {"_id": 1}
+        ).limit(args.patients)
+    ]
+    if not patient_ids:
+        sys.exit("No patient with a scan in the database")
+
+    results = []
+    for workers in [int(w) for w in args.workers.split(",")]:
+        result = run_point(args, workers, patient_ids)
+        results.append(result)
+        print(json.dumps(result))
+
+    baseline = results[0]["throughput_rps"] / results[0]["workers"] or 1.0
+    print(f"\n{'workers':>8} {'req/s':>9} {'speedup':>8} {'p50 ms':>8} {'p95 ms':>8} {'PSS MB':>8}")
+    for result in results:
+        print(
+            f"{result['workers']:>8} {result['throughput_rps']:>9.1f} "
+            f"{result['throughput_rps'] / baseline:>8.2f} "
+            f"{result['p50_ms'] or 0:>8.1f} {result['p95_ms'] or 0:>8.1f} {result['pss_mb']:>8.0f}"
+        )
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
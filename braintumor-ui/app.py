@@ -1,34 +1,183 @@
 import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from hidden import MONGO_URI
+from common.metrics import CONTENT_TYPE, MetricsMiddleware, MetricsRegistry, stage
+from common.prediction_queue import (
+    jobs_by_status_async,
+    needs_prediction,
+    prioritize_async,
+    queue_depth_async,
+    queue_stats_async,
+)
+from common.scan_store import (
+    THUMBNAIL_SIZE,
+    ScanTooLargeError,
+    UnsupportedScanError,
+    get_thumbnail_async,
+    make_thumbnail,
+    open_scan_async,
+    put_scan_file_async,
+    put_thumbnail_async,
+    read_scan_buffer_async,
+    sniff_content_type,
+)
+from model_client import ModelApiClient
+from patient_stats import get_stats, record_change, refresh_stats
+from patient_queries import (
+    NO_TUMOR_QUERY,
+    SEARCH_PROJECTION,
+    TUMOR_QUERY,
+    VALIDATED_QUERY,
+    WAITING_QUERY,
+    backfill_name_search,
+    ensure_indexes,
+    name_prefix_query,
+    name_search_fields,
+    list_pipeline,
+    name_text_query,
+    normalize_name,
+    paginate,
+)
 
 import uvicorn
-from fastapi import FastAPI, Request, Form, HTTPException
+from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
-from pymongo import MongoClient
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, Response, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from starlette.datastructures import UploadFile
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import PyMongoError
+from gridfs.errors import NoFile
 from bson import ObjectId
-from pydantic import BaseModel, validator
-from typing import Optional
-import base64
-import binascii
-import requests
+from bson.errors import InvalidId
+from pydantic import BaseModel, ValidationError, root_validator, validator
+from typing import List, Optional
+import asyncio
+import hashlib
+import httpx
 from datetime import datetime  
 
 app = FastAPI()
 
-# Connexion à la base de données MongoDB
-client = MongoClient(MONGO_URI)
+# Métriques exposées sur GET /metrics, et trace des requêtes plus lentes que SLOW_REQUEST_MS
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 1000))
+metrics = MetricsRegistry("backend")
+model_api_errors = metrics.counter(
+    "model_api_errors_total", "Failed calls to the model API by endpoint.", ("endpoint",)
+)
+prediction_jobs = metrics.gauge(
+    "prediction_jobs", "Background prediction jobs by status.", ("status",)
+)
+app.add_middleware(
+    MetricsMiddleware, registry=metrics, slow_request_seconds=SLOW_REQUEST_MS / 1000
+)
+
+# Envoi des scanners : taille maximale du fichier, et du reste du formulaire multipart
+MAX_SCAN_BYTES = int(os.environ.get("MAX_SCAN_BYTES", 50 * 1024 * 1024))
+MAX_FORM_OVERHEAD = 64 * 1024
+MAX_FORM_FIELDS = 10
+
+
+class BodySizeLimitMiddleware:
+    """
+    Arrête la lecture du corps d'une requête dès qu'il dépasse max_bytes (413).
+
+    check_upload_size refuse les envois trop gros annoncés par Content-Length ; sans
+    Content-Length (envoi chunked), le parseur multipart copierait sinon tout le fichier
+    sur disque avant que put_scan_file_async ne vérifie sa taille.
+    """
+
+    def __init__(self, app, max_bytes):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=413, detail="Scan too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+app.add_middleware(BodySizeLimitMiddleware, max_bytes=MAX_SCAN_BYTES + MAX_FORM_OVERHEAD)
+
+# Nombre de patients par page dans les listes
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 50))
+
+# Recherche de patients : nombre maximal de résultats, et index texte optionnel
+SEARCH_LIMIT = int(os.environ.get("SEARCH_LIMIT", 100))
+SEARCH_TEXT_INDEX = os.environ.get("SEARCH_TEXT_INDEX", "0") == "1"
+
+# Recalcul complet des statistiques (les prédictions en arrière-plan ne les incrémentent pas)
+STATS_REFRESH_SECONDS = float(os.environ.get("STATS_REFRESH_SECONDS", 300))
+
+# Nombre de patients envoyés par requête à /predict/batch (environ un lot du modèle), et
+# timeout de ces requêtes, qui ne sont pas rejouées : un lot lent serait prédit plusieurs fois
+PREDICT_ALL_BATCH_SIZE = int(os.environ.get("PREDICT_ALL_BATCH_SIZE", 32))
+PREDICT_ALL_TIMEOUT = float(os.environ.get("PREDICT_ALL_TIMEOUT", 120))
+
+# Connexion à l'API du modèle
+MODEL_API_URL = os.environ.get("MODEL_API_URL", "http://localhost:8000")
+MODEL_API_TIMEOUT = float(os.environ.get("MODEL_API_TIMEOUT", 30))
+MODEL_API_RETRIES = int(os.environ.get("MODEL_API_RETRIES", 2))
+MODEL_API_MAX_CONNECTIONS = int(os.environ.get("MODEL_API_MAX_CONNECTIONS", 100))
+model_api = None
+
+# Connexion asynchrone à la base de données MongoDB
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+client = AsyncIOMotorClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE)
 db = client["braintumor"]
 
+
+@app.on_event("startup")
+async def startup():
+    global model_api
+    # Un seul client HTTP, partagé par toutes les requêtes
+    model_api = ModelApiClient(
+        MODEL_API_URL, MODEL_API_TIMEOUT, MODEL_API_RETRIES, MODEL_API_MAX_CONNECTIONS
+    )
+    # Créer les index des listes de patients
+    await ensure_indexes(db, SEARCH_TEXT_INDEX)
+    # Ajouter les champs de recherche aux anciens patients, sans bloquer le démarrage
+    asyncio.create_task(backfill_name_search(db))
+    asyncio.create_task(refresh_stats_loop())
+
+
+async def refresh_stats_loop():
+    while True:
+        try:
+            await refresh_stats(db)
+        except PyMongoError as e:
+            print(f"Error refreshing the statistics: {e}")
+        await asyncio.sleep(STATS_REFRESH_SECONDS)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await model_api.aclose()
+
 # Modèle Pydantic pour les prédictions (à adapter selon vos besoins)
 class PredictionModel(BaseModel):
     AI_predict: Optional[str] = None
     confidence: Optional[float] = None
     raw_confidence: Optional[float] = None
     prediction_date: Optional[str] = None
+    model_version: Optional[str] = None
     predict_check: Optional[str] = None
     predict_check_date: Optional[str] = None
     comment: Optional[str] = None
@@ -40,26 +189,41 @@ class PredictionModel(BaseModel):
     def model_dump(self):
         return self.__dict__
 
+# Autre patient avec le même scanner, ou un scanner presque identique (signalé à
+# l'ingestion par l'API du modèle ; distance de Hamming entre les hash perceptuels)
+class DuplicateScanModel(BaseModel):
+    patient_id: str
+    scan_id: str
+    distance: int
+
 # Modèle Pydantic pour le scanner
+# (métadonnées seulement : l'image est envoyée en fichier et lue depuis le scan store)
 class ScannerModel(BaseModel):
-    scanner_img: Optional[str] = Form(None, description="Base64 encoded image")
-    scanner_name: Optional[str] = Form(None)
+    scanner_name: Optional[str] = None
+    scan_id: Optional[str] = None
+    scan_size: Optional[int] = None
+    scan_content_type: Optional[str] = None
+    legacy_scan: bool = False
     prediction: Optional[PredictionModel] = None
+    duplicates: List[DuplicateScanModel] = []
+
+    @root_validator(pre=True)
+    def detect_legacy_scan(cls, values):
+        # Ancien format : image base64 dans le document, qui n'est pas gardée dans le modèle
+        if values.get('scanner_img'):
+            values = {k: v for k, v in values.items() if k != 'scanner_img'}
+            values['legacy_scan'] = True
+        return values
 
     @property
-    def image_bytes(self):
-        if self.scanner_img is not None:
-            try:
-                return base64.b64decode(self.scanner_img)
-            except binascii.Error:
-                return None
-        return None
+    def has_scan(self):
+        return bool(self.scan_id or self.legacy_scan)
 
 # Modèles Pydantic pour l'ajout d'un patient
 class PatientModel(BaseModel):
-    name: str = Form(...)
-    age: int = Form(...)
-    gender: str = Form(...)
+    name: str
+    age: int
+    gender: str
     scanner: Optional[ScannerModel] = None
 
     def model_dump(self):
@@ -67,9 +231,9 @@ class PatientModel(BaseModel):
 
 # Modèles Pydantic pour la modification du patient
 class PatientUpdateModel(BaseModel):
-    name: Optional[str] = Form(None)
-    age: Optional[int] = Form(None)
-    gender: Optional[str] = Form(None)
+    name: Optional[str] = None
+    age: Optional[int] = None
+    gender: Optional[str] = None
     scanner: Optional[ScannerModel] = None
 
     def model_dump(self):
@@ -95,7 +259,17 @@ templates = Jinja2Templates(directory="templates")
 # Route pour la page d'accueil
 @app.get("/", response_class=HTMLResponse)
 async def read_index(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+    stats = await get_stats(db, await db.patients.estimated_document_count())
+    return templates.TemplateResponse("index.html", {"request": request, "stats": stats})
+
+
+# Statistiques des prédictions : compteurs matérialisés, ou recalculés avec refresh=true
+@app.get("/stats")
+async def stats(refresh: bool = False):
+    if refresh:
+        await refresh_stats(db)
+    stats = await get_stats(db, await db.patients.estimated_document_count())
+    return JSONResponse(content=jsonable_encoder(stats))
 
 
 # Route pour ajouter un patient
@@ -103,23 +277,75 @@ async def read_index(request: Request):
 def add_patient(request: Request):
     return templates.TemplateResponse("add_patient.html", {"request": request})
 
+def check_upload_size(request: Request):
+    # Refuser un envoi trop gros avant de lire le corps de la requête
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_SCAN_BYTES + MAX_FORM_OVERHEAD:
+        raise HTTPException(status_code=413, detail="Scan too large")
+
+
+def parse_patient_form(form, model):
+    # Champs texte du formulaire (les champs vides sont ignorés)
+    fields = {k: v for k, v in form.items() if isinstance(v, str) and v != ""}
+    try:
+        return model(**fields)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+
+def uploaded_scan(form):
+    upload = form.get("scanner")
+    if isinstance(upload, UploadFile) and upload.filename:
+        return upload
+    return None
+
+
+async def store_uploaded_scan(upload):
+    # Copier le fichier reçu dans le scan store, par morceaux
+    try:
+        return await put_scan_file_async(db, upload, upload.filename, MAX_SCAN_BYTES)
+    except UnsupportedScanError:
+        raise HTTPException(status_code=415, detail="Scan must be a JPEG or PNG image")
+    except ScanTooLargeError:
+        raise HTTPException(status_code=413, detail="Scan too large")
+
+
+# Formulaire multipart : name, age, gender et le fichier scanner (optionnel)
 @app.post("/add_patient")
-async def add_patient_post(patient: PatientModel):
+async def add_patient_post(request: Request, background_tasks: BackgroundTasks):
+    check_upload_size(request)
+    # Le fichier est gardé sur disque au-delà de 1 Mo par le parseur multipart
+    async with request.form(max_files=1, max_fields=MAX_FORM_FIELDS) as form:
+        patient = parse_patient_form(form, PatientModel)
+        patient_data = patient.model_dump()
+        patient_data.update(name_search_fields(patient_data['name']))
+        upload = uploaded_scan(form)
+        if upload is not None:
+            # Le document ne garde que la référence du scanner
+            patient_data['scanner'] = {
+                **await store_uploaded_scan(upload),
+                'scanner_name': upload.filename,
+                'prediction': None,
+            }
+
     # Insérer le patient dans la base de données
-    patient_data = patient.model_dump()
-    if patient_data.get('scanner'):
-        patient_data['scanner'] = patient_data['scanner'].dict()
-    db.patients.insert_one(patient_data)
+    result = await db.patients.insert_one(patient_data)
+    if (patient_data.get('scanner') or {}).get('scan_id'):
+        # Prétraiter le scanner en arrière-plan, après la réponse
+        background_tasks.add_task(ingest_scan, str(result.inserted_id))
     return JSONResponse(content={"redirect_url": "/view_patients"})
 
 # endpoint full_view_patient
 @app.get("/full_view_patient/{patient_id}", response_class=HTMLResponse)
 async def full_view_patient(request: Request, patient_id: str):
     # Retrieve patient information from the database
-    patient_data = db.patients.find_one({"_id": ObjectId(patient_id)})
+    patient_data = await db.patients.find_one({"_id": ObjectId(patient_id)})
     if patient_data is not None:
         # Prepare the data to pass to the HTML template
         patient = PatientViewModel(id=str(patient_data["_id"]), **patient_data)
+        if needs_prediction(patient_data):
+            # Le patient est consulté : sa prédiction passe en tête de la file
+            await prioritize_async(db, patient_data["_id"])
         return templates.TemplateResponse(
             "full_view_patient.html", 
             {"request": request, "patient": patient, "patient_id": patient_id}
@@ -127,88 +353,85 @@ async def full_view_patient(request: Request, patient_id: str):
     else:
         raise HTTPException(status_code=404, detail="Patient not found")
 
+async def render_patient_list(request, template, query, cursor, sort_field=None, direction=ASCENDING, **context):
+    # Filtrer, projeter et paginer dans MongoDB plutôt que dans le template
+    try:
+        documents, next_cursor, total = await paginate(
+            db.patients, query, cursor, PAGE_SIZE, sort_field, direction
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    patients = [
+        PatientViewModel(id=str(patient["_id"]), **patient)
+        for patient in documents
+    ]
+    next_url = None
+    if next_cursor:
+        next_url = str(request.url.include_query_params(cursor=next_cursor))
+    return templates.TemplateResponse(
+        template,
+        {"request": request, "patients": patients, "total": total, "next_url": next_url, **context},
+    )
+
+
 # Route pour visualiser tous les patients
 @app.get("/view_patients", response_class=HTMLResponse)
 async def view_patients(
     request: Request,
     name: Optional[str] = None,
-    patient_id: Optional[str] = None):
-    # Récupérer tous les patients depuis la base de données
+    patient_id: Optional[str] = None,
+    cursor: Optional[str] = None):
+    # Récupérer les patients depuis la base de données
     query = {}
     if name:
-        query["name"] = {"$regex": name, "$options": "i"}
+        query = name_prefix_query(name)
+        if query is None:
+            # Filtre sans lettre ni chiffre ("!!!") : aucun patient, comme /search_patient
+            return templates.TemplateResponse(
+                "view_patients.html",
+                {"request": request, "patients": [], "total": 0, "next_url": None},
+            )
     if patient_id:
         try:
             query["_id"] = ObjectId(patient_id)
         except:
             raise HTTPException(status_code=400, detail="Invalid patient ID format")
 
-    patients = [
-        PatientViewModel(id=str(patient["_id"]), **patient)
-        for patient in db.patients.find(query)
-    ]
-    return templates.TemplateResponse(
-        "view_patients.html", {"request": request, "patients": patients}
-    )
+    return await render_patient_list(request, "view_patients.html", query, cursor)
 
 
 # Route pour visualiser tous les patients avec tumeur confirmé
 @app.get("/tumor", response_class=HTMLResponse)
-async def view_validates_patients( request: Request):
-
-    query={}
-
-    patients = [
-        PatientViewModel(id=str(patient["_id"]), **patient)
-        for patient in db.patients.find(query)
-    ]
-    return templates.TemplateResponse(
-        "tumor.html", {"request": request, "patients": patients}
-    )
+async def view_tumor_patients(request: Request, cursor: Optional[str] = None):
+    return await render_patient_list(request, "tumor.html", TUMOR_QUERY, cursor)
 
 
 # Route pour visualiser tous les patients confirmé sans tumeur 
 @app.get("/no_tumor", response_class=HTMLResponse)
-async def view_validates_patients( request: Request):
-
-    query={}
-
-    patients = [
-        PatientViewModel(id=str(patient["_id"]), **patient)
-        for patient in db.patients.find(query)
-    ]
-    return templates.TemplateResponse(
-        "no_tumor.html", {"request": request, "patients": patients}
-    )
+async def view_no_tumor_patients(request: Request, cursor: Optional[str] = None):
+    return await render_patient_list(request, "no_tumor.html", NO_TUMOR_QUERY, cursor)
 
 
 # Route pour visualiser tous les patients validés
 @app.get("/view_validates_patients", response_class=HTMLResponse)
-async def view_validates_patients( request: Request):
-
-    query={}
-
-    patients = [
-        PatientViewModel(id=str(patient["_id"]), **patient)
-        for patient in db.patients.find(query)
-    ]
-    return templates.TemplateResponse(
-        "view_validates_patients.html", {"request": request, "patients": patients}
+async def view_validates_patients(request: Request, cursor: Optional[str] = None):
+    return await render_patient_list(
+        request, "view_validates_patients.html", VALIDATED_QUERY, cursor
     )
 
 
 # Route pour visualiser tous les patients en attente de validation 
 @app.get("/view_waiting_patients", response_class=HTMLResponse)
-async def view_waiting_patients( request: Request):
-
-    query = {}
-
-    patients = [
-        PatientViewModel(id=str(patient["_id"]), **patient)
-        for patient in db.patients.find(query).sort("scanner.prediction.raw_confidence",-1)
-    ]
-    return templates.TemplateResponse(
-        "view_waiting_patients.html", {"request": request, "patients": patients}
+async def view_waiting_patients(request: Request, cursor: Optional[str] = None):
+    return await render_patient_list(
+        request,
+        "view_waiting_patients.html",
+        WAITING_QUERY,
+        cursor,
+        sort_field="scanner.prediction.raw_confidence",
+        direction=DESCENDING,
+        queue_depth=await queue_depth_async(db),
     )
 
 
@@ -216,7 +439,7 @@ async def view_waiting_patients( request: Request):
 @app.get("/edit_patient/{patient_id}", response_class=HTMLResponse)
 async def edit_patient(request: Request, patient_id: str):
     # Récupérer les informations du patient pour affichage dans le formulaire
-    patient_data = db.patients.find_one({"_id": ObjectId(patient_id)})
+    patient_data = await db.patients.find_one({"_id": ObjectId(patient_id)})
     if patient_data is not None:
         patient = PatientModel(**{str(k): v for k, v in patient_data.items()})
         return templates.TemplateResponse(
@@ -229,21 +452,165 @@ async def edit_patient(request: Request, patient_id: str):
 
 # To update mongoDB with new datas edited
 @app.post("/edit_patient/{patient_id}")
-async def edit_patient_post(patient_id: str, patient: PatientUpdateModel):
-    # Obtenir un dictionnaire des champs définis
-    updated_fields = {k: v for k, v in patient.model_dump().items() if v is not None}
-    if updated_fields.get('scanner'):
-        scanner_fields = updated_fields['scanner'].dict()
-        for key, value in scanner_fields.items():
-            updated_fields[f'scanner.{key}'] = value
-        del updated_fields['scanner']
+async def edit_patient_post(request: Request, patient_id: str, background_tasks: BackgroundTasks):
+    check_upload_size(request)
+    async with request.form(max_files=1, max_fields=MAX_FORM_FIELDS) as form:
+        patient = parse_patient_form(form, PatientUpdateModel)
+        # Obtenir un dictionnaire des champs définis
+        updated_fields = {
+            k: v for k, v in patient.model_dump().items() if v is not None and k != 'scanner'
+        }
+        if 'name' in updated_fields:
+            updated_fields.update(name_search_fields(updated_fields['name']))
+        unset_fields = {}
+        upload = uploaded_scan(form)
+        if upload is not None:
+            # Un nouveau scanner remplace l'ancien et sa prédiction
+            scanner_fields = await store_uploaded_scan(upload)
+            scanner_fields['scanner_name'] = upload.filename
+            scanner_fields['prediction'] = None
+            for key, value in scanner_fields.items():
+                updated_fields[f'scanner.{key}'] = value
+            unset_fields['scanner.scanner_img'] = ""
+            # Les doublons de l'ancien scanner ne valent plus : recalculés à l'ingestion
+            unset_fields['scanner.duplicates'] = ""
 
     # Mettre à jour uniquement les champs définis dans la base de données
-    db.patients.update_one({"_id": ObjectId(patient_id)}, {"$set": updated_fields})
+    update = {"$set": updated_fields}
+    if unset_fields:
+        update["$unset"] = unset_fields
+    if 'scanner.scan_id' in updated_fields:
+        before = await db.patients.find_one_and_update(
+            {"_id": ObjectId(patient_id)},
+            update,
+            projection={"scanner.prediction": 1},
+            return_document=ReturnDocument.BEFORE,
+        )
+        # La prédiction de l'ancien scanner ne compte plus dans les statistiques
+        if before is not None:
+            previous = (before.get("scanner") or {}).get("prediction")
+            await record_change(db, previous, None)
+        background_tasks.add_task(ingest_scan, patient_id)
+    else:
+        await db.patients.update_one({"_id": ObjectId(patient_id)}, update)
 
     return RedirectResponse(url="/view_patients")
 
 
+# Les scanners ne changent pas pour un même scan_id : une URL avec ?v=<scan_id> peut
+# être gardée en cache par le navigateur sans revalidation
+IMMUTABLE_CACHE = "private, max-age=31536000, immutable"
+REVALIDATE_CACHE = "private, no-cache"
+
+
+def etag_matches(request, etag):
+    """
+    Vérifie si l'en-tête If-None-Match de la requête contient l'ETag (comparaison faible,
+    comme le prévoit la RFC 9110 pour If-None-Match).
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+def cache_headers(etag, versioned):
+    return {"ETag": etag, "Cache-Control": IMMUTABLE_CACHE if versioned else REVALIDATE_CACHE}
+
+
+async def find_patient_scanner(patient_id):
+    try:
+        object_id = ObjectId(patient_id)
+    except InvalidId:
+        raise HTTPException(status_code=404, detail="Scan not found")
+    patient_data = await db.patients.find_one(
+        {"_id": object_id},
+        {"scanner.scan_id": 1, "scanner.scan_content_type": 1, "scanner.scanner_img": 1},
+    )
+    if patient_data is None or not patient_data.get("scanner"):
+        raise HTTPException(status_code=404, detail="Scan not found")
+    return patient_data["scanner"]
+
+
+# Route pour lire l'image du scanner d'un patient
+@app.get("/patients/{patient_id}/scan")
+async def patient_scan(request: Request, patient_id: str, v: Optional[str] = None):
+    scanner = await find_patient_scanner(patient_id)
+
+    scan_id = scanner.get("scan_id")
+    if scan_id:
+        # ETag fort : le scan_id est le hash SHA-256 du contenu
+        etag = f'"{scan_id}"'
+        headers = cache_headers(etag, v == scan_id)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+
+        # Envoyer le fichier GridFS chunk par chunk
+        try:
+            grid_out = await open_scan_async(db, scan_id)
+        except NoFile:
+            raise HTTPException(status_code=404, detail="Scan not found")
+
+        async def chunks():
+            while True:
+                chunk = await grid_out.readchunk()
+                if not chunk:
+                    break
+                yield chunk
+
+        return StreamingResponse(
+            chunks(),
+            media_type=scanner.get("scan_content_type") or "application/octet-stream",
+            headers={**headers, "Content-Length": str(grid_out.length)},
+        )
+
+    # Ancien format pas encore migré
+    image_data = await read_scan_buffer_async(db, scanner)
+    if image_data is None:
+        raise HTTPException(status_code=404, detail="Scan not found")
+    content = image_data.tobytes()
+    headers = cache_headers(f'"{hashlib.sha256(content).hexdigest()}"', False)
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    # Les anciens scanners ne stockent pas leur type : il est détecté dans les octets
+    return Response(content=content, media_type=sniff_content_type(content), headers=headers)
+
+
+# Route pour lire la miniature du scanner d'un patient (calculée à l'ingestion)
+@app.get("/patients/{patient_id}/thumbnail")
+async def patient_thumbnail(request: Request, patient_id: str, v: Optional[str] = None):
+    scanner = await find_patient_scanner(patient_id)
+
+    scan_id = scanner.get("scan_id")
+    if scan_id:
+        etag = f'"{scan_id}-{THUMBNAIL_SIZE}"'
+        headers = cache_headers(etag, v == scan_id)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+        thumbnail = await get_thumbnail_async(db, scan_id)
+    else:
+        thumbnail = None
+
+    if thumbnail is None:
+        # Scanner pas encore ingéré (ou ancien format) : calculer la miniature
+        image_data = await read_scan_buffer_async(db, scanner)
+        if image_data is None:
+            raise HTTPException(status_code=404, detail="Scan not found")
+        loop = asyncio.get_running_loop()
+        thumbnail = await loop.run_in_executor(None, make_thumbnail, image_data)
+        if thumbnail is None:
+            raise HTTPException(status_code=404, detail="Scan could not be decoded")
+        if scan_id:
+            await put_thumbnail_async(db, scan_id, thumbnail)
+        else:
+            headers = cache_headers(f'"{hashlib.sha256(thumbnail).hexdigest()}"', False)
+            if etag_matches(request, headers["ETag"]):
+                return Response(status_code=304, headers=headers)
+
+    return Response(content=thumbnail, media_type="image/jpeg", headers=headers)
+
+
 @app.get("/search_patient", response_class=JSONResponse)
 async def search_patient(patient_id: Optional[str] = None, name: Optional[str] = None):
     if not patient_id and not name:
@@ -257,9 +624,12 @@ async def search_patient(patient_id: Optional[str] = None, name: Optional[str] =
         except:
             raise HTTPException(status_code=400, detail="Invalid patient ID format")
     elif name:
-        query["name"] = {"$regex": name, "$options": "i"}
+        query = name_prefix_query(name)
+        if query is None:
+            raise HTTPException(status_code=404, detail="Patient not found")
 
-    patients = list(db.patients.find(query))
+    # Colonnes des listes seulement (pas l'image), et nombre de résultats limité
+    patients = await db.patients.aggregate(list_pipeline(query, limit=SEARCH_LIMIT)).to_list(None)
 
     if patients:
         for patient in patients:
@@ -270,29 +640,80 @@ async def search_patient(patient_id: Optional[str] = None, name: Optional[str] =
         raise HTTPException(status_code=404, detail="Patient not found")
 
 
+# Suggestions pour la barre de recherche (autocomplétion)
+@app.get("/patients/search", response_class=JSONResponse)
+async def search_patients(q: str, limit: int = 10, mode: str = "prefix"):
+    limit = max(1, min(limit, SEARCH_LIMIT))
+    if mode == "text":
+        if not SEARCH_TEXT_INDEX:
+            raise HTTPException(status_code=400, detail="Full-text search is not enabled")
+        score = {"$meta": "textScore"}
+        cursor = (
+            db.patients.find(name_text_query(q), {**SEARCH_PROJECTION, "score": score})
+            .sort([("score", score)])
+            .limit(limit)
+        )
+    elif mode == "prefix":
+        query = name_prefix_query(q)
+        if query is None:
+            return []
+        # Pas de tri dans MongoDB : la lecture s'arrête aux premiers résultats de l'index
+        cursor = db.patients.find(query, SEARCH_PROJECTION).limit(limit)
+    else:
+        raise HTTPException(status_code=400, detail="mode must be prefix or text")
+
+    patients = await cursor.to_list(None)
+    if mode == "prefix":
+        patients.sort(key=lambda patient: normalize_name(patient.get("name")))
+    return [
+        {
+            "id": str(patient["_id"]),
+            "name": patient.get("name"),
+            "age": patient.get("age"),
+            "gender": patient.get("gender"),
+        }
+        for patient in patients
+    ]
+
+
 # Route pour faire la prediction
 @app.get("/predict_patient/{patient_id}", response_class=HTMLResponse)
 async def predict_patient(request: Request, patient_id: str):
-    url = f"http://localhost:8000/predict/?patient_id={patient_id}"
-    prediction_result = requests.post(url)
+    try:
+        with stage("model_api"):
+            prediction_result = await model_api.post("/predict/", params={"patient_id": patient_id})
+    except httpx.HTTPError:
+        model_api_errors.inc("/predict/")
+        raise HTTPException(status_code=503, detail="Model API unavailable.")
     if prediction_result.status_code == 200:
         prediction_result = prediction_result.json()
         if prediction_result:
-            patient_data = db.patients.find_one({"_id": ObjectId(patient_id)})
+            with stage("find_patient"):
+                patient_data = await db.patients.find_one({"_id": ObjectId(patient_id)})
             if patient_data.get("scanner") and patient_data["scanner"].get("prediction") is None:
-                db.patients.update_one(
+                with stage("init_prediction"):
+                    await db.patients.update_one(
+                        {"_id": ObjectId(patient_id)},
+                        {"$set": {"scanner.prediction": {}}}
+                    )
+            prediction = {
+                "AI_predict": 'Tumor' if prediction_result["AI_predict"] == "yes" else 'No tumor',
+                "confidence": (1 - prediction_result["confidence"])*100 if prediction_result["AI_predict"] == "no" else prediction_result["confidence"]*100,
+                "raw_confidence": prediction_result["confidence"],
+                "prediction_date": prediction_result["prediction_date"],
+                "model_version": prediction_result.get("model_version")
+            }
+            with stage("update_prediction"):
+                before = await db.patients.find_one_and_update(
                     {"_id": ObjectId(patient_id)},
-                    {"$set": {"scanner.prediction": {}}}
+                    {"$set": {f"scanner.prediction.{key}": value for key, value in prediction.items()}},
+                    projection={"scanner.prediction": 1},
+                    return_document=ReturnDocument.BEFORE,
                 )
-            db.patients.update_one(
-                {"_id": ObjectId(patient_id)},
-                {"$set": {
-                    "scanner.prediction.AI_predict": 'Tumor' if prediction_result["AI_predict"] == "yes" else 'No tumor',
-                    "scanner.prediction.confidence": (1 - prediction_result["confidence"])*100 if prediction_result["AI_predict"] == "no" else prediction_result["confidence"]*100,
-                    "scanner.prediction.raw_confidence": prediction_result["confidence"],
-                    "scanner.prediction.prediction_date": prediction_result["prediction_date"]
-                }}
-            )
+            # Mettre à jour les statistiques avec le changement de prédiction
+            previous = ((before or {}).get("scanner") or {}).get("prediction") or {}
+            with stage("record_stats"):
+                await record_change(db, previous, {**previous, **prediction})
             return HTMLResponse(
                 content=f"<script>alert('Prediction successfull');</script><meta http-equiv='refresh' content='0;url=/full_view_patient/{patient_id}' />"
             )
@@ -302,8 +723,48 @@ async def predict_patient(request: Request, patient_id: str):
                 detail="Prediction failed. Please check if the image exists.",
             )
     else:
+        model_api_errors.inc("/predict/")
         raise HTTPException(status_code=500, detail="Prediction request failed.")
 
+# Route pour prédire tous les patients dont le scanner attend une prédiction
+@app.get("/predict_all_waiting", response_class=HTMLResponse)
+async def predict_all_waiting(request: Request):
+    query = {
+        "$or": [
+            {"scanner.scan_id": {"$type": "string"}},
+            {"scanner.scanner_img": {"$type": "string"}},
+        ],
+        "scanner.prediction.AI_predict": None,
+    }
+    patient_ids = [
+        str(patient["_id"])
+        async for patient in db.patients.find(query, {"_id": 1})
+    ]
+
+    # Envoyer les patients par lots à l'API du modèle
+    predicted = 0
+    for start in range(0, len(patient_ids), PREDICT_ALL_BATCH_SIZE):
+        chunk = patient_ids[start : start + PREDICT_ALL_BATCH_SIZE]
+        try:
+            with stage("model_api"):
+                prediction_result = await model_api.post(
+                    "/predict/batch",
+                    retries=0,
+                    timeout=httpx.Timeout(PREDICT_ALL_TIMEOUT, connect=5.0),
+                    json={"patient_ids": chunk},
+                )
+        except httpx.HTTPError:
+            model_api_errors.inc("/predict/batch")
+            raise HTTPException(status_code=503, detail="Model API unavailable.")
+        if prediction_result.status_code != 200:
+            model_api_errors.inc("/predict/batch")
+            raise HTTPException(status_code=500, detail="Prediction request failed.")
+        predicted += len(prediction_result.json()["predictions"])
+
+    return HTMLResponse(
+        content=f"<script>alert('{predicted} prediction(s) done');</script><meta http-equiv='refresh' content='0;url=/view_waiting_patients' />"
+    )
+
 # Route pour faire le check de la prediction
 @app.get("/check_predict", response_class=HTMLResponse)
 def check_predict(request: Request):
@@ -319,16 +780,21 @@ async def check_predict_post(patient_id: str, patient: PredictionModel):
         predict_check = patient.model_dump().get("predict_check")
         comment = patient.model_dump().get("comment")
         # Update patient data with check result and date
-        db.patients.update_one(
+        before = await db.patients.find_one_and_update(
             {"_id": ObjectId(patient_id)},
             {"$set": {
                 "scanner.prediction.predict_check": predict_check,
                 "scanner.prediction.predict_check_date": current_date
-            }}
+            }},
+            projection={"scanner.prediction": 1},
+            return_document=ReturnDocument.BEFORE,
         )
+        # Mettre à jour les statistiques avec la vérification de l'expert
+        previous = ((before or {}).get("scanner") or {}).get("prediction") or {}
+        await record_change(db, previous, {**previous, "predict_check": predict_check})
         # If 'no' is selected, also update the comment
         if predict_check == "no":
-            db.patients.update_one(
+            await db.patients.update_one(
                 {"_id": ObjectId(patient_id)},
                 {"$set": {
                     "scanner.prediction.comment": comment
@@ -343,28 +809,64 @@ async def check_predict_post(patient_id: str, patient: PredictionModel):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-def trigger_prediction(image_data: str):
+async def ingest_scan(patient_id: str):
+    # Faire calculer et stocker la région d'intérêt du scanner par l'API du modèle
+    try:
+        response = await model_api.post("/ingest/", params={"patient_id": patient_id})
+        if response.status_code != 200:
+            print(f"Ingest failed for patient {patient_id}: {response.text}")
+    except httpx.HTTPError as e:
+        print(f"Error: {e}")
+
+
+async def trigger_prediction(image_data: str):
     # Trigger prediction request to model API
-    model_api_url = "http://localhost:8000/predict/"
     files = {"file": ("image.jpg", image_data)}
     try:
-        response = requests.post(model_api_url, files=files)
+        response = await model_api.post("/predict/", files=files)
         if response.status_code == 200:
             prediction_result = response.json()
             return prediction_result
         else:
             return None
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Error: {e}")
         return None
 
+# Etat de la file des prédictions en arrière-plan
+@app.get("/queue/stats")
+async def queue_stats():
+    return JSONResponse(content=jsonable_encoder(await queue_stats_async(db)))
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    # Format texte de Prometheus. L'état de la file est lu au moment de la collecte.
+    try:
+        for status, count in (await jobs_by_status_async(db)).items():
+            prediction_jobs.set(count, status)
+    except PyMongoError as e:
+        print(f"Error reading the prediction queue: {e}")
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+
+async def send_feedback(data: dict):
+    # Transmettre le retour de l'expert à l'API du modèle, qui l'enregistre
+    try:
+        response = await model_api.post("/feedback/", json=data)
+        if response.status_code != 202:
+            print(f"Feedback failed for patient {data.get('patient_id')}: {response.text}")
+    except httpx.HTTPError as e:
+        print(f"Error: {e}")
+
+
 # Route pour voir le feedback des erreurs 
-@app.post("/feed_back")
-async def feed_back(request: Request):
+@app.post("/feed_back", status_code=202)
+async def feed_back(request: Request, background_tasks: BackgroundTasks):
     data = await request.json()
-    url = "http://localhost:8000/feedback/"
-
-    requests.post(url, json=data)
+    # Répondre tout de suite, l'envoi se fait après la réponse
+    background_tasks.add_task(send_feedback, data)
+    return {"status": "accepted"}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,61 @@
+import asyncio
+
+import httpx
+
+# Codes HTTP pour lesquels la requête est rejouée
+RETRY_STATUS_CODES = {502, 503, 504}
+
+
+class ModelApiClient:
+    """
+    Client HTTP partagé vers l'API du modèle : connexions réutilisées (pool),
+    timeouts et nouvelles tentatives en cas d'erreur réseau ou de 502/503/504.
+
+    Args:
+    - base_url: str, URL de l'API du modèle (ex: "http://localhost:8000")
+    - timeout: float, timeout en secondes d'une requête
+    - retries: int, nombre de nouvelles tentatives après un échec
+    - max_connections: int, taille maximale du pool de connexions
+    - transport: transport httpx optionnel (ex: httpx.ASGITransport pour appeler l'API
+      dans le même processus, dans les benchmarks)
+    """
+
+    def __init__(self, base_url, timeout=30.0, retries=2, max_connections=100, transport=None):
+        self.retries = retries
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(timeout, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections // 5 or 1,
+            ),
+            transport=transport,
+        )
+
+    async def post(self, path, retries=None, **kwargs):
+        """
+        Envoie une requête POST, rejouée en cas d'erreur réseau ou de 502/503/504.
+
+        Args:
+        - path: str, chemin de l'endpoint
+        - retries: int, nombre de nouvelles tentatives pour cet appel (défaut: celui du client).
+          0 pour les appels longs qui ne doivent pas être rejoués (ex: /predict/batch)
+        - kwargs: arguments passés à httpx (json, params, files, timeout...)
+
+        Returns:
+        - httpx.Response, la réponse de la dernière tentative
+        """
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                response = await self._client.post(path, **kwargs)
+                if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                    return response
+            except httpx.TransportError:
+                if attempt == retries:
+                    raise
+            # Attendre un peu plus à chaque tentative
+            await asyncio.sleep(0.2 * 2**attempt)
+
+    async def aclose(self):
+        await self._client.aclose()
@@ -0,0 +1,262 @@
+import base64
+import binascii
+import json
+import re
+import unicodedata
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ASCENDING, DESCENDING, TEXT, UpdateOne
+
+# Colonnes affichées dans les tableaux de patients (jamais l'image)
+LIST_PROJECTION = {
+    "name": 1,
+    "age": 1,
+    "gender": 1,
+    "scanner.scan_id": 1,
+    "scanner.scanner_name": 1,
+    "scanner.prediction": 1,
+    "scanner.legacy_scan": 1,
+}
+
+# Ancien format (image base64 dans scanner_img) : seul ce booléen est renvoyé, pas l'image.
+# Vrai pour une chaîne non vide, comme le validateur de ScannerModel
+LEGACY_SCAN_EXPRESSION = {"$gt": ["$scanner.scanner_img", ""]}
+
+# Tumeur confirmée : l'IA et l'expert sont d'accord sur "Tumor", ou l'expert contredit "No tumor"
+TUMOR_QUERY = {
+    "$or": [
+        {"scanner.prediction.AI_predict": "Tumor", "scanner.prediction.predict_check": "Yes"},
+        {"scanner.prediction.AI_predict": "No tumor", "scanner.prediction.predict_check": "No"},
+    ]
+}
+
+# Absence de tumeur confirmée
+NO_TUMOR_QUERY = {
+    "$or": [
+        {"scanner.prediction.AI_predict": "No tumor", "scanner.prediction.predict_check": "Yes"},
+        {"scanner.prediction.AI_predict": "Tumor", "scanner.prediction.predict_check": "No"},
+    ]
+}
+
+# Prédiction vérifiée par un expert
+VALIDATED_QUERY = {"scanner.prediction.predict_check": {"$ne": None}}
+
+# Prédiction faite, en attente de vérification. Même condition que le compteur "waiting"
+# de patient_stats, sans condition sur le stockage du scanner : les anciens patients
+# (image base64 dans scanner_img, sans scan_id) restent listés
+WAITING_QUERY = {
+    "scanner.prediction.AI_predict": {"$in": ["Tumor", "No tumor"]},
+    "scanner.prediction.predict_check": {"$nin": ["Yes", "No"]},
+}
+
+
+# Colonnes renvoyées par la recherche de patients
+SEARCH_PROJECTION = {"name": 1, "age": 1, "gender": 1}
+
+
+def normalize_name(name):
+    """
+    Forme du nom utilisée pour la recherche : sans accents, en minuscules, espaces réduits.
+    """
+    decomposed = unicodedata.normalize("NFKD", name or "")
+    without_accents = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(without_accents.casefold().split())
+
+
+def name_search_fields(name):
+    """
+    Champs de recherche à enregistrer avec le nom d'un patient.
+
+    Returns:
+    - dict, name_search (nom normalisé) et name_tokens (mots du nom normalisé)
+    """
+    normalized = normalize_name(name)
+    return {"name_search": normalized, "name_tokens": normalized.split()}
+
+
+def name_prefix_query(text):
+    """
+    Filtre des patients dont un mot du nom commence par chaque mot de text
+    ("jea dup" trouve "Jean Dupont" et "Dupont Jean").
+
+    Les regex ancrées (^) sur le champ normalisé utilisent l'index name_tokens.
+    """
+    tokens = normalize_name(text).split()
+    if not tokens:
+        return None
+    clauses = [{"name_tokens": re.compile("^" + re.escape(token))} for token in tokens]
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def name_text_query(text):
+    # Recherche plein texte (mots entiers), si l'index texte a été créé
+    return {"$text": {"$search": normalize_name(text)}}
+
+
+async def backfill_name_search(db, batch_size=1000):
+    """
+    Ajoute les champs de recherche aux patients enregistrés avant leur création.
+
+    Returns:
+    - int, nombre de patients mis à jour
+    """
+    updated = 0
+    while True:
+        patients = await (
+            db.patients.find({"name_search": {"$exists": False}}, {"name": 1})
+            .limit(batch_size)
+        ).to_list(None)
+        if not patients:
+            return updated
+        operations = [
+            UpdateOne(
+                {"_id": patient["_id"]},
+                {"$set": name_search_fields(patient.get("name"))},
+            )
+            for patient in patients
+        ]
+        await db.patients.bulk_write(operations, ordered=False)
+        updated += len(patients)
+
+
+async def ensure_indexes(db, text_index=False):
+    """
+    Crée les index utilisés par les listes de patients (sans effet s'ils existent déjà).
+
+    Args:
+    - text_index: bool, créer aussi l'index texte de la recherche plein texte
+    """
+    await db.patients.create_index(
+        [("name_tokens", ASCENDING), ("_id", ASCENDING)], name="name_tokens"
+    )
+    await db.patients.create_index(
+        [("name_search", ASCENDING), ("_id", ASCENDING)], name="name_search"
+    )
+    if text_index:
+        # Langue "none" : pas de racinisation ni de mots vides sur des noms propres
+        await db.patients.create_index(
+            [("name_search", TEXT)], name="name_text", default_language="none"
+        )
+    await db.patients.create_index(
+        [
+            ("scanner.prediction.AI_predict", ASCENDING),
+            ("scanner.prediction.predict_check", ASCENDING),
+            ("_id", ASCENDING),
+        ],
+        name="prediction_check",
+    )
+    await db.patients.create_index(
+        [("scanner.prediction.predict_check", ASCENDING), ("_id", ASCENDING)],
+        name="check",
+    )
+    await db.patients.create_index(
+        [
+            ("scanner.prediction.predict_check", ASCENDING),
+            ("scanner.prediction.raw_confidence", DESCENDING),
+            ("_id", DESCENDING),
+        ],
+        name="waiting_by_confidence",
+    )
+    # Patients qui ont le même scanner (doublons signalés à l'ingestion)
+    await db.patients.create_index([("scanner.scan_id", ASCENDING)], name="scan_id")
+
+
+def list_pipeline(query, sort=None, limit=None):
+    """
+    Pipeline d'agrégation des tableaux de patients : filtre, tri et limite, puis colonnes
+    de LIST_PROJECTION (avec scanner.legacy_scan, calculé sur les documents renvoyés).
+
+    Args:
+    - query: dict, filtre MongoDB
+    - sort: list de (champ, direction), ou None
+    - limit: int, nombre maximal de documents, ou None
+    """
+    pipeline = [{"$match": query}]
+    if sort:
+        pipeline.append({"$sort": dict(sort)})
+    if limit:
+        pipeline.append({"$limit": limit})
+    pipeline.append({"$addFields": {"scanner.legacy_scan": LEGACY_SCAN_EXPRESSION}})
+    pipeline.append({"$project": LIST_PROJECTION})
+    return pipeline
+
+
+def _get_field(doc, field):
+    for key in field.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+    return doc
+
+
+def encode_cursor(doc, sort_field=None):
+    value = _get_field(doc, sort_field) if sort_field else None
+    payload = json.dumps([value, str(doc["_id"])])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Returns:
+    - tuple, (valeur du champ de tri, ObjectId du dernier patient de la page)
+
+    Raises:
+    - ValueError si le curseur est invalide
+    """
+    try:
+        value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return value, ObjectId(last_id)
+    except (binascii.Error, ValueError, TypeError, InvalidId):
+        raise ValueError("Invalid cursor")
+
+
+async def paginate(collection, query, cursor=None, limit=50, sort_field=None, direction=ASCENDING):
+    """
+    Pagination par curseur : la page suivante reprend après le dernier document vu,
+    sans skip, pour que le coût d'une page ne dépende pas de sa position.
+
+    Args:
+    - collection: collection MongoDB (motor)
+    - query: dict, filtre MongoDB
+    - cursor: str, curseur renvoyé par la page précédente
+    - limit: int, nombre de documents par page
+    - sort_field: str, champ de tri (en plus de _id, qui départage les égalités)
+    - direction: ASCENDING ou DESCENDING
+
+    Returns:
+    - tuple, (documents, curseur de la page suivante ou None, nombre total de documents)
+    """
+    total = await collection.count_documents(query)
+
+    page_query = dict(query)
+    if cursor:
+        value, last_id = decode_cursor(cursor)
+        after = "$gt" if direction == ASCENDING else "$lt"
+        if sort_field and value is not None:
+            following = [
+                {sort_field: {after: value}},
+                {sort_field: value, "_id": {after: last_id}},
+            ]
+            # En tri décroissant, les valeurs nulles viennent après toutes les autres
+            if direction == DESCENDING:
+                following.append({sort_field: None})
+            page_query = {"$and": [query, {"$or": following}]}
+        elif sort_field:
+            page_query = {"$and": [query, {sort_field: None, "_id": {after: last_id}}]}
+        else:
+            page_query = {"$and": [query, {"_id": {after: last_id}}]}
+
+    sort = [(sort_field, direction)] if sort_field else []
+    sort.append(("_id", direction))
+
+    # Lire un document de plus pour savoir s'il y a une page suivante
+    documents = await collection.aggregate(
+        list_pipeline(page_query, sort, limit + 1)
+    ).to_list(None)
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = encode_cursor(documents[-1], sort_field)
+
+    return documents, next_cursor, total
@@ -0,0 +1,234 @@
+"""
+Statistiques des prédictions, pour la page d'accueil.
+
+Les compteurs sont stockés dans la collection patient_stats : un document "overview",
+et un document "model:<version>" par version du modèle. Ils sont mis à jour par $inc à
+chaque prédiction, vérification ou remplacement de scanner fait depuis l'interface, et
+recalculés en entier par une agrégation $facet (au démarrage, puis toutes les
+STATS_REFRESH_SECONDS).
+
+Les écritures faites hors de l'interface ne mettent pas les compteurs à jour : les
+prédictions de POST /predict/batch (bouton "prédire tout" et workers de
+common/prediction_worker.py) et les patients ajoutés par common/import_patients.py
+n'apparaissent qu'après le recalcul suivant.
+"""
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+STATS_COLLECTION = "patient_stats"
+OVERVIEW_ID = "overview"
+UNKNOWN_VERSION = "unknown"
+
+OVERVIEW_COUNTERS = [
+    "predicted",
+    "ai_tumor",
+    "ai_no_tumor",
+    "waiting",
+    "validated",
+    "agreed",
+    "disagreed",
+    "confirmed_tumor",
+    "confirmed_no_tumor",
+]
+MODEL_COUNTERS = ["predicted", "validated", "agreed"]
+
+
+def model_stats_id(version):
+    return f"model:{version or UNKNOWN_VERSION}"
+
+
+def stat_counters(prediction):
+    """
+    Compteurs auxquels contribue un patient, selon sa prédiction.
+
+    Returns:
+    - dict {_id du document de statistiques: {compteur: 1}}
+    """
+    prediction = prediction or {}
+    ai_predict = prediction.get("AI_predict")
+    if ai_predict not in ("Tumor", "No tumor"):
+        return {}
+
+    overview = {"predicted": 1, "ai_tumor" if ai_predict == "Tumor" else "ai_no_tumor": 1}
+    model = {"predicted": 1}
+    predict_check = prediction.get("predict_check")
+    if predict_check in ("Yes", "No"):
+        agreed = predict_check == "Yes"
+        tumor = (ai_predict == "Tumor") == agreed
+        overview["validated"] = 1
+        overview["agreed" if agreed else "disagreed"] = 1
+        overview["confirmed_tumor" if tumor else "confirmed_no_tumor"] = 1
+        model["validated"] = 1
+        if agreed:
+            model["agreed"] = 1
+    else:
+        overview["waiting"] = 1
+
+    return {OVERVIEW_ID: overview, model_stats_id(prediction.get("model_version")): model}
+
+
+async def record_change(db, before, after):
+    """
+    Met à jour les compteurs après le changement de prédiction d'un patient.
+
+    Args:
+    - before: dict, prédiction avant l'écriture (ou None)
+    - after: dict, prédiction après l'écriture (ou None)
+    """
+    delta = {}
+    for sign, prediction in ((-1, before), (1, after)):
+        for stats_id, counters in stat_counters(prediction).items():
+            for name, value in counters.items():
+                key = (stats_id, name)
+                delta[key] = delta.get(key, 0) + sign * value
+
+    increments = {}
+    for (stats_id, name), value in delta.items():
+        if value:
+            increments.setdefault(stats_id, {})[name] = value
+    if not increments:
+        return
+
+    await db[STATS_COLLECTION].bulk_write(
+        [
+            UpdateOne({"_id": stats_id}, {"$inc": counters}, upsert=True)
+            for stats_id, counters in increments.items()
+        ],
+        ordered=False,
+    )
+
+
+def _sum_if(condition):
+    return {"$sum": {"$cond": [condition, 1, 0]}}
+
+
+_AI_TUMOR = {"$eq": ["$scanner.prediction.AI_predict", "Tumor"]}
+_CHECKED = {"$in": ["$scanner.prediction.predict_check", ["Yes", "No"]]}
+_AGREED = {"$eq": ["$scanner.prediction.predict_check", "Yes"]}
+_DISAGREED = {"$eq": ["$scanner.prediction.predict_check", "No"]}
+
+# Une seule lecture des patients prédits pour tous les compteurs
+STATS_PIPELINE = [
+    {"$match": {"scanner.prediction.AI_predict": {"$in": ["Tumor", "No tumor"]}}},
+    {
+        "$facet": {
+            "overview": [
+                {
+                    "$group": {
+                        "_id": None,
+                        "predicted": {"$sum": 1},
+                        "ai_tumor": _sum_if(_AI_TUMOR),
+                        "ai_no_tumor": _sum_if({"$not": _AI_TUMOR}),
+                        "waiting": _sum_if({"$not": _CHECKED}),
+                        "validated": _sum_if(_CHECKED),
+                        "agreed": _sum_if(_AGREED),
+                        "disagreed": _sum_if(_DISAGREED),
+                        "confirmed_tumor": _sum_if(
+                            {"$or": [
+                                {"$and": [_AI_TUMOR, _AGREED]},
+                                {"$and": [{"$not": _AI_TUMOR}, _DISAGREED]},
+                            ]}
+                        ),
+                        "confirmed_no_tumor": _sum_if(
+                            {"$or": [
+                                {"$and": [{"$not": _AI_TUMOR}, _AGREED]},
+                                {"$and": [_AI_TUMOR, _DISAGREED]},
+                            ]}
+                        ),
+                    }
+                }
+            ],
+            "by_model": [
+                {
+                    "$group": {
+                        "_id": {
+                            "$ifNull": ["$scanner.prediction.model_version", UNKNOWN_VERSION]
+                        },
+                        "predicted": {"$sum": 1},
+                        "validated": _sum_if(_CHECKED),
+                        "agreed": _sum_if(_AGREED),
+                    }
+                }
+            ],
+        }
+    },
+]
+
+
+async def refresh_stats(db):
+    """
+    Recalcule tous les compteurs avec l'agrégation $facet et les enregistre.
+    """
+    result = await db.patients.aggregate(STATS_PIPELINE).to_list(None)
+    facets = result[0] if result else {"overview": [], "by_model": []}
+    refreshed_at = datetime.now()
+
+    overview = facets["overview"][0] if facets["overview"] else {}
+    operations = [
+        UpdateOne(
+            {"_id": OVERVIEW_ID},
+            {"$set": {
+                **{name: overview.get(name, 0) for name in OVERVIEW_COUNTERS},
+                "refreshed_at": refreshed_at,
+            }},
+            upsert=True,
+        )
+    ]
+    for model in facets["by_model"]:
+        operations.append(
+            UpdateOne(
+                {"_id": model_stats_id(model["_id"])},
+                {"$set": {
+                    **{name: model[name] for name in MODEL_COUNTERS},
+                    "refreshed_at": refreshed_at,
+                }},
+                upsert=True,
+            )
+        )
+    await db[STATS_COLLECTION].bulk_write(operations, ordered=False)
+    # Versions qui n'ont plus de patients
+    versions = [model_stats_id(model["_id"]) for model in facets["by_model"]]
+    await db[STATS_COLLECTION].delete_many(
+        {"_id": {"$regex": "^model:", "$nin": versions}}
+    )
+
+
+def _rate(numerator, denominator):
+    return round(numerator / denominator, 4) if denominator else None
+
+
+async def get_stats(db, total_patients=None):
+    """
+    Lit les compteurs (quelques petits documents, quel que soit le nombre de patients).
+
+    Returns:
+    - dict, compteurs globaux, taux d'accord IA / expert, et détail par version du modèle
+    """
+    documents = await db[STATS_COLLECTION].find({}).to_list(None)
+    overview = {name: 0 for name in OVERVIEW_COUNTERS}
+    refreshed_at = None
+    models = []
+    for document in documents:
+        if document["_id"] == OVERVIEW_ID:
+            overview.update({name: document.get(name, 0) for name in OVERVIEW_COUNTERS})
+            refreshed_at = document.get("refreshed_at")
+        elif document.get("predicted"):
+            models.append(
+                {
+                    "model_version": document["_id"][len("model:"):],
+                    **{name: document.get(name, 0) for name in MODEL_COUNTERS},
+                    "agreement_rate": _rate(
+                        document.get("agreed", 0), document.get("validated", 0)
+                    ),
+                }
+            )
+    models.sort(key=lambda model: model["predicted"], reverse=True)
+
+    return {
+        "patients": total_patients,
+        **overview,
+        "agreement_rate": _rate(overview["agreed"], overview["validated"]),
+        "by_model": models,
+        "refreshed_at": refreshed_at,
+    }
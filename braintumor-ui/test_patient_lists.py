@@ -0,0 +1,101 @@
+import asyncio
+import base64
+import os
+import sys
+import types
+
+import pytest
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+UI_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, UI_DIR)
+# app.py lit MONGO_URI dans hidden.py, absent du dépôt : la base est remplacée ci-dessous
+sys.modules.setdefault("hidden", types.SimpleNamespace(MONGO_URI="mongodb://localhost:27017"))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import app as ui  # noqa: E402
+from patient_queries import WAITING_QUERY, paginate  # noqa: E402
+
+PNG = base64.b64encode(b"\x89PNG\r\n\x1a\n").decode()
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.chdir(UI_DIR)
+    database = mongomock_motor.AsyncMongoMockClient()["braintumor"]
+    monkeypatch.setattr(ui, "db", database)
+    return database
+
+
+def waiting_prediction(confidence):
+    return {
+        "AI_predict": "Tumor",
+        "confidence": confidence,
+        "raw_confidence": confidence,
+        "predict_check": None,
+    }
+
+
+@pytest.fixture
+def patients(db):
+    raw = db._AsyncMongoMockDatabase__database
+    raw.patients.insert_many(
+        [
+            {
+                "name": "Legacy Patient",
+                "age": 50,
+                "gender": "female",
+                "scanner": {"scanner_img": PNG, "prediction": waiting_prediction(0.9)},
+            },
+            {
+                "name": "Stored Patient",
+                "age": 40,
+                "gender": "male",
+                "scanner": {"scan_id": "a" * 64, "prediction": waiting_prediction(0.8)},
+            },
+            {"name": "No Scan", "age": 30, "gender": "male"},
+        ]
+    )
+
+
+def test_list_flags_legacy_scan_without_the_image(db, patients):
+    documents, _, total = asyncio.run(paginate(db.patients, WAITING_QUERY))
+    assert total == 2
+    legacy = next(doc for doc in documents if doc["name"] == "Legacy Patient")
+    assert legacy["scanner"]["legacy_scan"] is True
+    assert "scanner_img" not in legacy["scanner"]
+
+
+def test_waiting_list_shows_legacy_patient(db, patients):
+    response = TestClient(ui.app).get("/view_waiting_patients")
+    assert response.status_code == 200
+    assert "Legacy Patient" in response.text
+    assert "Stored Patient" in response.text
+
+
+def test_patient_list_shows_legacy_scan(db, patients):
+    response = TestClient(ui.app).get("/view_patients")
+    assert response.status_code == 200
+    row = response.text.split("Legacy Patient", 1)[1].split("</tr>", 1)[0]
+    assert "Waiting scanner" not in row
+
+
+def test_legacy_scan_is_sent_with_its_content_type(db):
+    raw = db._AsyncMongoMockDatabase__database
+    jpeg = base64.b64encode(b"\xff\xd8\xff\xe0 legacy jpeg").decode()
+    patient_id = raw.patients.insert_one(
+        {"name": "Jpeg Patient", "scanner": {"scanner_img": jpeg}}
+    ).inserted_id
+    response = TestClient(ui.app).get(f"/patients/{patient_id}/scan")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/jpeg"
+
+
+@pytest.mark.parametrize("name", ["!!!", "   "])
+def test_empty_name_filter_lists_nobody(db, patients, name):
+    response = TestClient(ui.app).get("/view_patients", params={"name": name})
+    assert response.status_code == 200
+    assert "Stored Patient" not in response.text
+    assert "0 patient(s)" in response.text
@@ -0,0 +1,170 @@
+"""
+Retours des experts sur les prédictions, stockés dans la collection MongoDB feedback.
+
+Un document par retour : patient, scanner, version du modèle, prédiction de l'IA, avis
+de l'expert et label qui s'en déduit (voir common.labels.expert_label).
+"""
+import asyncio
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from common.labels import expert_label
+
+FEEDBACK_COLLECTION = "feedback"
+
+
+async def ensure_feedback_indexes(db):
+    """
+    Crée les index de la collection feedback (sans effet s'ils existent déjà). Pour une
+    base motor.
+    """
+    feedback = db[FEEDBACK_COLLECTION]
+    await feedback.create_index(
+        [("patient_id", ASCENDING), ("created_at", DESCENDING)], name="patient"
+    )
+    await feedback.create_index(
+        [("model_version", ASCENDING), ("created_at", DESCENDING)], name="model_version"
+    )
+    await feedback.create_index([("scan_id", ASCENDING)], name="scan")
+    # Export des retours, du plus récent au plus ancien
+    await feedback.create_index([("created_at", DESCENDING)], name="created_at")
+
+
+def feedback_document(patient_id, scanner, ai_predict, expert_opinion, comment=None):
+    """
+    Construit le document d'un retour.
+
+    Args:
+    - patient_id: str, _id du patient
+    - scanner: dict, sous-document "scanner" du patient (scan_id et prediction), ou {}
+    - ai_predict: str, prédiction affichée à l'expert ("Tumor" ou "No tumor")
+    - expert_opinion: str, avis de l'expert ("Yes" s'il confirme, "No" sinon)
+    - comment: str, commentaire de l'expert
+    """
+    prediction = scanner.get("prediction") or {}
+    return {
+        "patient_id": patient_id,
+        "scan_id": scanner.get("scan_id"),
+        "model_version": prediction.get("model_version"),
+        "AI_predict": ai_predict,
+        "confidence": prediction.get("confidence"),
+        "expert_opinion": expert_opinion,
+        "label": expert_label({"AI_predict": ai_predict, "predict_check": expert_opinion}),
+        "comment": comment,
+        "created_at": datetime.now(),
+    }
+
+
+class FeedbackBuffer:
+    """
+    Écriture groupée des retours : les documents sont insérés par lots, quand le lot
+    est plein ou au plus tard flush_interval secondes après le premier retour.
+
+    Si l'écriture échoue, le lot est gardé et réessayé à l'écriture suivante (au plus
+    max_pending documents sont gardés).
+
+    Args:
+    - collection: collection motor
+    - max_batch_size: int, nombre de documents déclenchant une écriture
+    - flush_interval: float, délai maximal en secondes avant l'écriture d'un retour
+    - max_pending: int, nombre maximal de documents en attente
+    """
+
+    def __init__(self, collection, max_batch_size=100, flush_interval=2.0, max_pending=10000):
+        self.collection = collection
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = []
+        self._full = None
+        self._task = None
+        self.written = 0
+        self.dropped = 0
+
+    async def start(self):
+        self._full = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Écrire ce qui reste avant l'arrêt
+        await self.flush()
+
+    def add(self, document):
+        self._pending.append(document)
+        if len(self._pending) > self.max_pending:
+            # Base indisponible depuis longtemps : abandonner les plus anciens
+            overflow = len(self._pending) - self.max_pending
+            del self._pending[:overflow]
+            self.dropped += overflow
+            print(f"Feedback buffer full, {overflow} document(s) dropped")
+        if len(self._pending) >= self.max_batch_size and self._full is not None:
+            self._full.set()
+
+    async def flush(self):
+        while self._pending:
+            batch = self._pending[: self.max_batch_size]
+            del self._pending[: len(batch)]
+            try:
+                await self.collection.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                # Documents refusés : 11000 = déjà écrits lors d'un essai précédent
+                errors = [err for err in e.details["writeErrors"] if err["code"] != 11000]
+                if errors:
+                    print(f"{len(errors)} feedback document(s) rejected: {errors[0]['errmsg']}")
+                self.written += len(batch) - len(errors)
+                self.dropped += len(errors)
+                continue
+            except PyMongoError as e:
+                print(f"Error writing {len(batch)} feedback document(s): {e}")
+                self._pending[:0] = batch
+                return
+            self.written += len(batch)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+
+def iter_feedback(db, model_version=None, since=None, batch_size=500):
+    """
+    Parcourt les retours, du plus récent au plus ancien, sans tout charger en mémoire.
+    Pour une base pymongo.
+
+    Args:
+    - model_version: str, ne garder que les retours sur les prédictions de ce modèle
+    - since: datetime, ne garder que les retours postérieurs
+    """
+    query = {"label": {"$ne": None}}
+    if model_version is not None:
+        query["model_version"] = model_version
+    if since is not None:
+        query["created_at"] = {"$gte": since}
+    cursor = (
+        db[FEEDBACK_COLLECTION]
+        .find(query)
+        .sort([("created_at", DESCENDING), ("_id", DESCENDING)])
+        .batch_size(batch_size)
+    )
+    for document in cursor:
+        yield document
@@ -0,0 +1,457 @@
+"""
+Importe en masse des patients et leurs scanners, à partir d'un manifeste ou d'un dossier.
+
+Usage (depuis la racine du dépôt) :
+    python -m common.import_patients --manifest hopital_a/patients.csv --ingest --queue-predictions
+    python -m common.import_patients --directory hopital_b/ --source hopital_b --ingest --resume
+
+Manifeste CSV (avec une ligne d'en-tête) ou NDJSON (un objet JSON par ligne), avec les
+champs name, age, gender, scan (chemin du scanner, relatif au manifeste, facultatif) et
+external_id (identifiant du patient dans l'hôpital, facultatif). Dans un dossier, chaque
+image JPEG ou PNG est le scanner d'un patient, décrit par un fichier JSON du même nom
+(scan_0001.png et scan_0001.json).
+
+Les fichiers sont lus et hachés en parallèle pendant l'écriture du lot précédent. Un
+même contenu n'est stocké qu'une fois dans GridFS. Les scanners et les patients sont
+écrits par lots (insert_many non ordonnés). Chaque patient importé porte une clé
+import_key unique ("<source>:<external_id ou numéro de ligne>") : relancer l'import, ou
+le reprendre avec --resume après une interruption, ne crée pas de doublon.
+
+Les scanners importés ne passent pas par l'envoi de l'interface : avec --ingest, chaque
+patient du lot est envoyé à POST /ingest/ de l'API du modèle (--model-api-url), qui
+calcule la ROI, la miniature et le hash perceptuel et signale les doublons. Sans
+--ingest, ou pour les patients dont l'ingestion a échoué, relancer le même import avec
+--ingest : les patients déjà importés sont ingérés à leur tour (l'ingestion ne recalcule
+pas ce qui existe déjà).
+"""
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import httpx
+from bson import ObjectId
+from pymongo import ASCENDING, MongoClient
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../braintumor-ui")))
+
+from common.prediction_queue import PRIORITY_LOW, enqueue_many  # noqa: E402
+from common.scan_store import (  # noqa: E402
+    UPLOAD_CONTENT_TYPES,
+    ensure_scan_indexes,
+    insert_many_ignoring_duplicates,
+    put_scans_bulk,
+    sniff_content_type,
+)
+from patient_queries import name_search_fields  # noqa: E402
+
+MAX_SCAN_BYTES = int(os.environ.get("MAX_SCAN_BYTES", 50 * 1024 * 1024))
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 4))
+SCAN_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+class InvalidRecord(ValueError):
+    """Ligne du manifeste refusée (champ manquant ou invalide, scanner illisible)."""
+
+
+def manifest_records(path):
+    """
+    Lit un manifeste CSV ou NDJSON, sans le charger en entier.
+
+    Yields:
+    - dict, champs du patient ; le chemin du scanner est rendu absolu
+    """
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.lower().endswith(".csv"):
+            rows = csv.DictReader(f)
+        else:
+            rows = (_json_row(line) for line in f if line.strip())
+        for row in rows:
+            if row.get("scan"):
+                row["scan"] = os.path.join(base_dir, row["scan"])
+            yield row
+
+
+def _json_row(line):
+    try:
+        row = json.loads(line)
+    except ValueError:
+        return {"invalid": "malformed JSON line"}
+    return row if isinstance(row, dict) else {"invalid": "not a JSON object"}
+
+
+def directory_records(directory):
+    """
+    Un patient par image du dossier (parcouru récursivement, dans un ordre stable),
+    décrit par le fichier JSON du même nom.
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            stem, extension = os.path.splitext(name)
+            if extension.lower() not in SCAN_EXTENSIONS:
+                continue
+            try:
+                with open(os.path.join(root, f"{stem}.json"), encoding="utf-8") as f:
+                    row = json.load(f)
+            except (OSError, ValueError):
+                row = {}
+            row["scan"] = os.path.join(root, name)
+            yield row
+
+
+def patient_fields(row):
+    if row.get("invalid"):
+        raise InvalidRecord(row["invalid"])
+    name = str(row.get("name") or "").strip()
+    gender = str(row.get("gender") or "").strip()
+    if not name:
+        raise InvalidRecord("missing name")
+    if not gender:
+        raise InvalidRecord("missing gender")
+    try:
+        age = int(row.get("age"))
+    except (TypeError, ValueError):
+        raise InvalidRecord(f"invalid age {row.get('age')!r}")
+    return {"name": name, "age": age, "gender": gender, **name_search_fields(name)}
+
+
+def load_record(row, max_scan_bytes=MAX_SCAN_BYTES):
+    """
+    Valide une ligne, puis lit et hache son scanner. Appelé dans les threads du pool.
+
+    Returns:
+    - (champs du patient, (scan_id, contenu, nom du fichier, type MIME) ou None)
+    """
+    patient = patient_fields(row)
+    path = row.get("scan")
+    if not path:
+        return patient, None
+    try:
+        if os.path.getsize(path) > max_scan_bytes:
+            raise InvalidRecord(f"scan larger than {max_scan_bytes} bytes")
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError as e:
+        raise InvalidRecord(f"unreadable scan: {e}")
+    content_type = sniff_content_type(data)
+    if content_type not in UPLOAD_CONTENT_TYPES:
+        raise InvalidRecord("scan must be a JPEG or PNG image")
+    return patient, (hashlib.sha256(data).hexdigest(), data, os.path.basename(path), content_type)
+
+
+def ensure_import_indexes(db):
+    ensure_scan_indexes(db)
+    # Un patient importé n'est créé qu'une fois, même si l'import est relancé
+    db.patients.create_index(
+        [("import_key", ASCENDING)],
+        name="import_key",
+        unique=True,
+        partialFilterExpression={"import_key": {"$type": "string"}},
+    )
+
+
+class ImportStats:
+    def __init__(self, **counts):
+        self.rows = counts.get("rows", 0)
+        self.imported = counts.get("imported", 0)
+        self.already_imported = counts.get("already_imported", 0)
+        self.invalid = counts.get("invalid", 0)
+        self.scans_written = counts.get("scans_written", 0)
+        self.scans_deduplicated = counts.get("scans_deduplicated", 0)
+        self.jobs_queued = counts.get("jobs_queued", 0)
+        self.ingested = counts.get("ingested", 0)
+        self.ingest_failed = counts.get("ingest_failed", 0)
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+def ingest_patient(model_api, patient_id):
+    """
+    Returns:
+    - str, erreur de l'ingestion, ou None si elle a réussi
+    """
+    try:
+        response = model_api.post("/ingest/", params={"patient_id": patient_id})
+    except httpx.HTTPError as e:
+        return f"Model API error: {e}"
+    if response.is_error:
+        return f"{response.status_code} {response.text[:200]}"
+    return None
+
+
+def ingest_patients(model_api, patient_ids, workers=INGEST_WORKERS):
+    """
+    Ingère les scanners de patients en parallèle (POST /ingest/ de l'API du modèle).
+
+    Returns:
+    - int, nombre d'ingestions en échec (chacune est affichée)
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        errors = executor.map(lambda patient_id: ingest_patient(model_api, patient_id), patient_ids)
+        failed = 0
+        for patient_id, error in zip(patient_ids, errors):
+            if error is not None:
+                print(f"Ingestion du patient {patient_id} en échec : {error}")
+                failed += 1
+    return failed
+
+
+def write_batch(db, source, loaded, queue_predictions, model_api=None):
+    """
+    Écrit un lot : les nouveaux scanners, puis les patients, puis leurs jobs de prédiction,
+    et ingère leurs scanners si model_api est donné.
+
+    Args:
+    - loaded: list de (numéro de ligne, clé externe, champs du patient, scanner ou None)
+    - model_api: httpx.Client vers l'API du modèle, ou None pour ne pas ingérer
+
+    Returns:
+    - dict des compteurs du lot
+    """
+    # Un contenu présent plusieurs fois dans le lot n'est envoyé qu'une fois
+    scans = {}
+    for _, _, _, scan in loaded:
+        if scan is not None:
+            scans.setdefault(scan[0], scan)
+    written = put_scans_bulk(db, list(scans.values())) if scans else []
+    scan_count = sum(1 for *_, scan in loaded if scan is not None)
+
+    documents = []
+    for line, external_id, patient, scan in loaded:
+        document = {
+            "_id": ObjectId(),
+            **patient,
+            "import_key": f"{source}:{external_id or line}",
+        }
+        if scan is not None:
+            scan_id, data, filename, content_type = scan
+            document["scanner"] = {
+                "scan_id": scan_id,
+                "scan_size": len(data),
+                "scan_content_type": content_type,
+                "uploaded_at": datetime.now(),
+                "scanner_name": filename,
+                "prediction": None,
+            }
+        documents.append(document)
+    duplicates = insert_many_ignoring_duplicates(db.patients, documents)
+    inserted = [document for i, document in enumerate(documents) if i not in duplicates]
+
+    jobs_queued = 0
+    if queue_predictions:
+        # Priorité basse : l'import ne passe pas devant les demandes faites depuis l'interface
+        jobs = [
+            (document["_id"], document["scanner"]["scan_id"])
+            for document in inserted
+            if "scanner" in document
+        ]
+        jobs_queued = enqueue_many(db, jobs, PRIORITY_LOW)
+
+    ingested = ingest_failed = 0
+    if model_api is not None:
+        # Les patients déjà importés sont ingérés aussi : relancer l'import avec --ingest
+        # rattrape ceux qui ne l'ont pas été
+        keys = [document["import_key"] for document in documents if "scanner" in document]
+        patient_ids = [
+            str(patient["_id"])
+            for patient in db.patients.find(
+                {"import_key": {"$in": keys}, "scanner.scan_id": {"$type": "string"}}, {"_id": 1}
+            )
+        ]
+        ingest_failed = ingest_patients(model_api, patient_ids)
+        ingested = len(patient_ids) - ingest_failed
+
+    return {
+        "imported": len(inserted),
+        "already_imported": len(duplicates),
+        "scans_written": len(written),
+        "scans_deduplicated": scan_count - len(written),
+        "jobs_queued": jobs_queued,
+        "ingested": ingested,
+        "ingest_failed": ingest_failed,
+    }
+
+
+def write_checkpoint(path, checkpoint):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def import_patients(
+    db,
+    records,
+    source,
+    batch_size=200,
+    workers=None,
+    max_scan_bytes=MAX_SCAN_BYTES,
+    queue_predictions=False,
+    checkpoint_path=None,
+    errors_path=None,
+    resume_from=None,
+    model_api=None,
+):
+    """
+    Importe les patients par lots. Les fichiers du lot suivant sont lus et hachés
+    pendant l'écriture du lot courant.
+
+    Args:
+    - db: base MongoDB (pymongo)
+    - records: itérable de dict (voir manifest_records et directory_records)
+    - source: str, nom de la source, préfixe des clés import_key
+    - batch_size: int, nombre de patients par lot
+    - workers: int, threads de lecture (défaut : celui de ThreadPoolExecutor)
+    - queue_predictions: bool, ajouter les scanners importés à la file des prédictions
+    - checkpoint_path: str, fichier du point de reprise (après chaque lot), ou None
+    - errors_path: str, fichier NDJSON des lignes refusées, ou None
+    - resume_from: dict, point de reprise chargé, ou None
+    - model_api: httpx.Client vers l'API du modèle pour ingérer les scanners, ou None
+
+    Returns:
+    - ImportStats
+    """
+    ensure_import_indexes(db)
+    stats = ImportStats(**(resume_from or {}).get("stats", {}))
+    first_line = stats.rows
+    numbered = enumerate(itertools.islice(records, first_line, None), start=first_line + 1)
+    errors_file = open(errors_path, "a", encoding="utf-8") if errors_path else None
+    start = time.perf_counter()
+    imported_before = stats.imported
+
+    def submit(executor):
+        batch = list(itertools.islice(numbered, batch_size))
+        return [
+            (line, row, executor.submit(load_record, row, max_scan_bytes)) for line, row in batch
+        ]
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = submit(executor)
+            while pending:
+                upcoming = submit(executor)
+                loaded = []
+                for line, row, future in pending:
+                    try:
+                        patient, scan = future.result()
+                    except InvalidRecord as e:
+                        stats.invalid += 1
+                        if errors_file is not None:
+                            errors_file.write(
+                                json.dumps({"line": line, "error": str(e), "row": row}, default=str)
+                                + "\n"
+                            )
+                        continue
+                    loaded.append((line, row.get("external_id"), patient, scan))
+
+                counts = write_batch(db, source, loaded, queue_predictions, model_api)
+                for name, value in counts.items():
+                    setattr(stats, name, getattr(stats, name) + value)
+                stats.rows = pending[-1][0]
+                pending = upcoming
+
+                if checkpoint_path:
+                    write_checkpoint(
+                        checkpoint_path,
+                        {
+                            "source": source,
+                            "stats": stats.as_dict(),
+                            "updated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                        },
+                    )
+                rate = (stats.imported - imported_before) / (time.perf_counter() - start)
+                print(f"{stats.rows} ligne(s), {stats.imported} patient(s) importé(s), {rate:.0f}/s")
+    finally:
+        if errors_file is not None:
+            errors_file.close()
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument("--manifest", help="fichier CSV ou NDJSON")
+    input_group.add_argument("--directory", help="dossier d'images avec un fichier JSON par image")
+    parser.add_argument(
+        "--source", default=None,
+        help="nom de la source (hôpital), préfixe des clés d'import (défaut : nom du fichier)",
+    )
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=None, help="threads de lecture des fichiers")
+    parser.add_argument("--max-scan-bytes", type=int, default=MAX_SCAN_BYTES)
+    parser.add_argument("--queue-predictions", action="store_true", help="prédire en arrière-plan")
+    parser.add_argument("--checkpoint", default=None, help="défaut : import_<source>.checkpoint.json")
+    parser.add_argument("--resume", action="store_true", help="reprendre au dernier point de reprise")
+    parser.add_argument("--errors", default=None, help="défaut : import_<source>.errors.ndjson")
+    parser.add_argument(
+        "--ingest", action="store_true",
+        help="calculer ROI, miniature et hash perceptuel avec l'API du modèle",
+    )
+    parser.add_argument(
+        "--model-api-url", default=os.getenv("MODEL_API_URL", "http://localhost:8000")
+    )
+    parser.add_argument("--mongo-uri", default=None)
+    args = parser.parse_args()
+
+    path = args.manifest or args.directory
+    source = args.source or os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+    checkpoint_path = args.checkpoint or f"import_{source}.checkpoint.json"
+    errors_path = args.errors or f"import_{source}.errors.ndjson"
+
+    resume_from = None
+    if args.resume and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            resume_from = json.load(f)
+        if resume_from["source"] != source:
+            sys.exit(f"{checkpoint_path} a été écrit pour la source {resume_from['source']}")
+        print(f"Reprise après {resume_from['stats']['rows']} ligne(s)")
+    elif os.path.exists(errors_path):
+        os.remove(errors_path)
+
+    if args.mongo_uri is None:
+        from hidden import MONGO_URI
+
+        args.mongo_uri = MONGO_URI
+
+    db = MongoClient(args.mongo_uri)["braintumor"]
+    records = manifest_records(path) if args.manifest else directory_records(path)
+    model_api = httpx.Client(base_url=args.model_api_url, timeout=120.0) if args.ingest else None
+    start = time.perf_counter()
+    try:
+        stats = import_patients(
+            db,
+            records,
+            source,
+            args.batch_size,
+            args.workers,
+            args.max_scan_bytes,
+            args.queue_predictions,
+            checkpoint_path,
+            errors_path,
+            resume_from,
+            model_api,
+        )
+    finally:
+        if model_api is not None:
+            model_api.close()
+    print(
+        f"Terminé en {time.perf_counter() - start:.1f} s : {stats.imported} patient(s) importé(s), "
+        f"{stats.already_imported} déjà présent(s), {stats.invalid} ligne(s) refusée(s) "
+        f"(voir {errors_path}), {stats.scans_written} scanner(s) enregistré(s), "
+        f"{stats.scans_deduplicated} en double, {stats.jobs_queued} prédiction(s) en file"
+    )
+    if args.ingest:
+        print(f"{stats.ingested} scanner(s) ingéré(s), {stats.ingest_failed} en échec")
+    else:
+        print("Scanners non ingérés (pas de miniature ni de hash) : relancer avec --ingest")
@@ -0,0 +1,33 @@
+"""
+Label de référence d'un scanner, déduit de la prédiction et de la vérification de l'expert.
+"""
+
+# Classes du modèle : 1 = tumeur, 0 = pas de tumeur
+TUMOR = 1
+NO_TUMOR = 0
+CLASSES = {"yes": TUMOR, "no": NO_TUMOR}
+
+# Prédictions vérifiées par un expert, avec un scanner
+VALIDATED_SCAN_QUERY = {
+    "$or": [
+        {"scanner.scan_id": {"$type": "string"}},
+        {"scanner.scanner_img": {"$type": "string"}},
+    ],
+    "scanner.prediction.AI_predict": {"$in": ["Tumor", "No tumor"]},
+    "scanner.prediction.predict_check": {"$in": ["Yes", "No"]},
+}
+
+
+def expert_label(prediction):
+    """
+    Returns:
+    - int, TUMOR ou NO_TUMOR selon l'expert, ou None si la prédiction n'a pas été vérifiée
+    """
+    prediction = prediction or {}
+    ai_predict = prediction.get("AI_predict")
+    predict_check = prediction.get("predict_check")
+    if ai_predict not in ("Tumor", "No tumor") or predict_check not in ("Yes", "No"):
+        return None
+    # L'expert confirme ("Yes") ou contredit ("No") la prédiction de l'IA
+    tumor = (ai_predict == "Tumor") == (predict_check == "Yes")
+    return TUMOR if tumor else NO_TUMOR
@@ -0,0 +1,349 @@
+"""
+Métriques des services (compteurs, jauges, histogrammes) au format texte de Prometheus,
+et temps passé dans chaque étape d'une requête.
+
+- MetricsRegistry : les métriques d'un service, exposées par GET /metrics (render).
+- MetricsMiddleware : middleware ASGI qui compte les requêtes par route et par statut,
+  mesure leur durée, et écrit une trace JSON des requêtes lentes avec le détail de
+  leurs étapes.
+- stage(name) : chronomètre une étape de la requête en cours (lecture MongoDB, décodage,
+  modèle...). Sans requête en cours, rien n'est enregistré.
+
+Avec plusieurs processus (api/serve.py), chaque processus écrit ses valeurs dans le
+dossier METRICS_DIR, et /metrics additionne celles de tous les processus. Une jauge qui
+vaut la même chose dans chaque processus (taille d'un index chargé par chaque processus)
+est créée avec merge="max" pour ne pas être multipliée par le nombre de processus.
+"""
+import asyncio
+import bisect
+import contextvars
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Bornes des histogrammes de durée, en secondes
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Trace de la requête en cours (propagée aux threads lancés avec copy_context)
+_current_trace = contextvars.ContextVar("request_trace", default=None)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), function=None, merge="sum"):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Valeur lue au moment de l'export : nombre, ou dict {valeurs des labels: nombre}
+        self.function = function
+        # Fusion des valeurs des processus : "sum" ou "max"
+        self.merge = merge
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        if self.function is not None:
+            value = self.function()
+            return dict(value) if isinstance(value, dict) else {(): value}
+        with self._lock:
+            return dict(self._values)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        # Nombre de valeurs par intervalle (le dernier est +Inf), puis la somme
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labelvalues)
+            if entry is None:
+                entry = self._values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    def samples(self):
+        with self._lock:
+            return {labels: list(entry) for labels, entry in self._values.items()}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """
+    Métriques d'un service. Les métriques des requêtes HTTP et des étapes sont créées
+    d'office, les autres avec counter(), gauge() et histogram().
+
+    Args:
+    - prefix: str, préfixe des noms des métriques (ex: "model_api")
+    - directory: str, dossier partagé par les processus d'un même service, ou None
+    """
+
+    def __init__(self, prefix, directory=None):
+        self.prefix = prefix
+        self.directory = directory
+        self._metrics = {}
+        self.requests = self.counter(
+            "requests_total", "HTTP requests by route, method and status.",
+            ("route", "method", "status"),
+        )
+        self.request_seconds = self.histogram(
+            "request_seconds", "HTTP request latency by route, until the response is sent.",
+            ("route",),
+        )
+        self.in_progress = self.gauge("requests_in_progress", "HTTP requests being served.")
+        self.stage_seconds = self.histogram(
+            "stage_seconds", "Time spent in each stage of the requests.", ("stage",)
+        )
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), function=None):
+        return self._add(Counter(f"{self.prefix}_{name}", documentation, labelnames, function))
+
+    def gauge(self, name, documentation, labelnames=(), function=None, merge="sum"):
+        if merge not in ("sum", "max"):
+            raise ValueError(f"merge must be 'sum' or 'max', not {merge!r}")
+        return self._add(
+            Gauge(f"{self.prefix}_{name}", documentation, labelnames, function, merge)
+        )
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(f"{self.prefix}_{name}", documentation, labelnames, buckets))
+
+    def snapshot(self):
+        return {
+            name: [[list(labels), value] for labels, value in metric.samples().items()]
+            for name, metric in self._metrics.items()
+        }
+
+    def _snapshot_path(self, pid=None):
+        return os.path.join(self.directory, f"{self.prefix}_{pid or os.getpid()}.json")
+
+    def write_snapshot(self):
+        # Écriture puis renommage, pour que les autres processus ne lisent jamais un fichier partiel
+        if self.directory is None:
+            return
+        path = self._snapshot_path()
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(f"{path}.tmp", path)
+
+    def _collect(self):
+        # Valeurs de ce processus, plus celles écrites par les autres processus
+        snapshots = [self.snapshot()]
+        if self.directory is not None:
+            own_path = self._snapshot_path()
+            for path in glob.glob(os.path.join(self.directory, f"{self.prefix}_*.json")):
+                if path == own_path:
+                    continue
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+
+        merged = {name: {} for name in self._metrics}
+        for snapshot in snapshots:
+            for name, samples in snapshot.items():
+                if name not in merged:
+                    continue
+                for labels, value in samples:
+                    labels = tuple(labels)
+                    current = merged[name].get(labels)
+                    if current is None:
+                        merged[name][labels] = list(value) if isinstance(value, list) else value
+                    elif isinstance(value, list):
+                        merged[name][labels] = [a + b for a, b in zip(current, value)]
+                    elif self._metrics[name].merge == "max":
+                        merged[name][labels] = max(current, value)
+                    else:
+                        merged[name][labels] = current + value
+        return merged
+
+    def render(self):
+        """
+        Returns:
+        - str, toutes les métriques au format texte de Prometheus
+        """
+        lines = []
+        for name, samples in self._collect().items():
+            metric = self._metrics[name]
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for labels, value in sorted(samples.items()):
+                if metric.type != "histogram":
+                    lines.append(
+                        f"{name}{_format_labels(metric.labelnames, labels)} {_format_value(value)}"
+                    )
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float("inf"),), value[:-1]):
+                    cumulative += count
+                    le = (("le", _format_value(float(bound))),)
+                    lines.append(
+                        f"{name}_bucket{_format_labels(metric.labelnames, labels, le)} {cumulative}"
+                    )
+                lines.append(
+                    f"{name}_sum{_format_labels(metric.labelnames, labels)} {_format_value(value[-1])}"
+                )
+                lines.append(f"{name}_count{_format_labels(metric.labelnames, labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    async def write_snapshots(self, interval):
+        """
+        Tâche de fond : écrit les valeurs de ce processus toutes les interval secondes.
+        """
+        while True:
+            try:
+                self.write_snapshot()
+            except OSError as e:
+                print(f"Could not write the metrics snapshot: {e}")
+            await asyncio.sleep(interval)
+
+
+class RequestTrace:
+    def __init__(self, registry):
+        self.registry = registry
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    def add(self, name, seconds):
+        self.registry.stage_seconds.observe(seconds, name)
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name):
+    """
+    Chronomètre une étape de la requête en cours : with stage("find_patient"): ...
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - start)
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI : compte et chronomètre les requêtes HTTP, et écrit sur la sortie
+    standard une trace JSON (une ligne) de celles qui durent plus de slow_request_seconds.
+
+    La durée s'arrête à l'envoi de la réponse : les tâches de fond lancées après la
+    réponse n'y sont pas comptées, mais leurs étapes le sont dans stage_seconds.
+
+    Args:
+    - app: application ASGI
+    - registry: MetricsRegistry du service
+    - slow_request_seconds: float, seuil des traces, ou None pour ne rien écrire
+    """
+
+    def __init__(self, app, registry, slow_request_seconds=None):
+        self.app = app
+        self.registry = registry
+        self.slow_request_seconds = slow_request_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = RequestTrace(self.registry)
+        status = 500
+        finished = None
+
+        async def send_and_record(message):
+            nonlocal status, finished
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body" and not message.get("more_body"):
+                finished = time.perf_counter()
+            await send(message)
+
+        token = _current_trace.set(trace)
+        self.registry.in_progress.inc()
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            _current_trace.reset(token)
+            self.registry.in_progress.dec()
+            duration = (finished or time.perf_counter()) - trace.start
+            # Route déclarée (/predict/{patient_id}) plutôt que le chemin, pour limiter les séries
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            self.registry.requests.inc(route, scope["method"], str(status))
+            self.registry.request_seconds.observe(duration, route)
+            if self.slow_request_seconds is not None and duration >= self.slow_request_seconds:
+                self.log_slow_request(scope, route, status, duration, trace)
+
+    def log_slow_request(self, scope, route, status, duration, trace):
+        record = {
+            "event": "slow_request",
+            "service": self.registry.prefix,
+            "request_id": uuid.uuid4().hex[:16],
+            "time": datetime.now().isoformat(timespec="milliseconds"),
+            "method": scope["method"],
+            "path": scope["path"],
+            "query": scope.get("query_string", b"").decode("latin-1"),
+            "route": route,
+            "status": status,
+            "duration_ms": round(duration * 1000, 2),
+            "stages_ms": {name: round(seconds * 1000, 2) for name, seconds in trace.stages.items()},
+        }
+        print(json.dumps(record), flush=True)
@@ -0,0 +1,82 @@
+"""
+Migre les scanners stockés en base64 dans les documents patients vers GridFS.
+
+Usage (depuis la racine du dépôt) :
+    python -m common.migrate_scans [--batch-size 100]
+
+La migration peut être interrompue et relancée : seuls les documents qui ont encore
+un champ scanner.scanner_img sont traités.
+"""
+import argparse
+import base64
+import binascii
+import os
+import sys
+
+from pymongo import MongoClient, UpdateOne
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+
+from common.scan_store import put_scan
+
+
+def migrate_scans(db, batch_size=100):
+    query = {"scanner.scanner_img": {"$type": "string"}}
+    projection = {"scanner.scanner_img": 1, "scanner.scanner_name": 1}
+
+    migrated = 0
+    invalid = 0
+    last_id = None
+    while True:
+        batch_query = dict(query)
+        if last_id is not None:
+            batch_query["_id"] = {"$gt": last_id}
+        patients = list(
+            db.patients.find(batch_query, projection).sort("_id", 1).limit(batch_size)
+        )
+        if not patients:
+            break
+
+        operations = []
+        for patient in patients:
+            scanner = patient["scanner"]
+            try:
+                data = base64.b64decode(scanner["scanner_img"])
+            except binascii.Error:
+                invalid += 1
+                continue
+
+            reference = put_scan(db, data, scanner.get("scanner_name"))
+            operations.append(
+                UpdateOne(
+                    {"_id": patient["_id"]},
+                    {
+                        "$set": {f"scanner.{key}": value for key, value in reference.items()},
+                        "$unset": {"scanner.scanner_img": ""},
+                    },
+                )
+            )
+
+        if operations:
+            db.patients.bulk_write(operations, ordered=False)
+        migrated += len(operations)
+        last_id = patients[-1]["_id"]
+        print(f"{migrated} scanner(s) migré(s)")
+
+    return migrated, invalid
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--mongo-uri", default=None)
+    args = parser.parse_args()
+
+    if args.mongo_uri is None:
+        from hidden import MONGO_URI
+
+        args.mongo_uri = MONGO_URI
+
+    db = MongoClient(args.mongo_uri)["braintumor"]
+    migrated, invalid = migrate_scans(db, args.batch_size)
+    print(f"Terminé : {migrated} scanner(s) migré(s), {invalid} image(s) invalide(s) ignorée(s)")
@@ -0,0 +1,278 @@
+"""
+File d'attente des prédictions, stockée dans la collection MongoDB prediction_jobs.
+
+Un job par patient (_id = _id du patient), pour le scanner scan_id :
+- status : "queued", "running", "done" ou "dead" (abandonné après MAX_ATTEMPTS échecs).
+  Les mises à jour d'un worker (complete, fail) portent sur le scan_id du job réservé :
+  si le scanner a été remplacé entre-temps, le job remis dans la file n'est pas modifié
+- priority : les jobs de priorité haute sont traités en premier
+- available_at : date à partir de laquelle le job peut être pris (backoff entre deux essais)
+"""
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+JOBS_COLLECTION = "prediction_jobs"
+
+# Priorités
+PRIORITY_HIGH = 10  # demande explicite depuis l'interface
+PRIORITY_NORMAL = 5  # nouveau scanner, ou scanner remplacé
+PRIORITY_LOW = 0  # rattrapage des scanners jamais prédits
+
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 10  # secondes, doublé à chaque essai
+
+# Scanners à prédire : image présente, pas encore de prédiction
+PENDING_QUERY = {
+    "scanner.scan_id": {"$type": "string"},
+    "$or": [
+        {"scanner.prediction": None},
+        {"scanner.prediction.AI_predict": None},
+    ],
+}
+
+
+def ensure_queue_indexes(db):
+    # Polling des scanners à prédire (prediction_worker, sans change streams)
+    db.patients.create_index([("scanner.uploaded_at", ASCENDING)], name="scan_uploaded_at")
+    jobs = db[JOBS_COLLECTION]
+    jobs.create_index(
+        [
+            ("status", ASCENDING),
+            ("priority", DESCENDING),
+            ("available_at", ASCENDING),
+        ],
+        name="claim",
+    )
+    jobs.create_index([("status", ASCENDING), ("finished_at", DESCENDING)], name="finished")
+
+
+def needs_prediction(patient):
+    scanner = patient.get("scanner") or {}
+    prediction = scanner.get("prediction") or {}
+    return isinstance(scanner.get("scan_id"), str) and prediction.get("AI_predict") is None
+
+
+def enqueue(db, patient_id, scan_id, priority=PRIORITY_NORMAL):
+    """
+    Ajoute un job pour le scanner d'un patient. Sans effet si ce scanner a déjà un job
+    (en attente, en cours ou terminé) : seul un nouveau scanner est remis dans la file,
+    même si le job de l'ancien est en cours de traitement.
+
+    Returns:
+    - bool, True si un job a été créé ou remis dans la file
+    """
+    now = datetime.now()
+    try:
+        db[JOBS_COLLECTION].update_one(
+            {"_id": patient_id, "scan_id": {"$ne": scan_id}},
+            {
+                "$set": {
+                    "scan_id": scan_id,
+                    "status": "queued",
+                    "priority": priority,
+                    "attempts": 0,
+                    "available_at": now,
+                    "created_at": now,
+                    "last_error": None,
+                }
+            },
+            upsert=True,
+        )
+        return True
+    except DuplicateKeyError:
+        # Job déjà présent pour ce scanner
+        return False
+
+
+def enqueue_many(db, jobs, priority=PRIORITY_LOW):
+    """
+    Ajoute les jobs de nouveaux patients en un seul insert_many (import en masse). Les
+    patients qui ont déjà un job ne sont pas modifiés.
+
+    Args:
+    - jobs: list de (patient_id, scan_id)
+
+    Returns:
+    - int, nombre de jobs créés
+    """
+    now = datetime.now()
+    documents = [
+        {
+            "_id": patient_id,
+            "scan_id": scan_id,
+            "status": "queued",
+            "priority": priority,
+            "attempts": 0,
+            "available_at": now,
+            "created_at": now,
+            "last_error": None,
+        }
+        for patient_id, scan_id in jobs
+    ]
+    if not documents:
+        return 0
+    try:
+        return len(db[JOBS_COLLECTION].insert_many(documents, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+        return e.details["nInserted"]
+
+
+def claim(db, worker_id, limit):
+    """
+    Réserve jusqu'à limit jobs, par priorité puis par ancienneté.
+
+    Returns:
+    - list, jobs réservés (status "running")
+    """
+    jobs = []
+    for _ in range(limit):
+        now = datetime.now()
+        job = db[JOBS_COLLECTION].find_one_and_update(
+            {"status": "queued", "available_at": {"$lte": now}},
+            {
+                "$set": {"status": "running", "worker": worker_id, "claimed_at": now},
+                "$inc": {"attempts": 1},
+            },
+            sort=[("priority", DESCENDING), ("available_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if job is None:
+            break
+        jobs.append(job)
+    return jobs
+
+
+def _claimed(job):
+    # Le job tel qu'il a été réservé : pas s'il a été remis dans la file pour un autre scanner
+    return {"_id": job["_id"], "scan_id": job["scan_id"], "status": "running"}
+
+
+def complete(db, jobs):
+    if jobs:
+        db[JOBS_COLLECTION].update_many(
+            {"$or": [_claimed(job) for job in jobs]},
+            {"$set": {"status": "done", "finished_at": datetime.now(), "last_error": None}},
+        )
+
+
+def fail(db, job, error, retry=True):
+    """
+    Remet un job dans la file avec un délai croissant, ou le passe en "dead"
+    si l'erreur est définitive ou si le nombre maximal d'essais est atteint.
+    """
+    now = datetime.now()
+    if retry and job["attempts"] < MAX_ATTEMPTS:
+        update = {
+            "status": "queued",
+            "available_at": now + timedelta(seconds=RETRY_DELAY * 2 ** (job["attempts"] - 1)),
+            "last_error": error,
+        }
+    else:
+        update = {"status": "dead", "finished_at": now, "last_error": error}
+    db[JOBS_COLLECTION].update_one(_claimed(job), {"$set": update})
+
+
+def requeue_stale(db, lease_seconds):
+    """
+    Remet dans la file les jobs réservés par un worker qui n'a pas répondu à temps
+    (processus arrêté en cours de traitement).
+    """
+    result = db[JOBS_COLLECTION].update_many(
+        {
+            "status": "running",
+            "claimed_at": {"$lt": datetime.now() - timedelta(seconds=lease_seconds)},
+        },
+        {"$set": {"status": "queued", "available_at": datetime.now()}},
+    )
+    return result.modified_count
+
+
+def requeue_dead(db):
+    result = db[JOBS_COLLECTION].update_many(
+        {"status": "dead"},
+        {"$set": {"status": "queued", "attempts": 0, "available_at": datetime.now()}},
+    )
+    return result.modified_count
+
+
+async def prioritize_async(db, patient_id):
+    """
+    Passe en priorité haute le job en attente d'un patient (base motor).
+    """
+    await db[JOBS_COLLECTION].update_one(
+        {"_id": patient_id, "status": "queued"}, {"$set": {"priority": PRIORITY_HIGH}}
+    )
+
+
+async def queue_depth_async(db):
+    return await db[JOBS_COLLECTION].count_documents({"status": {"$in": ["queued", "running"]}})
+
+
+def _stats_pipeline():
+    return [
+        {
+            "$group": {
+                "_id": {"status": "$status", "priority": "$priority"},
+                "count": {"$sum": 1},
+            }
+        }
+    ]
+
+
+def _format_stats(groups, done_last_minute, done_last_5_minutes, dead_jobs):
+    by_status = {"queued": 0, "running": 0, "done": 0, "dead": 0}
+    queued_by_priority = {}
+    for group in groups:
+        status = group["_id"]["status"]
+        by_status[status] = by_status.get(status, 0) + group["count"]
+        if status == "queued":
+            priority = str(group["_id"]["priority"])
+            queued_by_priority[priority] = queued_by_priority.get(priority, 0) + group["count"]
+
+    return {
+        "depth": by_status["queued"] + by_status["running"],
+        "by_status": by_status,
+        "queued_by_priority": queued_by_priority,
+        "done_per_minute": done_last_minute,
+        "done_per_minute_5m": done_last_5_minutes / 5,
+        "dead": [
+            {
+                "patient_id": str(job["_id"]),
+                "attempts": job.get("attempts"),
+                "last_error": job.get("last_error"),
+                "finished_at": job.get("finished_at"),
+            }
+            for job in dead_jobs
+        ],
+    }
+
+
+async def jobs_by_status_async(db):
+    """
+    Nombre de jobs par état, en une seule agrégation (pour les métriques), pour une base motor.
+    """
+    groups = await db[JOBS_COLLECTION].aggregate(_stats_pipeline()).to_list(None)
+    return _format_stats(groups, 0, 0, [])["by_status"]
+
+
+async def queue_stats_async(db, dead_limit=20):
+    """
+    Profondeur de la file, débit (jobs terminés par minute) et jobs abandonnés, pour une base motor.
+    """
+    jobs = db[JOBS_COLLECTION]
+    now = datetime.now()
+    groups = await jobs.aggregate(_stats_pipeline()).to_list(None)
+    done_last_minute = await jobs.count_documents(
+        {"status": "done", "finished_at": {"$gte": now - timedelta(minutes=1)}}
+    )
+    done_last_5_minutes = await jobs.count_documents(
+        {"status": "done", "finished_at": {"$gte": now - timedelta(minutes=5)}}
+    )
+    dead_jobs = await (
+        jobs.find({"status": "dead"}).sort("finished_at", DESCENDING).limit(dead_limit)
+    ).to_list(None)
+    return _format_stats(groups, done_last_minute, done_last_5_minutes, dead_jobs)
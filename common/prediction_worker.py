@@ -0,0 +1,231 @@
+"""
+Prédit en arrière-plan les scanners des nouveaux patients.
+
+Usage (depuis la racine du dépôt, l'API du modèle doit être lancée) :
+    python -m common.prediction_worker [--workers 2] [--batch-size 16]
+
+Le processus principal surveille la collection patients (change streams, ou
+interrogation périodique si MongoDB n'est pas un replica set) et ajoute les scanners
+à prédire dans la file prediction_jobs. L'interrogation ne relit que les scanners
+enregistrés depuis la précédente (scanner.uploaded_at). Les processus workers prennent les jobs par
+lots et les envoient à POST /predict/batch, qui enregistre les prédictions.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import httpx
+from pymongo import DESCENDING, MongoClient
+from pymongo.errors import OperationFailure, PyMongoError
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+
+from common.prediction_queue import (
+    PENDING_QUERY,
+    PRIORITY_LOW,
+    PRIORITY_NORMAL,
+    claim,
+    complete,
+    enqueue,
+    ensure_queue_indexes,
+    fail,
+    needs_prediction,
+    requeue_dead,
+    requeue_stale,
+)
+
+
+# Marge du curseur de polling : un scanner enregistré juste avant le précédent passage,
+# mais écrit après lui, est relu au passage suivant
+SWEEP_OVERLAP_SECONDS = 60
+
+
+def latest_upload(db):
+    """
+    Returns:
+    - datetime, date du scanner enregistré le plus récemment, ou None
+    """
+    patient = db.patients.find_one(
+        {"scanner.uploaded_at": {"$type": "date"}},
+        {"scanner.uploaded_at": 1},
+        sort=[("scanner.uploaded_at", DESCENDING)],
+    )
+    return patient["scanner"]["uploaded_at"] if patient else None
+
+
+def sweep(db, priority, since=None):
+    """
+    Ajoute à la file les scanners sans prédiction qui n'y sont pas encore : tous, ou
+    seulement ceux enregistrés depuis since (moins SWEEP_OVERLAP_SECONDS).
+    """
+    query = PENDING_QUERY
+    if since is not None:
+        query = {
+            **PENDING_QUERY,
+            "scanner.uploaded_at": {"$gte": since - timedelta(seconds=SWEEP_OVERLAP_SECONDS)},
+        }
+    queued = 0
+    for patient in db.patients.find(query, {"scanner.scan_id": 1}):
+        if enqueue(db, patient["_id"], patient["scanner"]["scan_id"], priority):
+            queued += 1
+    return queued
+
+
+def watch_patients(db, stop_event, poll_interval, lease_seconds):
+    """
+    Alimente la file : rattrapage au démarrage, puis change streams ou, à défaut, polling.
+    """
+    # Curseur lu avant le rattrapage : rien de ce qui est enregistré pendant n'est manqué
+    since = latest_upload(db) or datetime.now()
+    print(f"{sweep(db, PRIORITY_LOW)} scanner(s) en attente ajouté(s) à la file")
+
+    pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}}]
+    try:
+        with db.patients.watch(
+            pipeline, full_document="updateLookup", max_await_time_ms=1000
+        ) as stream:
+            print("Surveillance des patients par change stream")
+            last_maintenance = time.monotonic()
+            while not stop_event.is_set():
+                change = stream.try_next()
+                patient = change.get("fullDocument") if change else None
+                if patient and needs_prediction(patient):
+                    enqueue(db, patient["_id"], patient["scanner"]["scan_id"], PRIORITY_NORMAL)
+                if time.monotonic() - last_maintenance > poll_interval:
+                    requeue_stale(db, lease_seconds)
+                    last_maintenance = time.monotonic()
+            return
+    except OperationFailure as e:
+        # Les change streams ne sont disponibles que sur un replica set
+        print(f"Change streams indisponibles ({e.code}), polling toutes les {poll_interval}s")
+
+    while not stop_event.is_set():
+        latest = latest_upload(db)
+        sweep(db, PRIORITY_NORMAL, since)
+        since = latest or since
+        requeue_stale(db, lease_seconds)
+        stop_event.wait(poll_interval)
+
+
+def process_jobs(db, client, jobs):
+    """
+    Envoie un lot de jobs à l'API du modèle et met à jour leur statut.
+    """
+    by_id = {str(job["_id"]): job for job in jobs}
+    try:
+        response = client.post("/predict/batch", json={"patient_ids": list(by_id)})
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        for job in jobs:
+            fail(db, job, f"Model API error: {e}")
+        return 0
+
+    result = response.json()
+    done = [
+        by_id.pop(item["patient_id"])
+        for item in result["predictions"]
+        if item["patient_id"] in by_id
+    ]
+    complete(db, done)
+    # Erreurs définitives : patient supprimé, scanner absent ou illisible
+    for key in ("not_found", "no_image", "failed"):
+        for patient_id in result.get(key, []):
+            if patient_id in by_id:
+                fail(db, by_id.pop(patient_id), key, retry=False)
+    for job in by_id.values():
+        fail(db, job, "Missing from the model API response")
+    return len(done)
+
+
+def worker_loop(worker_id, mongo_uri, model_api_url, batch_size, poll_interval, stop_event):
+    db = MongoClient(mongo_uri)["braintumor"]
+    with httpx.Client(base_url=model_api_url, timeout=120.0) as client:
+        while not stop_event.is_set():
+            try:
+                jobs = claim(db, worker_id, batch_size)
+                if not jobs:
+                    stop_event.wait(poll_interval)
+                    continue
+                done = process_jobs(db, client, jobs)
+                print(f"[{worker_id}] {datetime.now():%H:%M:%S} {done}/{len(jobs)} prédiction(s)")
+            except PyMongoError as e:
+                print(f"[{worker_id}] Erreur MongoDB : {e}")
+                stop_event.wait(poll_interval)
+
+
+def run(mongo_uri, model_api_url, workers, batch_size, poll_interval, lease_seconds):
+    db = MongoClient(mongo_uri)["braintumor"]
+    ensure_queue_indexes(db)
+
+    # Chaque worker ouvre ses propres connexions MongoDB et HTTP
+    context = multiprocessing.get_context("spawn")
+    stop_event = context.Event()
+    processes = [
+        context.Process(
+            target=worker_loop,
+            args=(
+                f"worker-{i}",
+                mongo_uri,
+                model_api_url,
+                batch_size,
+                poll_interval,
+                stop_event,
+            ),
+            daemon=True,
+        )
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        watch_patients(db, stop_event, poll_interval, lease_seconds)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        for process in processes:
+            process.join(timeout=30)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("PREDICTION_WORKERS", "2"))
+    )
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--poll-interval", type=float, default=5.0)
+    parser.add_argument(
+        "--lease", type=float, default=300.0,
+        help="secondes avant de remettre dans la file un job dont le worker ne répond plus",
+    )
+    parser.add_argument(
+        "--model-api-url", default=os.getenv("MODEL_API_URL", "http://localhost:8000")
+    )
+    parser.add_argument("--mongo-uri", default=None)
+    parser.add_argument(
+        "--requeue-dead", action="store_true",
+        help="remet les jobs abandonnés dans la file, puis quitte",
+    )
+    args = parser.parse_args()
+
+    if args.mongo_uri is None:
+        from hidden import MONGO_URI
+
+        args.mongo_uri = MONGO_URI
+
+    if args.requeue_dead:
+        db = MongoClient(args.mongo_uri)["braintumor"]
+        print(f"{requeue_dead(db)} job(s) remis dans la file")
+    else:
+        run(
+            args.mongo_uri,
+            args.model_api_url,
+            args.workers,
+            args.batch_size,
+            args.poll_interval,
+            args.lease,
+        )
@@ -0,0 +1,369 @@
+"""
+Détection des scanners en double ou presque en double, par hash perceptuel.
+
+Un même scanner est souvent envoyé pour plusieurs patients, ou ré-exporté avec de
+petites différences (recompression JPEG, autre format) : son contenu, donc son scan_id,
+change, mais pas l'image. Le hash perceptuel (64 bits) est calculé sur la région
+d'intérêt normalisée (l'entrée du modèle) ; deux images proches ont des hash à faible
+distance de Hamming.
+
+- perceptual_hash : hash d'une région d'intérêt (DCT, comme pHash).
+- PerceptualHashIndex : index en mémoire des hash, recherche par distance de Hamming
+  (multi-index hashing), rechargé depuis la collection scan_phashes.
+
+Deux images différentes peuvent avoir le même hash (par exemple deux scanners presque
+uniformes) : le hash sert à signaler des doublons possibles, pas à réutiliser une
+prédiction. Seule une ROI identique octet pour octet (roi_sha256) donne la même entrée
+au modèle.
+
+Usage (depuis la racine du dépôt) :
+    python -m common.scan_similarity [--batch-size 500]   # hash des ROIs déjà stockées
+    python -m common.scan_similarity --calibrate          # doublons signalés par distance
+"""
+import argparse
+import hashlib
+import itertools
+import os
+import sys
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+from pymongo import ASCENDING, MongoClient, UpdateOne
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+
+from common.scan_store import ROI_COLLECTION, roi_key  # noqa: E402
+
+PHASH_COLLECTION = "scan_phashes"
+HASH_BITS = 64
+# Taille de l'image réduite dont on garde les 8x8 plus basses fréquences
+_DCT_SIZE = 32
+_LOW_FREQUENCIES = 8
+
+
+def perceptual_hash(roi):
+    """
+    Hash perceptuel d'une région d'intérêt : signe des basses fréquences de la DCT de
+    l'image réduite en niveaux de gris, par rapport à leur médiane.
+
+    Args:
+    - roi: np.array (uint8), image normalisée, en couleur (BGR) ou en niveaux de gris
+
+    Returns:
+    - int, hash de 64 bits
+    """
+    gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY) if roi.ndim == 3 else roi
+    small = cv2.resize(gray, (_DCT_SIZE, _DCT_SIZE), interpolation=cv2.INTER_AREA)
+    low = cv2.dct(small.astype(np.float32))[:_LOW_FREQUENCIES, :_LOW_FREQUENCIES].flatten()
+    # La composante continue (luminosité moyenne) ne compte pas dans la médiane
+    bits = low > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def roi_digest(roi):
+    """
+    Returns:
+    - str, SHA-256 des octets de la ROI (uint8), tels qu'ils sont stockés dans scan_rois
+    """
+    return hashlib.sha256(np.ascontiguousarray(roi, dtype=np.uint8).tobytes()).hexdigest()
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def format_hash(phash):
+    return f"{phash:016x}"
+
+
+class PerceptualHashIndex:
+    """
+    Index en mémoire des hash perceptuels des scanners.
+
+    Multi-index hashing : le hash est découpé en segments, chacun indexé dans une table.
+    Deux hash à distance <= d ont au moins un segment à distance <= d // segments : on
+    ne vérifie que les hash qui ont un segment égal, ou presque, à celui cherché, au lieu
+    de parcourir toute la collection.
+
+    Args:
+    - segments: int, nombre de segments du hash (4 segments de 16 bits par défaut)
+    """
+
+    def __init__(self, segments=4):
+        self.segments = segments
+        self.segment_bits = HASH_BITS // segments
+        self._segment_mask = (1 << self.segment_bits) - 1
+        self._tables = [{} for _ in range(segments)]
+        # hash -> scan_id qui l'ont, et scan_id -> hash
+        self._scans = {}
+        self._hashes = {}
+        self._flips = {}
+        # Date d'écriture du dernier hash chargé depuis MongoDB
+        self.loaded_until = None
+        self.ready = False
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def _segment_values(self, phash):
+        return [
+            (phash >> (i * self.segment_bits)) & self._segment_mask for i in range(self.segments)
+        ]
+
+    def add(self, scan_id, phash):
+        if self._hashes.get(scan_id) == phash:
+            return
+        self._hashes[scan_id] = phash
+        scan_ids = self._scans.get(phash)
+        if scan_ids is not None:
+            scan_ids.add(scan_id)
+            return
+        self._scans[phash] = {scan_id}
+        for table, value in zip(self._tables, self._segment_values(phash)):
+            table.setdefault(value, set()).add(phash)
+
+    def hash_of(self, scan_id):
+        return self._hashes.get(scan_id)
+
+    def hashes(self):
+        # Un hash par scanner (répété si plusieurs scanners ont le même)
+        return list(self._hashes.values())
+
+    def exact(self, phash):
+        """
+        Returns:
+        - set des scan_id qui ont exactement ce hash
+        """
+        return set(self._scans.get(phash, ()))
+
+    def _masks(self, radius):
+        # Masques qui changent au plus radius bits d'un segment
+        masks = self._flips.get(radius)
+        if masks is None:
+            masks = [0]
+            for count in range(1, radius + 1):
+                for positions in itertools.combinations(range(self.segment_bits), count):
+                    masks.append(sum(1 << position for position in positions))
+            self._flips[radius] = masks
+        return masks
+
+    def search(self, phash, max_distance, limit=None):
+        """
+        Cherche les scanners dont le hash est à distance de Hamming <= max_distance.
+
+        Returns:
+        - list de (scan_id, distance), des plus proches aux plus éloignés
+        """
+        masks = self._masks(max_distance // self.segments)
+        candidates = set()
+        for table, value in zip(self._tables, self._segment_values(phash)):
+            for mask in masks:
+                candidates.update(table.get(value ^ mask, ()))
+
+        matches = []
+        for candidate in candidates:
+            distance = hamming_distance(phash, candidate)
+            if distance <= max_distance:
+                matches.extend((scan_id, distance) for scan_id in self._scans[candidate])
+        matches.sort(key=lambda match: (match[1], match[0]))
+        return matches[:limit] if limit is not None else matches
+
+    async def load_async(self, db, preprocessing_version, overlap_seconds=60):
+        """
+        Ajoute les hash écrits depuis le dernier chargement (tous au premier appel),
+        y compris ceux des autres processus. Pour une base motor.
+
+        Les hash écrits un peu avant loaded_until sont relus (overlap_seconds), au cas où
+        l'horloge d'un autre processus serait en retard.
+
+        Returns:
+        - int, nombre de hash lus
+        """
+        query = {"preprocessing_version": preprocessing_version}
+        if self.loaded_until is not None:
+            query["created_at"] = {"$gte": self.loaded_until - timedelta(seconds=overlap_seconds)}
+        count = 0
+        cursor = db[PHASH_COLLECTION].find(query, {"scan_id": 1, "phash": 1, "created_at": 1})
+        async for entry in cursor:
+            self.add(entry["scan_id"], int(entry["phash"], 16))
+            if self.loaded_until is None or entry["created_at"] > self.loaded_until:
+                self.loaded_until = entry["created_at"]
+            count += 1
+        self.ready = True
+        return count
+
+
+async def ensure_phash_indexes(db):
+    """
+    Crée les index de la collection scan_phashes. Pour une base motor.
+    """
+    phashes = db[PHASH_COLLECTION]
+    await phashes.create_index(
+        [("preprocessing_version", ASCENDING), ("created_at", ASCENDING)], name="created_at"
+    )
+    # Doublons exacts cherchés directement en base, avant que l'index en mémoire des
+    # autres processus ne soit rechargé
+    await phashes.create_index(
+        [("phash", ASCENDING), ("preprocessing_version", ASCENDING)], name="phash"
+    )
+    # Scanners dont la ROI est identique (réutilisation des prédictions)
+    await phashes.create_index(
+        [("roi_sha256", ASCENDING), ("preprocessing_version", ASCENDING)], name="roi_sha256"
+    )
+
+
+def phash_document(scan_id, preprocessing_version, roi):
+    return {
+        "scan_id": scan_id,
+        "preprocessing_version": preprocessing_version,
+        "phash": format_hash(perceptual_hash(roi)),
+        "roi_sha256": roi_digest(roi),
+        "created_at": datetime.now(),
+    }
+
+
+async def put_phash_async(db, document):
+    """
+    Enregistre le hash perceptuel de la région d'intérêt d'un scanner (document construit
+    par phash_document). Même clé que la ROI : le hash est recalculé quand les paramètres
+    de prétraitement changent.
+    """
+    await db[PHASH_COLLECTION].replace_one(
+        {"_id": roi_key(document["scan_id"], document["preprocessing_version"])},
+        document,
+        upsert=True,
+    )
+
+
+async def find_exact_async(db, preprocessing_version, phash):
+    """
+    Returns:
+    - list des scan_id dont la ROI a exactement ce hash
+    """
+    entries = await db[PHASH_COLLECTION].find(
+        {"phash": format_hash(phash), "preprocessing_version": preprocessing_version},
+        {"scan_id": 1},
+    ).to_list(None)
+    return [entry["scan_id"] for entry in entries]
+
+
+async def find_same_roi_async(db, preprocessing_version, roi):
+    """
+    Returns:
+    - list des scan_id dont la ROI est identique à roi (même entrée pour le modèle)
+    """
+    entries = await db[PHASH_COLLECTION].find(
+        {"roi_sha256": roi_digest(roi), "preprocessing_version": preprocessing_version},
+        {"scan_id": 1},
+    ).to_list(None)
+    return [entry["scan_id"] for entry in entries]
+
+
+def backfill_phashes(db, batch_size=500):
+    """
+    Calcule le hash perceptuel des ROIs déjà stockées qui n'en ont pas encore (scanners
+    ingérés avant la détection des doublons, ou importés par common.import_patients), ou
+    dont le document n'a pas encore roi_sha256. Peut être interrompu et relancé.
+
+    Returns:
+    - int, nombre de hash calculés
+    """
+    computed = 0
+    last_id = None
+    while True:
+        query = {} if last_id is None else {"_id": {"$gt": last_id}}
+        entries = list(
+            db[ROI_COLLECTION]
+            .find(query, {"scan_id": 1, "preprocessing_version": 1, "shape": 1, "roi": 1})
+            .sort("_id", 1)
+            .limit(batch_size)
+        )
+        if not entries:
+            break
+        last_id = entries[-1]["_id"]
+
+        done = {
+            entry["_id"]
+            for entry in db[PHASH_COLLECTION].find(
+                {
+                    "_id": {"$in": [entry["_id"] for entry in entries]},
+                    "roi_sha256": {"$exists": True},
+                },
+                {"_id": 1},
+            )
+        }
+        operations = []
+        for entry in entries:
+            if entry["_id"] in done:
+                continue
+            roi = np.frombuffer(entry["roi"], dtype=np.uint8).reshape(entry["shape"])
+            document = phash_document(entry["scan_id"], entry["preprocessing_version"], roi)
+            created_at = document.pop("created_at")
+            operations.append(
+                UpdateOne(
+                    {"_id": entry["_id"]},
+                    {"$set": document, "$setOnInsert": {"created_at": created_at}},
+                    upsert=True,
+                )
+            )
+        if operations:
+            db[PHASH_COLLECTION].bulk_write(operations, ordered=False)
+            computed += len(operations)
+            print(f"{computed} hash calculé(s)")
+    return computed
+
+
+def calibrate(db, max_distance=8):
+    """
+    Nombre d'autres scanners à distance <= d de chaque scanner, pour d de 0 à
+    max_distance, sur les hash stockés : aide à choisir NEAR_DUPLICATE_DISTANCE. Un
+    seuil qui signale plus d'un ou deux scanners par scanner signale surtout du bruit.
+
+    Returns:
+    - dict {version de prétraitement: list de (d, moyenne, 95e centile, maximum)}
+    """
+    indexes = {}
+    projection = {"scan_id": 1, "phash": 1, "preprocessing_version": 1}
+    for entry in db[PHASH_COLLECTION].find({}, projection):
+        index = indexes.setdefault(entry["preprocessing_version"], PerceptualHashIndex())
+        index.add(entry["scan_id"], int(entry["phash"], 16))
+
+    report = {}
+    for version, index in indexes.items():
+        hashes = index.hashes()
+        report[version] = []
+        for distance in range(max_distance + 1):
+            counts = np.array([len(index.search(phash, distance)) - 1 for phash in hashes])
+            p95 = float(np.percentile(counts, 95))
+            report[version].append((distance, float(counts.mean()), p95, int(counts.max())))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hash perceptuels des ROIs stockées")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument(
+        "--calibrate", action="store_true",
+        help="afficher le nombre de doublons signalés selon la distance, sans rien écrire",
+    )
+    parser.add_argument("--max-distance", type=int, default=8)
+    parser.add_argument("--mongo-uri", default=None)
+    args = parser.parse_args()
+
+    if args.mongo_uri is None:
+        from hidden import MONGO_URI
+
+        args.mongo_uri = MONGO_URI
+
+    db = MongoClient(args.mongo_uri)["braintumor"]
+    if args.calibrate:
+        for version, rows in calibrate(db, args.max_distance).items():
+            print(f"Prétraitement {version} :")
+            for distance, mean, p95, maximum in rows:
+                print(
+                    f"  d <= {distance} : {mean:.2f} en moyenne, {p95:.0f} (95e centile), "
+                    f"{maximum} au plus"
+                )
+    else:
+        print(f"Terminé : {backfill_phashes(db, args.batch_size)} hash calculé(s)")
@@ -0,0 +1,475 @@
+import base64
+import binascii
+import hashlib
+from datetime import datetime, timezone
+
+import cv2
+import gridfs
+import numpy as np
+from bson import Binary
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError
+
+# Les scanners sont stockés dans GridFS, indexés par le hash SHA-256 de leur contenu
+SCAN_BUCKET = "scans"
+
+# Signatures des formats d'image acceptés
+_SIGNATURES = {
+    b"\xff\xd8\xff": "image/jpeg",
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"GIF87a": "image/gif",
+    b"GIF89a": "image/gif",
+    b"BM": "image/bmp",
+}
+
+
+def sniff_content_type(data):
+    """
+    Détecte le type MIME d'une image à partir de ses premiers octets.
+
+    Args:
+    - data: bytes, début du fichier
+
+    Returns:
+    - str, type MIME (application/octet-stream si le format est inconnu)
+    """
+    for signature, content_type in _SIGNATURES.items():
+        if data.startswith(signature):
+            return content_type
+    return "application/octet-stream"
+
+
+def scan_bucket(db):
+    return gridfs.GridFSBucket(db, bucket_name=SCAN_BUCKET)
+
+
+def async_scan_bucket(db):
+    return AsyncIOMotorGridFSBucket(db, bucket_name=SCAN_BUCKET)
+
+
+# Formats acceptés à l'envoi d'un scanner, et taille des morceaux lus
+UPLOAD_CONTENT_TYPES = ("image/jpeg", "image/png")
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+
+class ScanUploadError(ValueError):
+    """Scanner refusé à l'envoi."""
+
+
+class UnsupportedScanError(ScanUploadError):
+    """Le fichier n'est pas une image JPEG ou PNG."""
+
+
+class ScanTooLargeError(ScanUploadError):
+    """Le fichier dépasse la taille maximale."""
+
+
+def _scan_reference(scan_id, size, content_type):
+    return {
+        "scan_id": scan_id,
+        "scan_size": size,
+        "scan_content_type": content_type,
+        # Date à laquelle le scanner est associé au patient : curseur du polling des
+        # prédictions en arrière-plan
+        "uploaded_at": datetime.now(),
+    }
+
+
+def _legacy_buffer(scanner):
+    # Ancien format : image en base64 dans le document patient
+    if scanner.get("scanner_img"):
+        try:
+            return np.frombuffer(base64.b64decode(scanner["scanner_img"]), np.uint8)
+        except binascii.Error:
+            return None
+    return None
+
+
+def has_scan(scanner):
+    # Référence GridFS, ou image base64 pas encore migrée
+    return bool(scanner.get("scan_id") or scanner.get("scanner_img"))
+
+
+def put_scan(db, data, filename=None):
+    """
+    Enregistre un scanner dans GridFS. Un contenu déjà présent n'est pas réécrit.
+
+    Args:
+    - db: base MongoDB (pymongo)
+    - data: bytes, contenu de l'image
+    - filename: str, nom d'origine du fichier
+
+    Returns:
+    - dict, référence et métadonnées à stocker dans le document patient
+    """
+    scan_id = hashlib.sha256(data).hexdigest()
+    content_type = sniff_content_type(data)
+
+    if db[f"{SCAN_BUCKET}.files"].count_documents({"_id": scan_id}, limit=1) == 0:
+        try:
+            scan_bucket(db).upload_from_stream_with_id(
+                scan_id,
+                filename or scan_id,
+                data,
+                metadata={"content_type": content_type},
+            )
+        except gridfs.errors.FileExists:
+            # Le même contenu vient d'être enregistré par une autre requête
+            pass
+
+    return _scan_reference(scan_id, len(data), content_type)
+
+
+# Taille des chunks GridFS (la valeur par défaut des drivers)
+GRIDFS_CHUNK_SIZE = 255 * 1024
+
+
+def ensure_scan_indexes(db):
+    # Index créés par les drivers à la première écriture GridFS, nécessaires ici
+    # quand les scanners sont écrits directement par put_scans_bulk
+    db[f"{SCAN_BUCKET}.chunks"].create_index(
+        [("files_id", ASCENDING), ("n", ASCENDING)], unique=True
+    )
+    db[f"{SCAN_BUCKET}.files"].create_index([("filename", ASCENDING), ("uploadDate", ASCENDING)])
+
+
+def insert_many_ignoring_duplicates(collection, documents):
+    """
+    insert_many non ordonné, où les documents déjà présents (clé en double) ne sont pas
+    des erreurs.
+
+    Returns:
+    - set des positions des documents qui n'ont pas été insérés car déjà présents
+    """
+    if not documents:
+        return set()
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details["writeErrors"]
+        if any(error["code"] != 11000 for error in errors):
+            raise
+        return {error["index"] for error in errors}
+    return set()
+
+
+def put_scans_bulk(db, scans):
+    """
+    Enregistre plusieurs scanners dans GridFS avec deux insert_many (les chunks, puis
+    les documents des fichiers), au lieu d'un upload par scanner. Les contenus déjà
+    présents ne sont pas réécrits. Comme les fichiers sont écrits après leurs chunks,
+    un scanner n'est jamais visible à moitié écrit ; après une interruption, les chunks
+    déjà écrits sont ignorés à la reprise.
+
+    Args:
+    - db: base MongoDB (pymongo)
+    - scans: list de (scan_id, contenu, nom du fichier, type MIME), scan_id uniques
+
+    Returns:
+    - list des scan_id enregistrés (absents de GridFS avant l'appel)
+    """
+    files = db[f"{SCAN_BUCKET}.files"]
+    existing = {
+        entry["_id"]
+        for entry in files.find({"_id": {"$in": [scan[0] for scan in scans]}}, {"_id": 1})
+    }
+    new_scans = [scan for scan in scans if scan[0] not in existing]
+
+    upload_date = datetime.now(timezone.utc)
+    chunks = []
+    file_documents = []
+    for scan_id, data, filename, content_type in new_scans:
+        for n, start in enumerate(range(0, len(data), GRIDFS_CHUNK_SIZE)):
+            chunks.append(
+                {"files_id": scan_id, "n": n, "data": Binary(data[start : start + GRIDFS_CHUNK_SIZE])}
+            )
+        file_documents.append(
+            {
+                "_id": scan_id,
+                "length": len(data),
+                "chunkSize": GRIDFS_CHUNK_SIZE,
+                "uploadDate": upload_date,
+                "filename": filename or scan_id,
+                "metadata": {"content_type": content_type},
+            }
+        )
+    insert_many_ignoring_duplicates(db[f"{SCAN_BUCKET}.chunks"], chunks)
+    insert_many_ignoring_duplicates(files, file_documents)
+    return [scan[0] for scan in new_scans]
+
+
+async def put_scan_async(db, data, filename=None):
+    """
+    Version asynchrone de put_scan, pour une base motor.
+    """
+    scan_id = hashlib.sha256(data).hexdigest()
+    content_type = sniff_content_type(data)
+
+    if await db[f"{SCAN_BUCKET}.files"].count_documents({"_id": scan_id}, limit=1) == 0:
+        try:
+            await async_scan_bucket(db).upload_from_stream_with_id(
+                scan_id,
+                filename or scan_id,
+                data,
+                metadata={"content_type": content_type},
+            )
+        except gridfs.errors.FileExists:
+            pass
+
+    return _scan_reference(scan_id, len(data), content_type)
+
+
+async def put_scan_file_async(db, upload, filename=None, max_size=None, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Enregistre un scanner envoyé en fichier (multipart), sans le charger en mémoire.
+
+    Le fichier est lu une première fois morceau par morceau pour calculer son hash et
+    vérifier son format et sa taille, puis copié dans GridFS morceau par morceau s'il
+    n'y est pas déjà.
+
+    Args:
+    - db: base MongoDB (motor)
+    - upload: fichier avec des méthodes asynchrones read(size) et seek(offset), par
+      exemple un UploadFile de FastAPI
+    - filename: str, nom d'origine du fichier
+    - max_size: int, taille maximale en octets (None : pas de limite)
+    - chunk_size: int, taille des morceaux lus
+
+    Returns:
+    - dict, référence et métadonnées à stocker dans le document patient
+
+    Raises:
+    - UnsupportedScanError: fichier vide ou qui n'est pas une image JPEG ou PNG
+    - ScanTooLargeError: fichier de plus de max_size octets
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    content_type = None
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            break
+        if content_type is None:
+            # Format reconnu dès le premier morceau, avant de lire la suite
+            content_type = sniff_content_type(chunk)
+            if content_type not in UPLOAD_CONTENT_TYPES:
+                raise UnsupportedScanError("Le scanner doit être une image JPEG ou PNG")
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise ScanTooLargeError(f"Le scanner dépasse {max_size} octets")
+        sha256.update(chunk)
+    if content_type is None:
+        raise UnsupportedScanError("Le fichier du scanner est vide")
+
+    scan_id = sha256.hexdigest()
+    if await db[f"{SCAN_BUCKET}.files"].count_documents({"_id": scan_id}, limit=1) == 0:
+        await upload.seek(0)
+        grid_in = async_scan_bucket(db).open_upload_stream_with_id(
+            scan_id, filename or scan_id, metadata={"content_type": content_type}
+        )
+        try:
+            while True:
+                chunk = await upload.read(chunk_size)
+                if not chunk:
+                    break
+                await grid_in.write(chunk)
+            await grid_in.close()
+        except gridfs.errors.FileExists:
+            # Le même contenu est en cours d'écriture par une autre requête : ses chunks
+            # ne doivent pas être supprimés
+            pass
+        except BaseException:
+            await grid_in.abort()
+            raise
+
+    return _scan_reference(scan_id, size, content_type)
+
+
+def open_scan(db, scan_id):
+    """
+    Ouvre un scanner en lecture, pour le lire morceau par morceau.
+
+    Returns:
+    - gridfs.GridOut, itérable sur les chunks du fichier
+    """
+    return scan_bucket(db).open_download_stream(scan_id)
+
+
+async def open_scan_async(db, scan_id):
+    """
+    Version asynchrone de open_scan.
+
+    Returns:
+    - motor AsyncIOMotorGridOut, lu avec await grid_out.readchunk()
+    """
+    return await async_scan_bucket(db).open_download_stream(scan_id)
+
+
+def read_scan_buffer(db, scanner):
+    """
+    Lit le scanner d'un patient dans un buffer numpy, prêt pour cv2.imdecode.
+
+    Args:
+    - db: base MongoDB (pymongo)
+    - scanner: dict, sous-document "scanner" du patient
+
+    Returns:
+    - np.array (uint8) ou None si le patient n'a pas de scanner lisible
+    """
+    if scanner.get("scan_id"):
+        try:
+            grid_out = open_scan(db, scanner["scan_id"])
+        except gridfs.errors.NoFile:
+            return None
+
+        # Copier les chunks directement dans un buffer préalloué
+        buffer = np.empty(grid_out.length, dtype=np.uint8)
+        offset = 0
+        while True:
+            chunk = grid_out.readchunk()
+            if not chunk:
+                break
+            buffer[offset : offset + len(chunk)] = np.frombuffer(chunk, np.uint8)
+            offset += len(chunk)
+        return buffer
+
+    return _legacy_buffer(scanner)
+
+
+async def read_scan_buffer_async(db, scanner):
+    """
+    Version asynchrone de read_scan_buffer, pour une base motor.
+    """
+    if scanner.get("scan_id"):
+        try:
+            grid_out = await open_scan_async(db, scanner["scan_id"])
+        except gridfs.errors.NoFile:
+            return None
+
+        buffer = np.empty(grid_out.length, dtype=np.uint8)
+        offset = 0
+        while True:
+            chunk = await grid_out.readchunk()
+            if not chunk:
+                break
+            buffer[offset : offset + len(chunk)] = np.frombuffer(chunk, np.uint8)
+            offset += len(chunk)
+        return buffer
+
+    return _legacy_buffer(scanner)
+
+
+# Régions d'intérêt normalisées (entrée du modèle), calculées une fois à l'ingestion
+ROI_COLLECTION = "scan_rois"
+
+
+def roi_key(scan_id, preprocessing_version):
+    return f"{scan_id}:{preprocessing_version}"
+
+
+async def put_roi_async(db, scan_id, preprocessing_version, roi, box, params):
+    """
+    Enregistre la région d'intérêt normalisée d'un scanner, en octets uint8 bruts.
+
+    Args:
+    - db: base MongoDB (motor)
+    - scan_id: str, hash du scanner
+    - preprocessing_version: str, identifiant des paramètres de prétraitement
+    - roi: np.array (uint8), image normalisée
+    - box: tuple, rectangle (x, y, w, h) du crop dans l'image d'origine, ou None
+    - params: dict, paramètres de prétraitement utilisés
+    """
+    roi = np.ascontiguousarray(roi, dtype=np.uint8)
+    await db[ROI_COLLECTION].replace_one(
+        {"_id": roi_key(scan_id, preprocessing_version)},
+        {
+            "scan_id": scan_id,
+            "preprocessing_version": preprocessing_version,
+            "params": params,
+            "shape": list(roi.shape),
+            "box": list(box) if box is not None else None,
+            "roi": Binary(roi.tobytes()),
+        },
+        upsert=True,
+    )
+
+
+def get_roi(db, scan_id, preprocessing_version):
+    """
+    Version synchrone de get_roi_async, pour une base pymongo.
+    """
+    entry = db[ROI_COLLECTION].find_one(
+        {"_id": roi_key(scan_id, preprocessing_version)}, {"roi": 1, "shape": 1}
+    )
+    if entry is None:
+        return None
+    return np.frombuffer(entry["roi"], dtype=np.uint8).reshape(entry["shape"])
+
+
+async def get_roi_async(db, scan_id, preprocessing_version):
+    """
+    Returns:
+    - np.array (uint8) de la région d'intérêt, ou None si elle n'a pas été calculée
+    """
+    entry = await db[ROI_COLLECTION].find_one(
+        {"_id": roi_key(scan_id, preprocessing_version)}, {"roi": 1, "shape": 1}
+    )
+    if entry is None:
+        return None
+    return np.frombuffer(entry["roi"], dtype=np.uint8).reshape(entry["shape"])
+
+
+# Miniatures JPEG des scanners, calculées une fois (à l'ingestion) pour les pages
+THUMBNAIL_COLLECTION = "scan_thumbnails"
+THUMBNAIL_SIZE = 256
+THUMBNAIL_QUALITY = 80
+
+
+def thumbnail_key(scan_id, size=THUMBNAIL_SIZE):
+    return f"{scan_id}:{size}"
+
+
+def make_thumbnail(image_data, size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY):
+    """
+    Réduit un scanner pour qu'il tienne dans un carré de size pixels, en gardant ses
+    proportions, et l'encode en JPEG.
+
+    Args:
+    - image_data: np.array (uint8), contenu du fichier image
+
+    Returns:
+    - bytes, miniature JPEG, ou None si l'image ne peut pas être décodée
+    """
+    image = cv2.imdecode(image_data, cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    height, width = image.shape[:2]
+    scale = size / max(height, width)
+    if scale < 1:
+        image = cv2.resize(
+            image,
+            (max(1, round(width * scale)), max(1, round(height * scale))),
+            interpolation=cv2.INTER_AREA,
+        )
+    ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return encoded.tobytes() if ok else None
+
+
+async def put_thumbnail_async(db, scan_id, thumbnail, size=THUMBNAIL_SIZE):
+    await db[THUMBNAIL_COLLECTION].replace_one(
+        {"_id": thumbnail_key(scan_id, size)},
+        {"scan_id": scan_id, "size": size, "thumbnail": Binary(thumbnail)},
+        upsert=True,
+    )
+
+
+async def get_thumbnail_async(db, scan_id, size=THUMBNAIL_SIZE):
+    """
+    Returns:
+    - bytes, miniature JPEG, ou None si elle n'a pas été calculée
+    """
+    entry = await db[THUMBNAIL_COLLECTION].find_one(
+        {"_id": thumbnail_key(scan_id, size)}, {"thumbnail": 1}
+    )
+    return bytes(entry["thumbnail"]) if entry is not None else None
@@ -0,0 +1,535 @@
+"""
+Jeu de données d'entraînement en blocs (shards) de tenseurs uint8, lus en memmap.
+
+Format d'un dossier de jeu de données :
+- meta.json : nombre d'images, forme des images, taille des blocs, classes, version
+  du prétraitement et liste des blocs
+- shard_00000.npy, ... : images normalisées (n, hauteur, largeur, 3) en uint8. Tous
+  les blocs ont shard_size images, sauf le dernier
+- labels.npy : label de chaque image (int64)
+- metadata.jsonl : une ligne par image (fichier source ou patient et scanner)
+- splits/<nom>.npy : indices des images de chaque split (train, test, val)
+
+Usage (depuis la racine du dépôt) :
+    python -m tumor_detection_model.functions.dataset --from-folders data/raw --output data/dataset
+    python -m tumor_detection_model.functions.dataset --from-mongo --output data/dataset
+    python -m tumor_detection_model.functions.dataset --from-feedback --output data/retrain
+"""
+import argparse
+import itertools
+import json
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../..")))
+
+from tumor_detection_model.functions.load_images import list_images  # noqa: E402
+from tumor_detection_model.functions.normalize_images import (  # noqa: E402
+    chunk_bounds,
+    normalize_image_with_box,
+    preprocessing_version,
+)
+
+FORMAT_VERSION = 1
+DEFAULT_SPLITS = {"train": 0.7, "test": 0.15, "val": 0.15}
+
+
+def make_splits(labels, fractions=None, seed=42):
+    """
+    Découpe les indices en splits aléatoires, stratifiés par label.
+
+    Args:
+    - labels: np.array des labels
+    - fractions: dict {nom: fraction}, par défaut 70 % train, 15 % test, 15 % val
+    - seed: int, graine du tirage
+
+    Returns:
+    - dict {nom: np.array des indices triés}
+    """
+    fractions = fractions or DEFAULT_SPLITS
+    rng = np.random.default_rng(seed)
+    names = list(fractions)
+    total = sum(fractions.values())
+    splits = {name: [] for name in names}
+
+    for label in np.unique(labels):
+        indices = np.flatnonzero(labels == label)
+        rng.shuffle(indices)
+        # Bornes cumulées, le dernier split prend le reste
+        bounds = np.cumsum([fractions[name] / total for name in names])
+        ends = np.round(bounds * len(indices)).astype(int)
+        ends[-1] = len(indices)
+        start = 0
+        for name, end in zip(names, ends):
+            splits[name].append(indices[start:end])
+            start = end
+
+    return {name: np.sort(np.concatenate(parts)) for name, parts in splits.items()}
+
+
+class DatasetWriter:
+    """
+    Écrit un jeu de données bloc par bloc. Seul le bloc en cours est en mémoire.
+
+    Args:
+    - output_dir: str, dossier du jeu de données (remplacé s'il existe)
+    - target_size: tuple, taille des images (largeur, hauteur)
+    - shard_size: int, nombre d'images par bloc
+    - classes: dict {nom: label}
+    """
+
+    def __init__(self, output_dir, target_size, shard_size, classes):
+        self.output_dir = output_dir
+        self.target_size = target_size
+        self.shard_size = shard_size
+        self.classes = classes
+        width, height = target_size
+        self.image_shape = (height, width, 3)
+
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        os.makedirs(os.path.join(output_dir, "splits"))
+
+        self.shards = []
+        self.labels = []
+        self.metadata_file = open(os.path.join(output_dir, "metadata.jsonl"), "w")
+        self.current = None
+        self.filled = 0
+
+    def _open_shard(self):
+        name = f"shard_{len(self.shards):05d}.npy"
+        self.shards.append(name)
+        self.current = np.lib.format.open_memmap(
+            os.path.join(self.output_dir, name),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(self.shard_size,) + self.image_shape,
+        )
+        self.filled = 0
+
+    def _close_shard(self):
+        self.current.flush()
+        path = os.path.join(self.output_dir, self.shards[-1])
+        if self.filled < self.shard_size:
+            # Dernier bloc incomplet : le réécrire à sa taille exacte
+            images = np.array(self.current[: self.filled])
+            del self.current
+            np.save(path, images)
+        self.current = None
+
+    def write(self, images, labels, metadata):
+        """
+        Ajoute un lot d'images normalisées (n, hauteur, largeur, 3), avec leurs labels
+        et leurs métadonnées (liste de dict).
+        """
+        offset = 0
+        while offset < len(images):
+            if self.current is None:
+                self._open_shard()
+            count = min(self.shard_size - self.filled, len(images) - offset)
+            self.current[self.filled : self.filled + count] = images[offset : offset + count]
+            self.filled += count
+            offset += count
+            if self.filled == self.shard_size:
+                self._close_shard()
+
+        self.labels.extend(int(label) for label in labels)
+        for entry in metadata:
+            self.metadata_file.write(json.dumps(entry, default=str) + "\n")
+
+    def close(self, splits, source):
+        if self.current is not None:
+            self._close_shard()
+        self.metadata_file.close()
+
+        labels = np.array(self.labels, dtype=np.int64)
+        np.save(os.path.join(self.output_dir, "labels.npy"), labels)
+        for name, indices in splits.items():
+            np.save(os.path.join(self.output_dir, "splits", f"{name}.npy"), indices)
+
+        meta = {
+            "format": FORMAT_VERSION,
+            "num_samples": len(labels),
+            "image_shape": list(self.image_shape),
+            "dtype": "uint8",
+            "shard_size": self.shard_size,
+            "shards": self.shards,
+            "classes": self.classes,
+            "preprocessing_version": preprocessing_version(self.target_size),
+            "splits": {name: len(indices) for name, indices in splits.items()},
+            "source": source,
+            "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        with open(os.path.join(self.output_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        return meta
+
+
+def _normalize_rows(load, items, target_size, out):
+    # Décode et normalise chaque élément directement dans sa ligne de out
+    ok = np.zeros(len(items), dtype=bool)
+    for row, item in enumerate(items):
+        img = load(item)
+        if img is None:
+            continue
+        normalize_image_with_box(img, target_size, out[row])
+        ok[row] = True
+    return ok
+
+
+def _build(writer, records, load, executor, workers):
+    """
+    Normalise les éléments en parallèle, un bloc à la fois, et les ajoute au jeu de données.
+    Seul le bloc en cours est en mémoire.
+
+    Args:
+    - records: itérable de (élément, label, métadonnées), l'élément est passé à load
+    - load: callable, renvoie l'image décodée d'un élément, ou None s'il est illisible
+
+    Returns:
+    - int, nombre d'éléments ignorés (illisibles)
+    """
+    width, height = writer.target_size
+    records = iter(records)
+    skipped = 0
+    processed = 0
+    while True:
+        batch = list(itertools.islice(records, writer.shard_size))
+        if not batch:
+            break
+        items, labels, metadata = zip(*batch)
+        images = np.empty((len(batch), height, width, 3), dtype=np.uint8)
+        futures = [
+            executor.submit(
+                _normalize_rows, load, items[a:b], writer.target_size, images[a:b]
+            )
+            for a, b in chunk_bounds(len(batch), 64, workers)
+        ]
+        ok = np.concatenate([future.result() for future in futures])
+        skipped += int((~ok).sum())
+
+        rows = np.flatnonzero(ok)
+        writer.write(
+            images[rows] if len(rows) < len(batch) else images,
+            [labels[row] for row in rows],
+            [metadata[row] for row in rows],
+        )
+        processed += len(batch)
+        print(f"{processed} image(s) traitée(s)")
+    return skipped
+
+
+def build_from_folders(
+    source_dir,
+    output_dir,
+    target_size=(224, 224),
+    classes=None,
+    shard_size=1024,
+    fractions=None,
+    seed=42,
+    workers=None,
+):
+    """
+    Construit le jeu de données à partir d'un dossier par classe (ex: data/raw/yes, data/raw/no).
+
+    Returns:
+    - dict, contenu de meta.json
+    """
+    paths, labels, classes = list_images(source_dir, classes)
+    writer = DatasetWriter(output_dir, target_size, shard_size, classes)
+    workers = workers or os.cpu_count() or 1
+
+    records = (
+        (path, label, {"source": os.path.relpath(path, source_dir)})
+        for path, label in zip(paths, labels)
+    )
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        skipped = _build(
+            writer,
+            records,
+            lambda path: cv2.imread(path, cv2.IMREAD_COLOR),
+            executor,
+            workers,
+        )
+    if skipped:
+        print(f"{skipped} image(s) illisible(s) ignorée(s)")
+
+    return writer.close(
+        make_splits(np.array(writer.labels), fractions, seed), {"folders": source_dir}
+    )
+
+
+def _scan_loader(db):
+    from common.scan_store import read_scan_buffer
+
+    def load(scanner):
+        buffer = read_scan_buffer(db, scanner)
+        if buffer is None:
+            return None
+        return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+    return load
+
+
+def _build_from_records(
+    db, records, output_dir, target_size, shard_size, fractions, seed, workers, source
+):
+    from common.labels import CLASSES
+
+    writer = DatasetWriter(output_dir, target_size, shard_size, CLASSES)
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        skipped = _build(writer, records, _scan_loader(db), executor, workers)
+    if skipped:
+        print(f"{skipped} scanner(s) manquant(s) ou illisible(s) ignoré(s)")
+
+    return writer.close(make_splits(np.array(writer.labels), fractions, seed), source)
+
+
+def build_from_mongo(
+    db,
+    output_dir,
+    target_size=(224, 224),
+    shard_size=1024,
+    fractions=None,
+    seed=42,
+    workers=None,
+):
+    """
+    Construit le jeu de données à partir des patients dont la prédiction a été vérifiée
+    par un expert. Le label est celui de l'expert (voir common.labels.expert_label).
+    Un scanner présent chez plusieurs patients n'est ajouté qu'une fois.
+
+    Args:
+    - db: base MongoDB (pymongo)
+
+    Returns:
+    - dict, contenu de meta.json
+    """
+    from common.labels import VALIDATED_SCAN_QUERY, expert_label
+
+    projection = {
+        "scanner.scan_id": 1,
+        "scanner.scanner_img": 1,
+        "scanner.prediction": 1,
+    }
+
+    def records():
+        seen = set()
+        patients = db.patients.find(VALIDATED_SCAN_QUERY, projection).sort("_id", 1)
+        for patient in patients:
+            scanner = patient["scanner"]
+            scan_id = scanner.get("scan_id")
+            if scan_id in seen:
+                continue
+            if scan_id:
+                seen.add(scan_id)
+            prediction = scanner["prediction"]
+            yield scanner, expert_label(prediction), {
+                "patient_id": str(patient["_id"]),
+                "scan_id": scan_id,
+                "AI_predict": prediction.get("AI_predict"),
+                "predict_check": prediction.get("predict_check"),
+                "model_version": prediction.get("model_version"),
+            }
+
+    return _build_from_records(
+        db, records(), output_dir, target_size, shard_size, fractions, seed, workers,
+        {"mongodb": "patients"},
+    )
+
+
+def build_from_feedback(
+    db,
+    output_dir,
+    target_size=(224, 224),
+    shard_size=1024,
+    fractions=None,
+    seed=42,
+    workers=None,
+    model_version=None,
+    since=None,
+):
+    """
+    Construit un jeu de données de réentraînement à partir des retours des experts
+    (collection feedback), joints à leurs scanners. Les retours sont lus en flux ; pour
+    un scanner corrigé plusieurs fois, le retour le plus récent est gardé.
+
+    Args:
+    - db: base MongoDB (pymongo)
+    - model_version: str, ne garder que les retours sur les prédictions de ce modèle
+    - since: datetime, ne garder que les retours postérieurs
+
+    Returns:
+    - dict, contenu de meta.json
+    """
+    from common.feedback_store import iter_feedback
+
+    def records():
+        seen = set()
+        for feedback in iter_feedback(db, model_version, since):
+            scan_id = feedback.get("scan_id")
+            if not scan_id or scan_id in seen:
+                continue
+            seen.add(scan_id)
+            yield {"scan_id": scan_id}, feedback["label"], {
+                "patient_id": feedback["patient_id"],
+                "scan_id": scan_id,
+                "AI_predict": feedback["AI_predict"],
+                "expert_opinion": feedback["expert_opinion"],
+                "model_version": feedback.get("model_version"),
+                "feedback_at": feedback["created_at"],
+            }
+
+    source = {
+        "mongodb": "feedback",
+        "model_version": model_version,
+        "since": since.strftime("%Y-%m-%d %H:%M:%S") if since else None,
+    }
+    return _build_from_records(
+        db, records(), output_dir, target_size, shard_size, fractions, seed, workers, source
+    )
+
+
+class ShardedDataset:
+    """
+    Lecture d'un jeu de données en blocs. L'ouverture ne lit que meta.json et les labels :
+    les images sont lues à la demande, depuis les blocs ouverts en memmap.
+
+    Args:
+    - path: str, dossier du jeu de données
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["format"] != FORMAT_VERSION:
+            raise ValueError(f"Format de jeu de données non supporté : {self.meta['format']}")
+
+        self.shard_size = self.meta["shard_size"]
+        self.classes = self.meta["classes"]
+        self.labels = np.load(os.path.join(path, "labels.npy"), mmap_mode="r")
+        self.shards = [
+            np.load(os.path.join(path, name), mmap_mode="r") for name in self.meta["shards"]
+        ]
+
+    def __len__(self):
+        return self.meta["num_samples"]
+
+    def __getitem__(self, index):
+        shard, row = divmod(int(index), self.shard_size)
+        return self.shards[shard][row], int(self.labels[index])
+
+    def split(self, name):
+        """
+        Returns:
+        - np.array des indices du split
+        """
+        return np.load(os.path.join(self.path, "splits", f"{name}.npy"))
+
+    def metadata(self):
+        """
+        Returns:
+        - list des métadonnées de chaque image (lit tout metadata.jsonl)
+        """
+        with open(os.path.join(self.path, "metadata.jsonl")) as f:
+            return [json.loads(line) for line in f]
+
+    def get_batch(self, indices, out=None):
+        """
+        Lit un lot d'images dans un tableau contigu, bloc par bloc.
+
+        Returns:
+        - np.array (n, hauteur, largeur, 3) uint8, np.array des labels
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if out is None:
+            out = np.empty((len(indices),) + tuple(self.meta["image_shape"]), np.uint8)
+        shards, rows = np.divmod(indices, self.shard_size)
+        for shard in np.unique(shards):
+            positions = np.flatnonzero(shards == shard)
+            shard_rows = rows[positions]
+            # Lecture dans l'ordre du fichier
+            order = np.argsort(shard_rows)
+            out[positions[order]] = self.shards[shard][shard_rows[order]]
+        return out, np.asarray(self.labels[indices])
+
+    def batches(self, split=None, batch_size=32, shuffle=True, seed=None, drop_last=False):
+        """
+        Itère sur les mini-lots d'un split (ou de tout le jeu de données).
+
+        Yields:
+        - (X, y) : np.array (batch_size, hauteur, largeur, 3) uint8, np.array des labels
+        """
+        indices = self.split(split) if split is not None else np.arange(len(self))
+        if shuffle:
+            indices = np.random.default_rng(seed).permutation(indices)
+        end = len(indices) - len(indices) % batch_size if drop_last else len(indices)
+        for start in range(0, end, batch_size):
+            yield self.get_batch(indices[start : start + batch_size])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--from-folders", help="dossier contenant un sous-dossier par classe")
+    source.add_argument("--from-mongo", action="store_true", help="patients vérifiés par un expert")
+    source.add_argument("--from-feedback", action="store_true", help="retours des experts")
+    parser.add_argument("--model-version", default=None, help="avec --from-feedback")
+    parser.add_argument("--since", default=None, help="avec --from-feedback, date YYYY-MM-DD")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--target-size", type=int, default=224)
+    parser.add_argument("--shard-size", type=int, default=1024)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--mongo-uri", default=None)
+    args = parser.parse_args()
+
+    target_size = (args.target_size, args.target_size)
+    if args.from_folders:
+        meta = build_from_folders(
+            args.from_folders,
+            args.output,
+            target_size,
+            shard_size=args.shard_size,
+            seed=args.seed,
+            workers=args.workers,
+        )
+    else:
+        from pymongo import MongoClient
+
+        if args.mongo_uri is None:
+            from hidden import MONGO_URI
+
+            args.mongo_uri = MONGO_URI
+
+        db = MongoClient(args.mongo_uri)["braintumor"]
+        if args.from_feedback:
+            meta = build_from_feedback(
+                db,
+                args.output,
+                target_size,
+                shard_size=args.shard_size,
+                seed=args.seed,
+                workers=args.workers,
+                model_version=args.model_version,
+                since=datetime.strptime(args.since, "%Y-%m-%d") if args.since else None,
+            )
+        else:
+            meta = build_from_mongo(
+                db,
+                args.output,
+                target_size,
+                shard_size=args.shard_size,
+                seed=args.seed,
+                workers=args.workers,
+            )
+    print(f"Terminé : {meta['num_samples']} image(s), splits {meta['splits']}")
@@ -0,0 +1,640 @@
+"""
+Évaluation hors ligne d'un ou plusieurs modèles sur des scanners labellisés.
+
+Les images sont lues et normalisées en flux dans un pool de processus, puis passées par
+gros lots à chaque modèle : plusieurs versions sont évaluées en un seul passage sur les
+données décodées. Les métriques (accuracy, précision, rappel, ROC AUC, matrice de
+confusion) sont calculées au fil des lots, enregistrées dans un point de reprise, et
+envoyées à MLflow avec le débit.
+
+Sources :
+- --from-folders data/raw : un sous-dossier "yes" et un sous-dossier "no"
+- --from-mongo : les patients dont la prédiction a été vérifiée par un expert (label de
+  l'expert, ROI calculée à l'ingestion quand elle existe)
+- --from-dataset data/dataset : un jeu de données en blocs (voir dataset.py), déjà normalisé
+
+Usage (depuis la racine du dépôt) :
+    python -m tumor_detection_model.functions.evaluate --from-folders data/raw \\
+        --model runs:/<run_id>/model --model "runs:/<run_id>/model#onnx-int8"
+    python -m tumor_detection_model.functions.evaluate --from-mongo --resume
+"""
+import argparse
+import collections
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../..")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../api")))
+
+from common.labels import CLASSES  # noqa: E402
+from tumor_detection_model.functions.load_images import list_images  # noqa: E402
+from tumor_detection_model.functions.normalize_images import (  # noqa: E402
+    normalize_image_with_box,
+    preprocessing_version,
+)
+
+# Taille d'entrée du modèle
+TARGET_SIZE = (224, 224)
+ROC_BINS = 1000
+
+
+class StreamingMetrics:
+    """
+    Métriques de classification binaire, mises à jour lot par lot.
+
+    La matrice de confusion est comptée au seuil threshold. La courbe ROC et son aire
+    sont calculées à partir d'un histogramme des scores de chaque classe (bins
+    intervalles sur [0, 1]) : la mémoire ne dépend pas du nombre d'images, et l'état
+    tient dans le point de reprise.
+
+    Args:
+    - threshold: float, score au-dessus duquel la prédiction est "tumeur"
+    - bins: int, nombre d'intervalles de l'histogramme des scores
+    """
+
+    def __init__(self, threshold=0.5, bins=ROC_BINS):
+        self.threshold = threshold
+        self.bins = bins
+        # confusion[label réel][label prédit]
+        self.confusion = np.zeros((2, 2), dtype=np.int64)
+        # histograms[label réel][intervalle du score]
+        self.histograms = np.zeros((2, bins), dtype=np.int64)
+        self.log_loss_sum = 0.0
+
+    def update(self, scores, labels):
+        scores = np.clip(np.asarray(scores, dtype=np.float64).reshape(-1), 0.0, 1.0)
+        labels = np.asarray(labels, dtype=np.int64)
+        predicted = (scores > self.threshold).astype(np.int64)
+        np.add.at(self.confusion, (labels, predicted), 1)
+        bins = np.minimum((scores * self.bins).astype(np.int64), self.bins - 1)
+        np.add.at(self.histograms, (labels, bins), 1)
+        p = np.clip(scores, 1e-7, 1 - 1e-7)
+        self.log_loss_sum -= float(np.sum(labels * np.log(p) + (1 - labels) * np.log(1 - p)))
+
+    def roc_curve(self):
+        """
+        Returns:
+        - (np.array des taux de faux positifs, np.array des taux de vrais positifs), des
+          seuils les plus hauts aux plus bas
+        """
+        negatives, positives = self.histograms
+        fp = np.concatenate([[0], np.cumsum(negatives[::-1])])
+        tp = np.concatenate([[0], np.cumsum(positives[::-1])])
+        return fp / max(fp[-1], 1), tp / max(tp[-1], 1)
+
+    def roc_auc(self):
+        # Méthode des trapèzes : les scores d'un même intervalle comptent comme des ex aequo
+        if not self.histograms[0].any() or not self.histograms[1].any():
+            return None
+        fpr, tpr = self.roc_curve()
+        return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+    def summary(self):
+        (tn, fp), (fn, tp) = self.confusion.tolist()
+        total = tn + fp + fn + tp
+
+        def ratio(a, b):
+            return a / b if b else None
+
+        precision = ratio(tp, tp + fp)
+        recall = ratio(tp, tp + fn)
+        return {
+            "images": total,
+            "accuracy": ratio(tp + tn, total),
+            "precision": precision,
+            "recall": recall,
+            "specificity": ratio(tn, tn + fp),
+            "f1": ratio(2 * precision * recall, precision + recall) if precision and recall else None,
+            "roc_auc": self.roc_auc(),
+            "log_loss": ratio(self.log_loss_sum, total),
+            "confusion_matrix": {"tn": tn, "fp": fp, "fn": fn, "tp": tp},
+        }
+
+    def state(self):
+        return {
+            "threshold": self.threshold,
+            "bins": self.bins,
+            "confusion": self.confusion.tolist(),
+            "histograms": self.histograms.tolist(),
+            "log_loss_sum": self.log_loss_sum,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        metrics = cls(state["threshold"], state["bins"])
+        metrics.confusion = np.array(state["confusion"], dtype=np.int64)
+        metrics.histograms = np.array(state["histograms"], dtype=np.int64)
+        metrics.log_loss_sum = state["log_loss_sum"]
+        return metrics
+
+
+def parse_model_spec(spec, default_backend="mlflow"):
+    """
+    "runs:/<run_id>/model#onnx" -> ("runs:/<run_id>/model", "onnx"). Sans "#", le
+    backend par défaut est utilisé.
+    """
+    model_uri, _, backend = spec.partition("#")
+    return model_uri, backend or default_backend
+
+
+class EvaluatedModel:
+    """
+    Un modèle évalué, avec ses métriques, son temps de calcul et son run MLflow.
+    """
+
+    def __init__(self, spec, model_uri, backend, model, version):
+        self.spec = spec
+        self.model_uri = model_uri
+        self.backend = backend
+        self.model = model
+        self.version = version
+        self.metrics = StreamingMetrics()
+        self.model_seconds = 0.0
+        self.run_id = None
+
+    def predict(self, images, labels):
+        start = time.perf_counter()
+        outputs = np.asarray(self.model.predict(images)).reshape(len(images), -1)
+        self.model_seconds += time.perf_counter() - start
+        # Première sortie : probabilité de tumeur, comme dans l'API du modèle
+        self.metrics.update(outputs[:, 0], labels)
+
+    def report(self, elapsed_seconds):
+        summary = self.metrics.summary()
+        images = summary["images"]
+        return {
+            "model_uri": self.model_uri,
+            "backend": self.backend,
+            "model_version": self.version,
+            "mlflow_run_id": self.run_id,
+            **summary,
+            "model_seconds": self.model_seconds,
+            "model_images_per_s": images / self.model_seconds if self.model_seconds else None,
+            "images_per_s": images / elapsed_seconds if elapsed_seconds else None,
+        }
+
+    def state(self):
+        return {
+            "spec": self.spec,
+            "model_version": self.version,
+            "mlflow_run_id": self.run_id,
+            "model_seconds": self.model_seconds,
+            "metrics": self.metrics.state(),
+        }
+
+    def restore(self, state):
+        if state["model_version"] != self.version:
+            raise ValueError(
+                f"{self.spec} : la version du modèle a changé depuis le point de reprise "
+                f"({state['model_version']} -> {self.version})"
+            )
+        self.run_id = state["mlflow_run_id"]
+        self.model_seconds = state["model_seconds"]
+        self.metrics = StreamingMetrics.from_state(state["metrics"])
+
+
+class MlflowLogger:
+    """
+    Un run MLflow par modèle évalué, dans l'expérience experiment. Les métriques sont
+    envoyées à chaque point de reprise (step = nombre d'images), puis à la fin avec le
+    rapport complet en artefact.
+    """
+
+    def __init__(self, experiment):
+        from mlflow.tracking import MlflowClient
+
+        self.client = MlflowClient()
+        found = self.client.get_experiment_by_name(experiment)
+        self.experiment_id = (
+            found.experiment_id if found else self.client.create_experiment(experiment)
+        )
+
+    def start(self, evaluated, params):
+        if evaluated.run_id is not None:
+            return
+        run = self.client.create_run(
+            self.experiment_id,
+            tags={"mlflow.runName": f"evaluation {evaluated.version}", "task": "evaluation"},
+        )
+        evaluated.run_id = run.info.run_id
+        for key, value in {
+            **params,
+            "model_uri": evaluated.model_uri,
+            "backend": evaluated.backend,
+            "model_version": evaluated.version,
+        }.items():
+            self.client.log_param(evaluated.run_id, key, value)
+
+    def log(self, evaluated, elapsed_seconds):
+        report = evaluated.report(elapsed_seconds)
+        step = report["images"]
+        values = {
+            key: report[key]
+            for key in (
+                "accuracy", "precision", "recall", "specificity", "f1", "roc_auc", "log_loss",
+                "model_images_per_s", "images_per_s",
+            )
+        }
+        values.update(report["confusion_matrix"])
+        for key, value in values.items():
+            if value is not None:
+                self.client.log_metric(evaluated.run_id, key, value, step=step)
+        return report
+
+    def finish(self, evaluated, report):
+        fpr, tpr = evaluated.metrics.roc_curve()
+        self.client.log_dict(evaluated.run_id, report, "evaluation.json")
+        self.client.log_dict(
+            evaluated.run_id, {"fpr": fpr.tolist(), "tpr": tpr.tolist()}, "roc_curve.json"
+        )
+        self.client.set_terminated(evaluated.run_id)
+
+
+# Chargement des images dans les processus du pool (une connexion MongoDB par processus)
+_worker = {}
+
+
+def _init_worker(source, mongo_uri, database):
+    cv2.setNumThreads(1)
+    _worker["source"] = source
+    if source == "mongo":
+        from pymongo import MongoClient
+
+        _worker["db"] = MongoClient(mongo_uri)[database]
+
+
+def _load_normalized(item, out):
+    """
+    Écrit l'image normalisée d'un élément dans out. Returns: bool, False si illisible.
+    """
+    if _worker["source"] == "folders":
+        img = cv2.imread(item, cv2.IMREAD_COLOR)
+    else:
+        from common.scan_store import get_roi, read_scan_buffer
+
+        db = _worker["db"]
+        if item.get("scan_id"):
+            # ROI calculée à l'ingestion avec les mêmes paramètres : rien à décoder
+            roi = get_roi(db, item["scan_id"], preprocessing_version(TARGET_SIZE))
+            if roi is not None and roi.shape == out.shape:
+                out[...] = roi
+                return True
+        buffer = read_scan_buffer(db, item)
+        img = None if buffer is None else cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if img is None:
+        return False
+    normalize_image_with_box(img, TARGET_SIZE, out)
+    return True
+
+
+def _preprocess_chunk(items):
+    width, height = TARGET_SIZE
+    images = np.empty((len(items), height, width, 3), dtype=np.uint8)
+    ok = np.array([_load_normalized(item, images[row]) for row, item in enumerate(items)])
+    return images[ok], ok
+
+
+def folder_records(source_dir):
+    paths, labels, _ = list_images(source_dir, CLASSES)
+    return zip(paths, labels.tolist())
+
+
+def mongo_records(db, after=None):
+    """
+    Scanners des patients vérifiés par un expert, avec le label de l'expert, dans
+    l'ordre des _id. Un scanner partagé par plusieurs patients n'est évalué qu'une fois.
+
+    Args:
+    - db: base MongoDB (pymongo)
+    - after: ObjectId, dernier patient évalué lors d'une reprise, ou None. La reprise se
+      fait par _id et non par position : les patients vérifiés entre-temps ne décalent pas
+      la lecture
+
+    Yields:
+    - (sous-document scanner avec patient_id, label de l'expert)
+    """
+    from common.labels import VALIDATED_SCAN_QUERY, expert_label
+
+    query = dict(VALIDATED_SCAN_QUERY)
+    seen = set()
+    if after is not None:
+        # Les scanners déjà évalués sont relus (sans leur image) pour retrouver les doublons
+        done = {**VALIDATED_SCAN_QUERY, "_id": {"$lte": after}}
+        for patient in db.patients.find(done, {"scanner.scan_id": 1}):
+            if patient["scanner"].get("scan_id"):
+                seen.add(patient["scanner"]["scan_id"])
+        query["_id"] = {"$gt": after}
+    projection = {"scanner.scan_id": 1, "scanner.scanner_img": 1, "scanner.prediction": 1}
+    for patient in db.patients.find(query, projection).sort("_id", 1):
+        scanner = patient["scanner"]
+        scan_id = scanner.get("scan_id")
+        if scan_id in seen:
+            continue
+        if scan_id:
+            seen.add(scan_id)
+        item = {key: scanner[key] for key in ("scan_id", "scanner_img") if key in scanner}
+        item["patient_id"] = str(patient["_id"])
+        yield item, expert_label(scanner["prediction"])
+
+
+def preprocessed_batches(records, source, workers, chunk_size, mongo_uri=None, database=None):
+    """
+    Normalise les éléments dans un pool de processus, en gardant au plus 2 blocs par
+    processus en cours : les blocs sont rendus dans l'ordre, pendant que les suivants
+    sont calculés.
+
+    Args:
+    - records: itérable de (élément, label)
+    - source: str, "folders" (élément = chemin) ou "mongo" (élément = sous-document scanner)
+
+    Yields:
+    - (images normalisées lisibles, leurs labels, nombre d'éléments consommés, _id du
+      dernier patient du bloc pour "mongo", None sinon)
+    """
+    records = iter(records)
+    # spawn : les processus ne reçoivent ni le modèle chargé ni la connexion du parent
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        workers, context, initializer=_init_worker, initargs=(source, mongo_uri, database)
+    ) as executor:
+        pending = collections.deque()
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = list(itertools.islice(records, chunk_size))
+                if not chunk:
+                    break
+                items, labels = zip(*chunk)
+                last_id = items[-1]["patient_id"] if source == "mongo" else None
+                pending.append((executor.submit(_preprocess_chunk, items), labels, last_id))
+            if not pending:
+                return
+            future, labels, last_id = pending.popleft()
+            images, ok = future.result()
+            yield images, np.asarray(labels, dtype=np.int64)[ok], len(labels), last_id
+
+
+def dataset_batches(path, split, chunk_size, skip):
+    from tumor_detection_model.functions.dataset import ShardedDataset
+
+    dataset = ShardedDataset(path)
+    indices = dataset.split(split) if split else np.arange(len(dataset))
+    for start in range(skip, len(indices), chunk_size):
+        images, labels = dataset.get_batch(indices[start : start + chunk_size])
+        yield images, labels, len(images), None
+
+
+def regroup(batches, batch_size):
+    """
+    Regroupe les blocs normalisés en lots de batch_size images pour les modèles.
+
+    Yields:
+    - (images, labels, nombre d'éléments consommés depuis le lot précédent, _id du dernier
+      patient consommé ou None)
+    """
+    images, labels, consumed = [], [], 0
+    buffered = 0
+    last_id = None
+    for chunk_images, chunk_labels, chunk_consumed, chunk_last_id in batches:
+        images.append(chunk_images)
+        labels.append(chunk_labels)
+        consumed += chunk_consumed
+        buffered += len(chunk_images)
+        last_id = chunk_last_id or last_id
+        if buffered >= batch_size:
+            yield np.concatenate(images), np.concatenate(labels), consumed, last_id
+            images, labels, consumed, buffered = [], [], 0, 0
+    if consumed:
+        yield np.concatenate(images), np.concatenate(labels), consumed, last_id
+
+
+def config_key(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def write_checkpoint(path, config, consumed, last_id, skipped, elapsed_seconds, models):
+    # Écriture atomique : un arrêt pendant l'écriture garde le point précédent
+    checkpoint = {
+        "config": config,
+        "config_key": config_key(config),
+        "consumed": consumed,
+        "last_id": last_id,
+        "skipped": skipped,
+        "elapsed_seconds": elapsed_seconds,
+        "models": [evaluated.state() for evaluated in models],
+        "updated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def evaluate(
+    batches,
+    models,
+    config,
+    checkpoint_path,
+    checkpoint_every=5000,
+    logger=None,
+    resume_from=None,
+):
+    """
+    Fait passer les lots normalisés par chaque modèle et met à jour leurs métriques.
+
+    Args:
+    - batches: itérable de (images, labels, nombre d'éléments consommés, _id du dernier
+      patient ou None), voir regroup
+    - models: list de EvaluatedModel
+    - config: dict, source et modèles, pour vérifier la reprise
+    - checkpoint_path: str, fichier du point de reprise
+    - checkpoint_every: int, nombre d'images entre deux points de reprise
+    - logger: MlflowLogger ou None
+    - resume_from: dict, point de reprise chargé, ou None
+
+    Returns:
+    - dict, rapport : nombre d'images, débit et métriques de chaque modèle
+    """
+    consumed = resume_from["consumed"] if resume_from else 0
+    last_id = resume_from.get("last_id") if resume_from else None
+    skipped = resume_from["skipped"] if resume_from else 0
+    previous_seconds = resume_from["elapsed_seconds"] if resume_from else 0.0
+    start = time.perf_counter()
+    last_checkpoint = consumed
+
+    def elapsed():
+        return previous_seconds + time.perf_counter() - start
+
+    for images, labels, batch_consumed, batch_last_id in batches:
+        for evaluated in models:
+            if len(images):
+                evaluated.predict(images, labels)
+        consumed += batch_consumed
+        last_id = batch_last_id or last_id
+        skipped += batch_consumed - len(images)
+        if consumed - last_checkpoint >= checkpoint_every:
+            last_checkpoint = consumed
+            write_checkpoint(
+                checkpoint_path, config, consumed, last_id, skipped, elapsed(), models
+            )
+            if logger is not None:
+                for evaluated in models:
+                    logger.log(evaluated, elapsed())
+            evaluated_images = models[0].metrics.confusion.sum()
+            print(f"{consumed} élément(s), {evaluated_images / elapsed():.1f} image(s)/s")
+
+    write_checkpoint(checkpoint_path, config, consumed, last_id, skipped, elapsed(), models)
+    reports = []
+    for evaluated in models:
+        report = evaluated.report(elapsed())
+        if logger is not None:
+            logger.log(evaluated, elapsed())
+            logger.finish(evaluated, report)
+        reports.append(report)
+    return {
+        "source": config["source"],
+        "preprocessing_version": preprocessing_version(TARGET_SIZE),
+        "consumed": consumed,
+        "skipped": skipped,
+        "elapsed_seconds": elapsed(),
+        "models": reports,
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--from-folders", help="dossier contenant les sous-dossiers yes et no")
+    source.add_argument("--from-mongo", action="store_true", help="patients vérifiés par un expert")
+    source.add_argument("--from-dataset", help="jeu de données en blocs (dataset.py)")
+    parser.add_argument("--split", default=None, help="avec --from-dataset, ex: test")
+    parser.add_argument(
+        "--model", action="append", default=None,
+        help="URI[#backend] du modèle, à répéter pour comparer plusieurs versions "
+        "(défaut : MLFLOW_RUN)",
+    )
+    parser.add_argument("--backend", default="mlflow", help="backend des modèles sans #backend")
+    parser.add_argument("--batch-size", type=int, default=256, help="images par appel du modèle")
+    parser.add_argument("--chunk-size", type=int, default=64, help="images par tâche du pool")
+    parser.add_argument("--workers", type=int, default=None, help="processus de prétraitement")
+    parser.add_argument("--checkpoint-every", type=int, default=5000)
+    parser.add_argument("--output", default="evaluation.json")
+    parser.add_argument("--checkpoint", default=None, help="défaut : <output>.checkpoint")
+    parser.add_argument("--resume", action="store_true", help="reprendre au dernier point de reprise")
+    parser.add_argument("--experiment", default="evaluation", help="expérience MLflow")
+    parser.add_argument("--no-mlflow", action="store_true", help="ne rien envoyer à MLflow")
+    parser.add_argument("--mongo-uri", default=None)
+    args = parser.parse_args()
+    workers = args.workers or os.cpu_count() or 1
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint"
+
+    from hidden import MLFLOW_RUN, MLFLOW_URI
+
+    import mlflow
+    from model_backends import load_model, model_version
+
+    mlflow.set_tracking_uri(MLFLOW_URI)
+
+    if args.from_folders:
+        source_config = {"folders": os.path.abspath(args.from_folders)}
+    elif args.from_dataset:
+        source_config = {"dataset": os.path.abspath(args.from_dataset), "split": args.split}
+    else:
+        source_config = {"mongodb": "patients"}
+    specs = args.model or [MLFLOW_RUN]
+    config = {
+        "source": source_config,
+        "models": specs,
+        "backend": args.backend,
+        "preprocessing_version": preprocessing_version(TARGET_SIZE),
+    }
+
+    resume_from = None
+    if args.resume and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            resume_from = json.load(f)
+        if resume_from["config_key"] != config_key(config):
+            sys.exit(
+                f"{checkpoint_path} a été écrit pour une autre source ou d'autres modèles : "
+                "relancer sans --resume"
+            )
+        if args.from_mongo and resume_from["consumed"] and not resume_from.get("last_id"):
+            sys.exit(
+                f"{checkpoint_path} ne contient pas le dernier patient évalué : "
+                "relancer sans --resume"
+            )
+        print(f"Reprise après {resume_from['consumed']} élément(s)")
+
+    models = []
+    for spec in specs:
+        model_uri, backend = parse_model_spec(spec, args.backend)
+        model = load_model(model_uri, backend)
+        models.append(
+            EvaluatedModel(spec, model_uri, backend, model, model_version(model, model_uri, backend))
+        )
+        print(f"Modèle {models[-1].version} chargé ({backend})")
+    if resume_from:
+        for evaluated, state in zip(models, resume_from["models"]):
+            evaluated.restore(state)
+
+    logger = None
+    if not args.no_mlflow:
+        logger = MlflowLogger(args.experiment)
+        params = {"source": json.dumps(source_config), "batch_size": args.batch_size}
+        for evaluated in models:
+            logger.start(evaluated, params)
+
+    skip = resume_from["consumed"] if resume_from else 0
+    if args.from_dataset:
+        chunks = dataset_batches(args.from_dataset, args.split, args.chunk_size, skip)
+    elif args.from_folders:
+        records = itertools.islice(folder_records(args.from_folders), skip, None)
+        chunks = preprocessed_batches(records, "folders", workers, args.chunk_size)
+    else:
+        from pymongo import MongoClient
+
+        if args.mongo_uri is None:
+            from hidden import MONGO_URI
+
+            args.mongo_uri = MONGO_URI
+        db = MongoClient(args.mongo_uri)["braintumor"]
+        from bson import ObjectId
+
+        # Reprise après le dernier patient évalué, par _id
+        last_id = resume_from.get("last_id") if resume_from else None
+        records = mongo_records(db, ObjectId(last_id) if last_id else None)
+        chunks = preprocessed_batches(
+            records, "mongo", workers, args.chunk_size, args.mongo_uri, "braintumor"
+        )
+
+    report = evaluate(
+        regroup(chunks, args.batch_size),
+        models,
+        config,
+        checkpoint_path,
+        args.checkpoint_every,
+        logger,
+        resume_from,
+    )
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\n{report['consumed']} élément(s), {report['skipped']} illisible(s) ignoré(s)")
+    for model_report in report["models"]:
+        auc = model_report["roc_auc"]
+        print(
+            f"{model_report['model_version']}: accuracy {model_report['accuracy'] or 0:.4f}, "
+            f"ROC AUC {auc if auc is None else round(auc, 4)}, "
+            f"{model_report['model_images_per_s'] or 0:.1f} image(s)/s (modèle)"
+        )
+    print(f"Rapport écrit dans {args.output}")
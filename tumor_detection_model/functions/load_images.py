@@ -1,39 +1,241 @@
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import cv2
 import numpy as np
 
+# Encodage historique des dossiers "yes" et "no"
+DEFAULT_CLASSES = {"yes": 1, "no": 0}
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff")
+
 
-def load_images(path_to_folder):
-    # Liste des classes (dossiers "yes" et "no")
-    classes = ["yes", "no"]
-    classes_enc = {"yes": 1, "no": 0}
+def discover_classes(path_to_folder):
+    """
+    Retourne l'encodage des classes à partir des sous-dossiers de path_to_folder.
 
-    # Compter le nombre total d'images pour allouer les tableaux numpy
-    total_images = sum(
-        len(os.listdir(os.path.join(path_to_folder, class_name)))
-        for class_name in classes
+    Les dossiers cachés (".ipynb_checkpoints"...) sont ignorés. Dès que les dossiers
+    "yes" et "no" sont présents, l'encodage historique (yes=1, no=0) est gardé, comme
+    pour les retours des experts, et les autres dossiers (par exemple "pred" dans Br35H)
+    sont ignorés avec un avertissement. Sans dossier "yes" ni "no", les classes sont
+    numérotées dans l'ordre alphabétique des dossiers.
+
+    Raises:
+    - ValueError, si un seul des dossiers "yes" et "no" est présent
+    """
+    names = sorted(
+        entry.name
+        for entry in os.scandir(path_to_folder)
+        if entry.is_dir() and not entry.name.startswith(".")
     )
+    found = set(DEFAULT_CLASSES) & set(names)
+    if found == set(DEFAULT_CLASSES):
+        ignored = [name for name in names if name not in DEFAULT_CLASSES]
+        if ignored:
+            print(f"Attention : dossier(s) ignoré(s) dans {path_to_folder} : {', '.join(ignored)}")
+        return dict(DEFAULT_CLASSES)
+    if found:
+        raise ValueError(
+            f"{path_to_folder} contient {found.pop()!r} sans son pendant : les dossiers "
+            f"{names} ne peuvent pas être encodés comme yes=1, no=0. "
+            "Passez classes explicitement."
+        )
+    return {name: label for label, name in enumerate(names)}
+
 
-    X = [None] * total_images  # Préallouer pour les images
-    y = [None] * total_images  # Préallouer pour les labels
+def list_images(path_to_folder, classes=None):
+    """
+    Liste les images de chaque dossier de classe, en un seul parcours.
 
-    last_index = 0
+    Args:
+    - path_to_folder: str, dossier contenant un sous-dossier par classe
+    - classes: dict {dossier: label}, liste de dossiers (label = position) ou None pour
+      utiliser tous les sous-dossiers (voir discover_classes)
 
-    # Parcourir chaque classe
-    for class_name in classes:
+    Returns:
+    - list des chemins, np.array des labels, dict {dossier: label}
+    """
+    if classes is None:
+        classes = discover_classes(path_to_folder)
+    elif not isinstance(classes, dict):
+        classes = {name: label for label, name in enumerate(classes)}
+
+    paths = []
+    labels = []
+    for class_name, label in classes.items():
         class_path = os.path.join(path_to_folder, class_name)
+        # Trier pour avoir un ordre stable d'une exécution à l'autre
+        names = sorted(
+            entry.name
+            for entry in os.scandir(class_path)
+            if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        paths += [os.path.join(class_path, name) for name in names]
+        labels += [label] * len(names)
+
+    return paths, np.array(labels, dtype=np.int64), classes
+
+
+def read_image(image_path, target_size=None, grayscale=False, out=None):
+    """
+    Lit une image avec OpenCV, et la redimensionne à target_size si demandé.
+
+    Si out est fourni (tableau uint8 de la taille cible), l'image redimensionnée y est
+    écrite directement, sans copie intermédiaire.
+    """
+    flag = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+    image = cv2.imread(image_path, flag)
+    if image is None:
+        raise ValueError(f"Impossible de lire l'image {image_path}")
+
+    if target_size is None:
+        return image
+    if out is not None:
+        cv2.resize(image, target_size, dst=out, interpolation=cv2.INTER_AREA)
+        return None
+    return cv2.resize(image, target_size, interpolation=cv2.INTER_AREA)
+
+
+def image_shape(target_size, grayscale=False):
+    # target_size est (largeur, hauteur) comme pour cv2.resize
+    width, height = target_size
+    return (height, width) if grayscale else (height, width, 3)
+
+
+def _submit_batch(executor, paths, target_size, grayscale, out, processes):
+    if out is not None and not processes:
+        # Threads : chaque image est écrite directement dans sa ligne du tableau
+        return [
+            executor.submit(read_image, path, target_size, grayscale, out[i])
+            for i, path in enumerate(paths)
+        ]
+    return [
+        executor.submit(read_image, path, target_size, grayscale) for path in paths
+    ]
+
+
+def _collect_batch(futures, out):
+    if out is None:
+        # Tailles d'origine différentes : tableau d'objets comme auparavant
+        X = np.empty(len(futures), dtype="object")
+        for i, future in enumerate(futures):
+            X[i] = future.result()
+        return X
+
+    for i, future in enumerate(futures):
+        image = future.result()
+        if image is not None:
+            out[i] = image
+    return out
+
+
+def iter_image_batches(
+    path_to_folder,
+    batch_size=256,
+    classes=None,
+    target_size=None,
+    grayscale=False,
+    workers=None,
+    processes=False,
+):
+    """
+    Charge les images par lots, en parallèle, sans garder tout le jeu de données en mémoire.
+
+    Le lot suivant est décodé pendant que le lot courant est utilisé.
+
+    Args:
+    - path_to_folder: str, dossier contenant un sous-dossier par classe
+    - batch_size: int, nombre d'images par lot
+    - classes: voir list_images
+    - target_size: tuple (largeur, hauteur) ou None. Si fourni, chaque lot est un tableau
+      uint8 contigu (batch, hauteur, largeur[, 3]), sinon un tableau d'objets
+    - grayscale: bool, lire les images en niveaux de gris
+    - workers: int, nombre de threads/processus de décodage (défaut : nombre de CPU)
+    - processes: bool, décoder dans des processus plutôt que des threads
+
+    Yields:
+    - (X, y, chemins) pour chaque lot
+    """
+    paths, labels, _ = list_images(path_to_folder, classes)
+    workers = workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+
+    with pool(max_workers=workers) as executor:
+        pending = None
+        for start in range(0, len(paths), batch_size):
+            batch_paths = paths[start : start + batch_size]
+            out = None
+            if target_size is not None:
+                out = np.empty(
+                    (len(batch_paths),) + image_shape(target_size, grayscale), np.uint8
+                )
+            futures = _submit_batch(
+                executor, batch_paths, target_size, grayscale, out, processes
+            )
+            if pending is not None:
+                yield _pending_result(pending, labels, paths)
+            pending = (futures, out, start)
+        if pending is not None:
+            yield _pending_result(pending, labels, paths)
+
+
+def _pending_result(pending, labels, paths):
+    futures, out, start = pending
+    end = start + len(futures)
+    return _collect_batch(futures, out), labels[start:end], paths[start:end]
+
+
+def load_images(
+    path_to_folder,
+    classes=None,
+    target_size=None,
+    grayscale=False,
+    workers=None,
+    processes=False,
+    out=None,
+    batch_size=256,
+):
+    """
+    Charge toutes les images d'un dossier de classes, en parallèle.
+
+    Args:
+    - path_to_folder: str, dossier contenant un sous-dossier par classe
+    - classes: voir list_images
+    - target_size: tuple (largeur, hauteur) ou None. Si fourni, les images sont écrites
+      dans un seul tableau uint8 contigu préalloué, sinon dans un tableau d'objets
+    - grayscale: bool, lire les images en niveaux de gris
+    - workers: int, nombre de threads/processus de décodage (défaut : nombre de CPU)
+    - processes: bool, décoder dans des processus plutôt que des threads
+    - out: tableau uint8 préalloué de forme (n_images, hauteur, largeur[, 3]), par exemple
+      un np.lib.format.open_memmap pour charger un jeu plus grand que la mémoire
+    - batch_size: int, nombre d'images décodées à la fois
 
-        # Parcourir chaque image dans la classe
-        for idx, image_name in enumerate(os.listdir(class_path)):
-            image_path = os.path.join(class_path, image_name)
+    Returns:
+    - np.array des images, np.array des labels
+    """
+    paths, labels, _ = list_images(path_to_folder, classes)
 
-            # Lire l'image avec OpenCV
-            image = cv2.imread(image_path)
+    if target_size is None:
+        X = np.empty(len(paths), dtype="object")
+    else:
+        shape = (len(paths),) + image_shape(target_size, grayscale)
+        if out is None:
+            out = np.empty(shape, dtype=np.uint8)
+        elif out.shape != shape or out.dtype != np.uint8:
+            raise ValueError(f"out doit être un tableau uint8 de forme {shape}")
+        X = out
 
-            # Ajouter l'image et le label aux tableaux X et y
-            X[last_index + idx] = image
-            y[last_index + idx] = classes_enc[class_name]
+    workers = workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
 
-        last_index = last_index + idx + 1
+    with pool(max_workers=workers) as executor:
+        for start in range(0, len(paths), batch_size):
+            batch_paths = paths[start : start + batch_size]
+            batch_out = None if target_size is None else X[start : start + batch_size]
+            futures = _submit_batch(
+                executor, batch_paths, target_size, grayscale, batch_out, processes
+            )
+            batch = _collect_batch(futures, batch_out)
+            if target_size is None:
+                X[start : start + len(batch_paths)] = batch
 
-    return np.array(X, dtype="object"), np.array(y)
+    return X, labels
@@ -1,55 +1,78 @@
+import hashlib
+import json
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import cv2
 import numpy as np
 
+# Paramètres du prétraitement, partagés par l'entraînement et l'API du modèle
+BLUR_KERNEL = (5, 5)
+THRESHOLD = 30
+
+
+def preprocessing_params(target_size):
+    return {
+        "target_size": list(target_size),
+        "blur_kernel": list(BLUR_KERNEL),
+        "threshold": THRESHOLD,
+    }
 
-def normalize_images(X, target_size):
+
+def preprocessing_version(target_size):
+    """
+    Identifiant des paramètres de prétraitement : les ROIs et le cache calculés avec
+    d'autres paramètres ne sont pas réutilisés.
     """
-    Normalise les images en niveaux de gris, applique un filtre pour supprimer le bruit, détecte les contours pour trouver le crop optimal, et redimensionne les images à target_size.
+    params = json.dumps(preprocessing_params(target_size), sort_keys=True)
+    return hashlib.sha1(params.encode()).hexdigest()[:12]
 
-    Args:
-    - X: np.array, liste d'images (ndarray)
-    - target_size: tuple, taille cible des images (ex: (224, 224))
 
-    Returns:
-    - np.array, liste d'images normalisées
+def normalize_image_with_box(img, target_size, out=None):
     """
-    normalized_images = [None] * len(X)
+    Normalise une image : filtre le bruit sur l'image en niveaux de gris, détecte les
+    contours pour trouver le crop optimal, et redimensionne le crop à target_size.
 
-    for i, img in enumerate(X):
-        if len(img.shape) == 3:
-            # Convertir en niveaux de gris si c'est pas déjà le cas
-            gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    Args:
+    - img: np.array, image en couleur (BGR) ou en niveaux de gris
+    - target_size: tuple, taille cible de l'image (ex: (224, 224))
+    - out: np.array uint8 optionnel, où écrire l'image normalisée (même nombre de
+      canaux que img)
 
-        # Appliquer un filtre pour supprimer le bruit (par exemple, un filtre gaussien)
-        denoised_img = cv2.GaussianBlur(gray_img, (5, 5), 0)
+    Returns:
+    - np.array, image normalisée, et (x, y, w, h) du crop ou None sans contour
+    """
+    # Convertir en niveaux de gris si ce n'est pas déjà le cas
+    if len(img.shape) == 3:
+        gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    else:
+        gray_img = img
 
-        # Détecter les contours pour trouver le crop optimal
-        _, thresh = cv2.threshold(denoised_img, 30, 255, cv2.THRESH_BINARY)
-        contours, _ = cv2.findContours(
-            thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-        )
+    # Appliquer un filtre pour supprimer le bruit (par exemple, un filtre gaussien)
+    denoised_img = cv2.GaussianBlur(gray_img, BLUR_KERNEL, 0)
 
-        if contours:
-            # Trouver le contour avec la plus grande aire
-            max_contour = max(contours, key=cv2.contourArea)
+    # Détecter les contours pour trouver le crop optimal
+    _, thresh = cv2.threshold(denoised_img, THRESHOLD, 255, cv2.THRESH_BINARY)
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-            # Obtenir les coordonnées du rectangle englobant
-            x, y, w, h = cv2.boundingRect(max_contour)
+    box = None
+    if contours:
+        # Trouver le contour avec la plus grande aire
+        max_contour = max(contours, key=cv2.contourArea)
 
-            # Cropper l'image pour obtenir la région d'intérêt
-            cropped_img = img[y : y + h, x : x + w]
+        # Obtenir les coordonnées du rectangle englobant
+        x, y, w, h = cv2.boundingRect(max_contour)
+        box = (x, y, w, h)
 
-            # Redimensionner à target_size (pour s'assurer que toutes les images ont la même taille)
-            normalized_images[i] = cv2.resize(
-                cropped_img, target_size, interpolation=cv2.INTER_AREA
-            )
-        else:
-            # Redimensionner à target_size si aucun contour n'est détecté
-            normalized_images[i] = cv2.resize(
-                img, target_size, interpolation=cv2.INTER_AREA
-            )
+        # Cropper l'image pour obtenir la région d'intérêt
+        img = img[y : y + h, x : x + w]
 
-    return np.array(normalized_images)
+    # Redimensionner à target_size (pour s'assurer que toutes les images ont la même taille)
+    if out is None:
+        return cv2.resize(img, target_size, interpolation=cv2.INTER_AREA), box
+    cv2.resize(img, target_size, dst=out, interpolation=cv2.INTER_AREA)
+    return out, box
 
 
 def normalize_image(img, target_size):
@@ -63,36 +86,205 @@ def normalize_image(img, target_size):
     Returns:
     - np.array, image normalisée
     """
-    # Convertir en niveaux de gris si ce n'est pas déjà le cas
-    if len(img.shape) == 3:
-        gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return normalize_image_with_box(img, target_size)[0]
 
-        # Appliquer un filtre pour supprimer le bruit (par exemple, un filtre gaussien)
-        denoised_img = cv2.GaussianBlur(gray_img, (5, 5), 0)
+
+def _normalize_into(img, target_size, out):
+    if len(img.shape) == 2 and len(out.shape) == 3:
+        # Image en niveaux de gris dans une sortie en couleur
+        normalized, _ = normalize_image_with_box(img, target_size)
+        cv2.cvtColor(normalized, cv2.COLOR_GRAY2BGR, dst=out)
+    elif len(img.shape) == 3 and len(out.shape) == 2:
+        normalize_image_with_box(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), target_size, out)
     else:
-        # Appliquer un filtre pour supprimer le bruit (par exemple, un filtre gaussien)
-        denoised_img = cv2.GaussianBlur(img, (5, 5), 0)
+        normalize_image_with_box(img, target_size, out)
 
-    # Détecter les contours pour trouver le crop optimal
-    _, thresh = cv2.threshold(denoised_img, 30, 255, cv2.THRESH_BINARY)
-    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-    if contours:
-        # Trouver le contour avec la plus grande aire
-        max_contour = max(contours, key=cv2.contourArea)
+def _normalize_chunk(X, start, end, target_size, out):
+    for i in range(start, end):
+        _normalize_into(X[i], target_size, out[i])
 
-        # Obtenir les coordonnées du rectangle englobant
-        x, y, w, h = cv2.boundingRect(max_contour)
 
-        # Cropper l'image pour obtenir la région d'intérêt
-        cropped_img = img[y : y + h, x : x + w]
+def chunk_bounds(n, chunk_size, workers=1):
+    # Des blocs plus petits quand il y a peu d'images, pour occuper tous les threads
+    chunk_size = max(1, min(chunk_size, -(-n // workers)))
+    return [(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+
 
-        # Redimensionner à target_size (pour s'assurer que toutes les images ont la même taille)
-        normalized_image = cv2.resize(
-            cropped_img, target_size, interpolation=cv2.INTER_AREA
+def normalize_images(X, target_size, workers=None, chunk_size=64, out=None):
+    """
+    Normalise un lot d'images en parallèle (voir normalize_image).
+
+    Les images sont réparties par blocs sur plusieurs threads (OpenCV libère le GIL), et
+    chaque image normalisée est écrite directement dans un tableau préalloué.
+
+    Args:
+    - X: np.array, liste d'images (ndarray), en couleur ou en niveaux de gris
+    - target_size: tuple, taille cible des images (ex: (224, 224))
+    - workers: int, nombre de threads (défaut : nombre de CPU)
+    - chunk_size: int, nombre d'images par tâche
+    - out: np.array uint8 optionnel de forme (n, hauteur, largeur[, 3])
+
+    Returns:
+    - np.array uint8, images normalisées : en couleur si au moins une image l'est
+    """
+    n = len(X)
+    if out is None:
+        width, height = target_size
+        color = any(len(img.shape) == 3 for img in X)
+        shape = (n, height, width, 3) if color else (n, height, width)
+        out = np.empty(shape, dtype=np.uint8)
+
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_normalize_chunk, X, start, end, target_size, out)
+            for start, end in chunk_bounds(n, chunk_size, workers)
+        ]
+        for future in futures:
+            future.result()
+
+    return out
+
+
+def _normalize_files_chunk(paths, target_size, out):
+    for row, path in enumerate(paths):
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError(f"Impossible de lire l'image {path}")
+        normalize_image_with_box(img, target_size, out[row])
+
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class NormalizedCache:
+    """
+    Cache sur disque des images normalisées, par contenu de fichier.
+
+    Les images sont stockées par blocs dans des fichiers .npy (lus en memmap), dans un
+    dossier par version de prétraitement. index.json associe le sha256 de chaque fichier
+    source au bloc et à la ligne de son image normalisée.
+    """
+
+    def __init__(self, cache_dir, target_size):
+        self.target_size = target_size
+        self.dir = os.path.join(cache_dir, preprocessing_version(target_size))
+        os.makedirs(self.dir, exist_ok=True)
+        self.index_path = os.path.join(self.dir, "index.json")
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def shard_path(self, shard):
+        return os.path.join(self.dir, f"{shard}.npy")
+
+    def write_shard(self, hashes, paths):
+        """
+        Normalise les fichiers d'un bloc directement dans un nouveau fichier .npy.
+        """
+        width, height = self.target_size
+        shard = uuid.uuid4().hex
+        tmp_path = self.shard_path(shard) + ".tmp"
+        images = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.uint8, shape=(len(paths), height, width, 3)
         )
-    else:
-        # Redimensionner à target_size si aucun contour n'est détecté
-        normalized_image = cv2.resize(img, target_size, interpolation=cv2.INTER_AREA)
+        try:
+            _normalize_files_chunk(paths, self.target_size, images)
+        except ValueError:
+            del images
+            os.remove(tmp_path)
+            raise
+        images.flush()
+        del images
+        os.replace(tmp_path, self.shard_path(shard))
+        return shard, hashes
+
+    def add(self, shard, hashes):
+        for row, sha256 in enumerate(hashes):
+            self.index[sha256] = [shard, row]
+        # Écriture atomique, pour garder les blocs déjà calculés si le calcul est interrompu
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def read_into(self, hashes, out):
+        # Copier les lignes de chaque bloc, ouvert une seule fois en memmap
+        by_shard = {}
+        for i, sha256 in enumerate(hashes):
+            shard, row = self.index[sha256]
+            by_shard.setdefault(shard, []).append((i, row))
+        for shard, rows in by_shard.items():
+            images = np.load(self.shard_path(shard), mmap_mode="r")
+            positions, shard_rows = zip(*rows)
+            out[list(positions)] = images[list(shard_rows)]
+        return out
+
+
+def normalize_files(
+    paths, target_size, cache_dir=None, workers=None, chunk_size=256, out=None
+):
+    """
+    Lit et normalise des fichiers image en parallèle, avec un cache sur disque.
+
+    Avec cache_dir, seuls les fichiers nouveaux ou modifiés depuis la dernière exécution
+    (ou normalisés avec d'autres paramètres) sont traités.
+
+    Args:
+    - paths: liste des chemins des images (lues en couleur)
+    - target_size: tuple, taille cible des images (ex: (224, 224))
+    - cache_dir: str, dossier du cache, ou None pour ne rien stocker
+    - workers: int, nombre de threads (défaut : nombre de CPU)
+    - chunk_size: int, nombre d'images par bloc
+    - out: np.array uint8 optionnel de forme (n, hauteur, largeur, 3), par exemple un
+      np.lib.format.open_memmap
+
+    Returns:
+    - np.array uint8 de forme (n, hauteur, largeur, 3)
+    """
+    width, height = target_size
+    if out is None:
+        out = np.empty((len(paths), height, width, 3), dtype=np.uint8)
+    workers = workers or os.cpu_count() or 1
+
+    if cache_dir is None:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    _normalize_files_chunk, paths[start:end], target_size, out[start:end]
+                )
+                for start, end in chunk_bounds(len(paths), chunk_size, workers)
+            ]
+            for future in futures:
+                future.result()
+        return out
+
+    cache = NormalizedCache(cache_dir, target_size)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = list(executor.map(file_hash, paths))
+
+        # Fichiers à normaliser : un seul par contenu
+        missing = {}
+        for sha256, path in zip(hashes, paths):
+            if sha256 not in cache.index:
+                missing.setdefault(sha256, path)
+        missing_hashes = list(missing)
+        futures = [
+            executor.submit(
+                cache.write_shard,
+                missing_hashes[start:end],
+                [missing[sha256] for sha256 in missing_hashes[start:end]],
+            )
+            for start, end in chunk_bounds(len(missing_hashes), chunk_size, workers)
+        ]
+        for future in as_completed(futures):
+            cache.add(*future.result())
 
-    return normalized_image
+    return cache.read_into(hashes, out)